@@ -1,6 +1,8 @@
 import numpy as np
 import tensorflow as tf
 from models.CNNEmbed import CNNEmbed
+from models.CNNEmbed1D import CNNEmbed1D
+from convert_checkpoint import checkpoint_fused_gating
 import nltk
 import cPickle
 import os
@@ -14,13 +16,21 @@ ZERO_IND = 483018
 
 tknzr = nltk.tokenize.TweetTokenizer()
 from train_GBW import perform_trec_exp
+from document_encoder import DocumentEncoder
 
-def load_model():
+def load_model(conv1d=False, ranks=None, causal=False):
     '''
-    Load the CNN model
+    Load the CNN model. Checkpoints with separate value and gate convolutions, from before fused gating, are built with
+    fused_gating=False.
+
+    Args:
+        conv1d (bool): If True, build CNNEmbed1D instead of CNNEmbed. The checkpoint has to be in its layout.
+        ranks (list): The rank of each convolution, for a checkpoint factorized with factorize_model.py.
+        causal (bool): Build the causal model with max pooling, as trained with train_GBW.py --num-targets.
     '''
 
     # Model parameters here.
+    checkpoint_prefix = os.path.join('./latest_model_gbw', 'gbw_model_latest')
     context_len = 5
     batch_size = 100
     num_filters = 900
@@ -29,7 +39,7 @@ def load_model():
     pos_words_num = 5
     neg_words_num = 10
     num_residual = 1
-    k_max = 3
+    k_max = 0 if causal else 3
     max_doc_len = 45
     embed_dim = 300
 
@@ -41,13 +51,20 @@ def load_model():
         indices_target_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, pos_words_num + neg_words_num])
 
         embedding = tf.get_variable("embedding", [VOCAB_SIZE, embed_dim], dtype=tf.float32, trainable=True)
+        # 1 for words and 0 for padding. Only fed when embedding padded batches of documents with different lengths.
+        doc_mask_placeholder = tf.placeholder_with_default(tf.ones_like(indices_data_placeholder, dtype=tf.float32),
+                                                           shape=[None, None], name='doc_mask')
         inputs = tf.gather(embedding, indices_data_placeholder)
-        inputs = tf.expand_dims(inputs, 3)
-        inputs = tf.transpose(inputs, [0, 2, 1, 3])
-
         targets_embeds = tf.gather(embedding, indices_target_placeholder)
-        targets_embeds = tf.expand_dims(targets_embeds, 3)
-        targets_embeds = tf.transpose(targets_embeds, [0, 2, 1, 3])
+        if conv1d:
+            # CNNEmbed1D takes the gathered (batch, doc_len, embed_dim) embeddings as they are.
+            model_class = CNNEmbed1D
+        else:
+            model_class = CNNEmbed
+            inputs = tf.expand_dims(inputs, 3)
+            inputs = tf.transpose(inputs, [0, 2, 1, 3])
+            targets_embeds = tf.expand_dims(targets_embeds, 3)
+            targets_embeds = tf.transpose(targets_embeds, [0, 2, 1, 3])
 
         target_place_holder = tf.placeholder(tf.float32, [None, pos_words_num + neg_words_num])
         # Placeholder for training
@@ -55,8 +72,10 @@ def load_model():
         is_training_placeholder = tf.placeholder(dtype=tf.bool, name='training_boolean')
 
         # build model
-        _docCNN = CNNEmbed(inputs, targets_embeds, target_place_holder, is_training_placeholder, keep_prob_placeholder,
-                           max_doc_len, embed_dim, num_layers, num_filters, num_residual, k_max, filter_size, 0.)
+        _docCNN = model_class(inputs, targets_embeds, target_place_holder, is_training_placeholder,
+                              keep_prob_placeholder, max_doc_len, embed_dim, num_layers, num_filters, num_residual,
+                              k_max, filter_size, 0., mask=doc_mask_placeholder, ranks=ranks,
+                              causal=causal, fused_gating=checkpoint_fused_gating(checkpoint_prefix))
 
         # input of the test (supervised learning) process
         model_output = tf.squeeze(_docCNN.res)
@@ -66,29 +85,47 @@ def load_model():
         saver = tf.train.Saver()
 
     # Restore the weights
-    saver.restore(sess_docCNN, os.path.join('./latest_model_gbw', 'gbw_model_latest'))
+    saver.restore(sess_docCNN, checkpoint_prefix)
 
     cnn_model['sess'] = sess_docCNN
     cnn_model['model'] = _docCNN
-    cnn_model['placeholders'] = [indices_data_placeholder, is_training_placeholder, keep_prob_placeholder]
+    cnn_model['placeholders'] = [indices_data_placeholder, is_training_placeholder, keep_prob_placeholder,
+                                doc_mask_placeholder]
     cnn_model['model_output'] = model_output
 
     return cnn_model
 
 
-def perform_exp(cnn_model, word_to_index, experiments):
+def model_encoder(cnn_model, word_to_index):
+    '''
+    Create a DocumentEncoder for a model returned by load_model.
+    '''
+
+    placeholders = cnn_model['placeholders']
+    return DocumentEncoder(cnn_model['sess'], cnn_model['model_output'], placeholders[0], placeholders[2],
+                           placeholders[1], placeholders[3], ZERO_IND, word_to_index)
+
+
+def perform_exp(encoder, experiments):
     '''
     Perform the listed classification experiments. Modelled off of skip-thought.
+
+    Args:
+        encoder (DocumentEncoder): Encoder for the model, with the GBW vocabulary.
+        experiments (list): Names of the experiments, TREC, MR, CR, SUBJ or MPQA.
+
+    Returns:
+        accuracies (dict): The classification accuracy of each experiment.
     '''
 
+    accuracies = dict()
     for exp in experiments:
         print('--------------------------------------------')
         if exp == 'TREC':
-            perform_trec_exp(cnn_model['sess'], cnn_model['model_output'], cnn_model['placeholders'][0],
-                             cnn_model['placeholders'][2], cnn_model['placeholders'][1], word_to_index)
+            accuracies[exp] = perform_trec_exp(encoder)
         else:
             # Load the dataset and extract features
-            z, features = dataset_handler.load_data(cnn_model, word_to_index, exp)
+            z, features = dataset_handler.load_data(encoder, exp)
 
             scan = [2 ** t for t in range(0, 9, 1)]
             kf = KFold(n_splits=10, random_state=1234)
@@ -137,6 +174,9 @@ def perform_exp(cnn_model, word_to_index, experiments):
                 scores.append(acc)
 
             print('{} classification accuracy: {}'.format(exp, np.mean(scores)))
+            accuracies[exp] = np.mean(scores)
+
+    return accuracies
 
 
 if __name__ == '__main__':
@@ -147,4 +187,4 @@ if __name__ == '__main__':
 
     experiments = ['TREC', 'MR', 'CR', 'SUBJ', 'MPQA']
 
-    perform_exp(cnn_model, word_to_index, experiments)
+    perform_exp(model_encoder(cnn_model, word_to_index), experiments)
@@ -0,0 +1,220 @@
+import argparse
+import re
+import numpy as np
+import tensorflow as tf
+
+# Variables of the separate value and gate convolutions of a gated layer, in CNNEmbed with fused_gating=False. Adam
+# slots, e.g. conv_0/weights_w_0/Adam, match as well.
+GATE_VALUE_PATTERN = re.compile(r'(weights|biases|batch_norm)_w_(\d+)')
+GATE_GATE_PATTERN = re.compile(r'(weights|biases|batch_norm)_v_(\d+)')
+# Conv kernels of CNNEmbed and CNNEmbed1D, e.g. conv_0/weights_wv_0. Their biases and batch norm share the suffix, and
+# the kernels of factorized convolutions are followed by a projection, e.g. conv_0/weights_wv_0_proj.
+CONV_KERNEL_PATTERN = re.compile(r'^(conv_\d+)/weights_((?:wv_|w_|v_)?\d+)$')
+# Default epsilon of tf.contrib.layers.batch_norm.
+BATCH_NORM_EPSILON = 0.001
+
+
+def fuse_gating(variables):
+    '''
+    Convert the variables of a CNNEmbed model with fused_gating=False to the layout of fused_gating=True. The value
+    (w) and gate (v) halves of every layer are concatenated along their last axis, the output channels, which is
+    the order the fused layer splits them in.
+
+    Args:
+        variables (dict): numpy arrays by checkpoint name.
+
+    Returns:
+        fused (dict): The converted numpy arrays by checkpoint name.
+    '''
+
+    fused = dict()
+    for name, value in variables.items():
+        if GATE_GATE_PATTERN.search(name):
+            continue
+
+        match = GATE_VALUE_PATTERN.search(name)
+        if match is None:
+            fused[name] = value
+            continue
+        if name[match.end():].startswith('_proj'):
+            raise ValueError('Can\'t fuse the factorized convolution {}, factorize the fused model instead.'.format(name))
+
+        gate_name = '{}{}_v_{}{}'.format(name[:match.start()], match.group(1), match.group(2), name[match.end():])
+        if gate_name not in variables:
+            raise ValueError('Found {} but not the matching gate variable {}.'.format(name, gate_name))
+
+        fused_name = '{}{}_wv_{}{}'.format(name[:match.start()], match.group(1), match.group(2), name[match.end():])
+        fused[fused_name] = np.concatenate([value, variables[gate_name]], axis=-1)
+
+    return fused
+
+
+def to_conv1d(variables):
+    '''
+    Convert the variables of a CNNEmbed model to the layout of CNNEmbed1D. The 2D conv kernels, of shape
+    (filter_height x filter_width x in_chans x out_chans), become 1D kernels of shape
+    (filter_width x (filter_height * in_chans) x out_chans). For the first layer filter_height is embed_dim and in_chans
+    is 1, and for the others filter_height is 1. Everything else is unchanged.
+
+    Args:
+        variables (dict): numpy arrays by checkpoint name.
+
+    Returns:
+        converted (dict): The converted numpy arrays by checkpoint name.
+    '''
+
+    converted = dict()
+    for name, value in variables.items():
+        if name.startswith('conv_') and value.ndim == 4:
+            height, width, in_chans, out_chans = value.shape
+            value = np.transpose(value, [1, 0, 2, 3]).reshape([width, height * in_chans, out_chans])
+        converted[name] = value
+
+    return converted
+
+
+def fold_batch_norm(variables):
+    '''
+    Fold the inference batch norm after every convolution into the convolution, for a model built with
+    batch_norm=False. At inference the batch norm is gamma * (conv - moving_mean) / sqrt(moving_variance + eps) + beta,
+    which is a per channel scale and shift, so it becomes part of the conv kernel and biases. For factorized
+    convolutions, the projection is scaled instead of the kernel. The batch norm variables and the optimizer slots of
+    every folded variable are dropped.
+
+    Args:
+        variables (dict): numpy arrays by checkpoint name.
+
+    Returns:
+        folded (dict): The converted numpy arrays by checkpoint name.
+    '''
+
+    folded = dict()
+    replaced = set()
+    for name, value in variables.items():
+        match = CONV_KERNEL_PATTERN.match(name)
+        if match is None:
+            continue
+
+        scope, suffix = match.groups()
+        if '{}_proj'.format(name) in variables:
+            name = '{}_proj'.format(name)
+            value = variables[name]
+        biases_name = '{}/biases_{}'.format(scope, suffix)
+        batch_norm_scope = '{}/batch_norm_{}'.format(scope, suffix)
+        batch_norm_names = ['{}/{}'.format(batch_norm_scope, param)
+                            for param in ['gamma', 'beta', 'moving_mean', 'moving_variance']]
+        missing = [var_name for var_name in [biases_name] + batch_norm_names if var_name not in variables]
+        if missing:
+            raise ValueError('Found {} but not {}.'.format(name, ', '.join(missing)))
+
+        gamma, beta, moving_mean, moving_variance = [variables[var_name] for var_name in batch_norm_names]
+        # The output channels are the last axis of the kernel, for both the 2D and the 1D layout.
+        scale = gamma / np.sqrt(moving_variance + BATCH_NORM_EPSILON)
+        folded[name] = (value * scale).astype(value.dtype)
+        folded[biases_name] = ((variables[biases_name] - moving_mean) * scale + beta).astype(value.dtype)
+        replaced.update([name, biases_name, batch_norm_scope])
+
+    for name, value in variables.items():
+        if name in folded or any(name.startswith(prefix + '/') for prefix in replaced):
+            continue
+        folded[name] = value
+
+    return folded
+
+
+CONVERSIONS = {
+    'fuse_gating': fuse_gating,
+    'to_conv1d': to_conv1d,
+    'fold_batch_norm': fold_batch_norm,
+}
+
+
+def checkpoint_fused_gating(prefix):
+    '''
+    Tell if a checkpoint has the layout of CNNEmbed with fused_gating=True, from the names of its variables, so the
+    model that restores it can be built to match. Checkpoints of models without gating read as fused, which makes no
+    difference to them.
+
+    Args:
+        prefix (str): Prefix of the checkpoint, as given to tf.train.Saver.restore.
+
+    Returns:
+        fused_gating (bool): False if the checkpoint has separate value and gate convolutions.
+    '''
+
+    names = tf.train.NewCheckpointReader(prefix).get_variable_to_shape_map()
+    return not any(GATE_VALUE_PATTERN.search(name) for name in names)
+
+
+def read_checkpoint(prefix):
+    '''
+    Read every variable of a checkpoint.
+
+    Args:
+        prefix (str): Prefix of the checkpoint, as given to tf.train.Saver.restore.
+
+    Returns:
+        variables (dict): numpy arrays by checkpoint name.
+    '''
+
+    reader = tf.train.NewCheckpointReader(prefix)
+    return dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map())
+
+
+def convert_checkpoint(input_prefix, output_prefix, conversions):
+    '''
+    Read every variable of a checkpoint, apply the conversions in order, and save the result as a new checkpoint.
+
+    Args:
+        input_prefix (str): Prefix of the checkpoint to read, as given to tf.train.Saver.restore.
+        output_prefix (str): Prefix of the checkpoint to write.
+        conversions (list): Names of functions in CONVERSIONS.
+    '''
+
+    variables = read_checkpoint(input_prefix)
+    for conversion in conversions:
+        variables = CONVERSIONS[conversion](variables)
+
+    save_checkpoint(variables, output_prefix)
+
+
+def save_checkpoint(variables, output_prefix):
+    '''
+    Save numpy arrays as a checkpoint, under their names.
+
+    Args:
+        variables (dict): numpy arrays by checkpoint name.
+        output_prefix (str): Prefix of the checkpoint to write.
+    '''
+
+    with tf.Graph().as_default():
+        # The values are fed in after the variables are created, so the embedding matrix doesn't end up as a constant
+        # in the graph.
+        var_list = dict()
+        for i, name in enumerate(sorted(variables)):
+            value = np.asarray(variables[name])
+            var_list[name] = tf.get_variable('var_{}'.format(i), shape=value.shape, dtype=tf.as_dtype(value.dtype),
+                                             initializer=tf.zeros_initializer())
+
+        saver = tf.train.Saver(var_list)
+        with tf.Session() as sess:
+            for name, var in var_list.items():
+                var.load(variables[name], sess)
+            saver.save(sess, output_prefix)
+
+    print('Saved {} variables to {}'.format(len(variables), output_prefix))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert a CNNEmbed checkpoint to a different layout of the model.')
+    parser.add_argument('--input', type=str, required=True, help='Prefix of the checkpoint to convert.')
+    parser.add_argument('--output', type=str, required=True, help='Prefix of the converted checkpoint.')
+    parser.add_argument('--conversion', type=str, action='append', required=True, choices=sorted(CONVERSIONS),
+                        help='Conversion to apply. Can be given several times, the conversions are applied in order. '
+                             '\'fuse_gating\' converts a model with separate w and v gating convolutions to '
+                             'fused_gating=True, \'to_conv1d\' converts a CNNEmbed model to CNNEmbed1D, and '
+                             '\'fold_batch_norm\' folds the batch norms into the convolutions, for batch_norm=False.')
+    args = parser.parse_args()
+
+    convert_checkpoint(args.input, args.output, args.conversion)
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+from preprocess import DATASET_FILES, PREPROCESS_VERSION, WORD2VEC_FILE, load_word2vec, read_dataset, \
+    remap_to_local_vocab
+from tokenizer import TOKENIZER_VERSION
+from util import RaggedArray, get_sup_data
+
+META_FILE = 'meta.json'
+
+
+def file_fingerprints(data_path, file_names):
+    '''
+    Return a fingerprint of each input file, made of its name, size and modification time. The files are far too big
+    to hash their contents on every run.
+    '''
+
+    fingerprints = []
+    for fn in file_names:
+        stat = os.stat(os.path.join(data_path, fn))
+        fingerprints.append([fn, stat.st_size, int(stat.st_mtime)])
+    return fingerprints
+
+
+class PreprocessingCache(object):
+    '''
+    A directory of pre-processed arrays, where every entry is keyed by a hash of everything it was computed from. A
+    run with different parameters gets a different key, so it never picks up stale files, and switching back to an
+    earlier configuration reuses its entry. Entries are written atomically, and the least recently used ones are
+    removed when the cache grows past its size budget.
+    '''
+
+    def __init__(self, cache_dir, max_size=None):
+        '''
+        Args:
+            cache_dir (str): Directory holding the entries, one sub-directory per entry.
+            max_size (int): Size budget in bytes. If None, entries are never removed.
+        '''
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, stage, params):
+        '''
+        Return the key of the output of a pre-processing stage, given all of its inputs.
+
+        Args:
+            stage (str): Name of the stage, which prefixes the key so the entries are easy to tell apart.
+            params (dict): JSON-serializable inputs of the stage, including the keys of the stages it depends on.
+        '''
+
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+        return '{}-{}'.format(stage, digest[:16])
+
+    def get(self, key):
+        '''
+        Return the arrays stored under key, as a dict, or None if there is no such entry. RaggedArrays are
+        memory-mapped.
+        '''
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_fn = os.path.join(entry_dir, META_FILE)
+        if not os.path.isfile(meta_fn):
+            return None
+
+        with open(meta_fn) as f:
+            meta = json.load(f)
+
+        arrays = dict()
+        for name in meta['arrays']:
+            if name in meta['ragged']:
+                arrays[name] = RaggedArray.load(os.path.join(entry_dir, name))
+            else:
+                arrays[name] = np.load(os.path.join(entry_dir, name + '.npy'))
+
+        # The modification time of the meta file is the last time the entry was used.
+        os.utime(meta_fn, None)
+        print('Loaded {} from the cache.'.format(key))
+        return arrays
+
+    def put(self, key, arrays, params):
+        '''
+        Store arrays under key, then remove old entries if the cache is over its size budget.
+
+        Args:
+            key (str): Key from key().
+            arrays (dict): numpy arrays and RaggedArrays, by name.
+            params (dict): The inputs the key was computed from, stored alongside for reference.
+        '''
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = '{}.tmp{}'.format(entry_dir, os.getpid())
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        ragged = []
+        for name, array in arrays.items():
+            if isinstance(array, RaggedArray):
+                array.save(os.path.join(tmp_dir, name))
+                ragged.append(name)
+            else:
+                np.save(os.path.join(tmp_dir, name + '.npy'), array)
+
+        with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+            json.dump({'arrays': sorted(arrays), 'ragged': ragged, 'params': params, 'created': time.time()}, f,
+                      indent=2, sort_keys=True)
+
+        # Rename the finished entry into place, so an interrupted run never leaves a partial entry behind. An existing
+        # entry, e.g. when rebuilding, is moved aside first and replaced.
+        old_dir = None
+        if os.path.isdir(entry_dir):
+            old_dir = '{}.old{}'.format(entry_dir, os.getpid())
+            os.rename(entry_dir, old_dir)
+        os.rename(tmp_dir, entry_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir)
+
+        self.evict(keep=[key])
+
+    def evict(self, keep=()):
+        '''
+        Remove the least recently used entries until the cache fits in its size budget. Entries in keep are never
+        removed.
+        '''
+
+        if self.max_size is None:
+            return
+
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_fn = os.path.join(entry_dir, META_FILE)
+            if not os.path.isfile(meta_fn):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry_dir, fn)) for fn in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(meta_fn), name, size))
+            total_size += size
+
+        for _, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name in keep:
+                continue
+
+            print('Removing {} from the cache.'.format(name))
+            shutil.rmtree(os.path.join(self.cache_dir, name))
+            total_size -= size
+
+
+def get_data_cached(cache, dataset, data_path, max_doc_len, fixed_length=True, num_workers=None, tokenizer='nltk',
+                    rebuild=False):
+    '''
+    Same as preprocess.get_data, but the output of each stage (tokenization and remapping to the local vocabulary) is
+    cached, and only the stages whose inputs changed are run again.
+
+    Args:
+        cache (PreprocessingCache): The cache.
+        dataset (str): Data to use, 'imdb', 'amazon', or 'wikipedia'
+        data_path (str): Path to the directory containing the data.
+        max_doc_len (int): Maximum length of input, if using CNN-pad
+        fixed_length (bool): True if using CNN-pad
+        num_workers (int): Number of tokenization processes. None uses all the cores.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'. Not used for IMDB.
+        rebuild (bool): If True, run every stage and overwrite the cached outputs.
+
+    Returns:
+        data_key (str): The key of the output, which the keys of later stages are derived from.
+        The outputs of preprocess.get_data.
+    '''
+
+    if dataset not in DATASET_FILES:
+        raise ValueError('Unknown dataset \'{}\'.'.format(dataset))
+
+    # Documents are only truncated when tokenizing for CNN-pad, and IMDB doesn't use the tokenizer option.
+    tokenize_params = {
+        'dataset': dataset,
+        'fixed_length': fixed_length,
+        'max_doc_len': max_doc_len if fixed_length else None,
+        'tokenizer': [tokenizer, TOKENIZER_VERSION] if dataset != 'imdb' else None,
+        'version': PREPROCESS_VERSION,
+        'files': file_fingerprints(data_path, [WORD2VEC_FILE] + DATASET_FILES[dataset]),
+    }
+    tokenize_key = cache.key('tokenize', tokenize_params)
+    remap_params = {'tokenize': tokenize_key, 'version': PREPROCESS_VERSION}
+    remap_key = cache.key('remap', remap_params)
+
+    remapped = None if rebuild else cache.get(remap_key)
+    if remapped is None:
+        tokenized = None if rebuild else cache.get(tokenize_key)
+        if tokenized is None:
+            word_vectors, train_data_indices, train_labels, test_data_indices, test_labels = read_dataset(
+                dataset, data_path, max_doc_len, fixed_length, num_workers, tokenizer)
+            # Wikipedia adds random vectors for its frequent words that aren't in word2vec. Only those are cached.
+            num_word2vec = len(load_word2vec(data_path)[0])
+            tokenized = {'train_data_indices': train_data_indices, 'train_labels': train_labels,
+                         'test_data_indices': test_data_indices, 'test_labels': test_labels,
+                         'extra_vectors': np.asarray(word_vectors[num_word2vec:])}
+            cache.put(tokenize_key, tokenized, tokenize_params)
+        else:
+            word_vectors = load_word2vec(data_path)[0]
+            if len(tokenized['extra_vectors']):
+                word_vectors = np.vstack((word_vectors, tokenized['extra_vectors']))
+
+        input_embeddings, (train_data_indices, test_data_indices) = remap_to_local_vocab(
+            word_vectors, [tokenized['train_data_indices'], tokenized['test_data_indices']])
+        remapped = {'input_embeddings': input_embeddings, 'train_data_indices': train_data_indices,
+                    'train_labels': tokenized['train_labels'], 'test_data_indices': test_data_indices,
+                    'test_labels': tokenized['test_labels']}
+        cache.put(remap_key, remapped, remap_params)
+
+    return remap_key, remapped['input_embeddings'], remapped['train_data_indices'], remapped['train_labels'], \
+        remapped['test_data_indices'], remapped['test_labels']
+
+
+def get_sup_data_cached(cache, data_key, train_data_indices, test_data_indices, train_labels, test_labels,
+                        unlabeled_class, split_class, fixed_length, max_doc_len, num_classes, zero_vector_index,
+                        rebuild=False):
+    '''
+    Same as util.get_sup_data, but the filtered and padded output is cached.
+
+    Args:
+        cache (PreprocessingCache): The cache.
+        data_key (str): The key of the data, from get_data_cached.
+        rebuild (bool): If True, recompute the output and overwrite the cached one.
+        The other arguments are the same as for util.get_sup_data.
+
+    Returns:
+        The outputs of util.get_sup_data.
+    '''
+
+    pad_params = {
+        'data': data_key,
+        'unlabeled_class': unlabeled_class,
+        'split_class': split_class,
+        'fixed_length': fixed_length,
+        'max_doc_len': max_doc_len if fixed_length else None,
+        'num_classes': num_classes,
+        'zero_vector_index': zero_vector_index,
+        'version': PREPROCESS_VERSION,
+    }
+    pad_key = cache.key('pad', pad_params)
+
+    padded = None if rebuild else cache.get(pad_key)
+    if padded is None:
+        train_data_indices_sup, test_data_indices_sup, train_labels_sup, test_labels_sup = get_sup_data(
+            train_data_indices, test_data_indices, train_labels, test_labels, unlabeled_class, split_class,
+            fixed_length, max_doc_len, num_classes, zero_vector_index)
+        padded = {'train_data_indices_sup': train_data_indices_sup, 'test_data_indices_sup': test_data_indices_sup,
+                  'train_labels_sup': train_labels_sup, 'test_labels_sup': test_labels_sup}
+        cache.put(pad_key, padded, pad_params)
+
+    return padded['train_data_indices_sup'], padded['test_data_indices_sup'], padded['train_labels_sup'], \
+        padded['test_labels_sup']
@@ -1,11 +1,10 @@
 import os
 import numpy as np
 from numpy.random import RandomState
-from train_GBW import encode_text
 
-def load_data(cnn_model, word_to_index, name, loc='/home/shunan/Code/SentEval/data/downstream', seed=1234):
+def load_data(encoder, name, loc='/home/shunan/Code/SentEval/data/downstream', seed=1234):
     """
-    Load one of MR, CR, SUBJ or MPQA
+    Load one of MR, CR, SUBJ or MPQA, and embed the sentences with encoder, a DocumentEncoder
     """
     z = {}
     if name == 'MR':
@@ -22,12 +21,8 @@ def load_data(cnn_model, word_to_index, name, loc='/home/shunan/Code/SentEval/da
     z['text'] = text
     z['labels'] = labels
     print 'Computing the encodings'
-    features = []
-    for sen in text:
-        vec = encode_text(cnn_model['sess'], cnn_model['model_output'], cnn_model['placeholders'][0],
-                               cnn_model['placeholders'][2], cnn_model['placeholders'][1], word_to_index, sen)
-        features.append(vec)
-    return z, np.array(features)
+    features = encoder.encode_batch(text)
+    return z, features
 
 
 def load_rt(loc):
@@ -0,0 +1,193 @@
+import argparse
+import cPickle
+import glob
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from models.CNNEmbed import CNNEmbed
+from models.CNNEmbed1D import CNNEmbed1D
+from models.optimizers import OPTIMIZERS, get_train_op
+from convert_checkpoint import fold_batch_norm, read_checkpoint
+from export_model import DOC_MASK_NAME, INDICES_NAME, OUTPUT_NAME, build_inference_graph
+from document_encoder import DocumentEncoder
+from tokenizer import TOKENIZERS
+from train_GBW import ZERO_IND, sample_contexts
+from util import BatchPrefetcher, RaggedArray, RAGGED_TOKENS_SUFFIX
+
+
+def time_model(sess, model_output, feed_dicts):
+    """
+    Return the time a model takes to embed a list of batches, in seconds.
+    """
+
+    # The first run includes the graph setup.
+    sess.run(model_output, feed_dicts[0])
+    start = time.time()
+    for feed_dict in feed_dicts:
+        sess.run(model_output, feed_dict)
+    return max(time.time() - start, 1e-6)
+
+
+def main(args):
+
+    context_len = args.context_len
+    batch_size = args.batch_size
+    keep_prob = args.dropout_keep_prob
+    max_doc_len = 50
+    embed_dim = 300
+
+    with open(os.path.join(args.cache_dir, 'word_to_index.pkl'), 'r') as f:
+        word_to_index = cPickle.load(f)
+    indices_files = [fn[:-len(RAGGED_TOKENS_SUFFIX)] for fn in
+                     glob.glob(os.path.join(args.data_dir, 'gbw/tokenized/*' + RAGGED_TOKENS_SUFFIX))]
+
+    # The teacher runs as a frozen graph with its batch norms folded, see export_model.py.
+    teacher_variables = read_checkpoint(args.teacher_checkpoint)
+    teacher_graph_def = build_inference_graph(fold_batch_norm(teacher_variables), args.teacher_num_residual)
+
+    ###########################################Distillation Graph#########################################
+    distill_graph = tf.Graph()
+    with distill_graph.as_default(), tf.device("/gpu:0"):
+        indices_data_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, None])
+        # 1 for words and 0 for padding. Only fed when embedding padded batches of documents with different lengths.
+        doc_mask_placeholder = tf.placeholder_with_default(tf.ones_like(indices_data_placeholder, dtype=tf.float32),
+                                                           shape=[None, None], name='doc_mask')
+        teacher_output, = tf.import_graph_def(
+            teacher_graph_def, input_map={INDICES_NAME + ':0': indices_data_placeholder,
+                                          DOC_MASK_NAME + ':0': doc_mask_placeholder},
+            return_elements=[OUTPUT_NAME + ':0'], name='teacher')
+
+        # The student starts from the teacher's word embeddings.
+        embedding = tf.get_variable("embedding", teacher_variables['embedding'].shape, dtype=tf.float32,
+                                    trainable=True)
+        inputs = tf.gather(embedding, indices_data_placeholder)
+        if args.conv1d:
+            model_class = CNNEmbed1D
+        else:
+            model_class = CNNEmbed
+            inputs = tf.transpose(tf.expand_dims(inputs, 3), [0, 2, 1, 3])
+
+        keep_prob_placeholder = tf.placeholder(dtype=tf.float32, name='dropout_rate')
+        is_training_placeholder = tf.placeholder(dtype=tf.bool, name='training_boolean')
+
+        # build the student, without target embeddings since it learns from the teacher's embeddings.
+        _docCNN = model_class(inputs, None, None, is_training_placeholder, keep_prob_placeholder, max_doc_len,
+                              embed_dim, args.num_layers, args.num_filters, args.num_residual, args.top_k,
+                              args.filter_size, args.l2_coeff, mask=doc_mask_placeholder)
+        loss = _docCNN.distillation_loss(teacher_output, args.loss)
+        model_output = tf.reshape(_docCNN.res, [-1, embed_dim])
+
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        with tf.control_dependencies(update_ops):
+            train_op = get_train_op(loss, args.learning_rate, args.optimizer)
+
+        session_conf = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
+        sess = tf.Session(config=session_conf)
+        sess.run(tf.global_variables_initializer())
+        embedding.load(teacher_variables['embedding'], sess)
+        saver = tf.train.Saver()
+
+    ###########################################Training######################################
+    iter = 0
+    while iter < args.max_iter:
+        np.random.shuffle(indices_files)
+        for file_num, tokenized_file in enumerate(indices_files):
+            train_indices = RaggedArray.load(tokenized_file)
+            train_order = np.random.permutation(len(train_indices))
+
+            # Contexts of random lengths, as in train_GBW.py. Only the contexts are needed, the targets are the
+            # teacher's embeddings.
+            super_batches = ((train_order[ind:ind + args.super_batch_size], np.random.randint(context_len, max_doc_len))
+                             for ind in range(0, len(train_indices), args.super_batch_size))
+            prefetcher = BatchPrefetcher(lambda task: sample_contexts(train_indices, task[0], task[1])[0],
+                                         super_batches, args.prefetch_workers, args.prefetch_depth)
+
+            losses = []
+            for all_data in prefetcher:
+                for j in range(0, len(all_data), batch_size):
+                    feed_dict = {indices_data_placeholder: all_data[j:j + batch_size], keep_prob_placeholder: keep_prob,
+                                 is_training_placeholder: True}
+                    _, loss_out = sess.run([train_op, loss], feed_dict)
+                    losses.append(loss_out)
+
+            print('Epoch: {}, file: {}, distillation loss: {}'.format(iter, file_num + 1, np.mean(losses)))
+            saver.save(sess, os.path.join(args.checkpoint_dir, 'gbw_student_latest'))
+
+        print('Completed one epoch.')
+        saver.save(sess, os.path.join(args.checkpoint_dir, 'gbw_student'), global_step=iter)
+        iter += 1
+
+    ###########################################Evaluation######################################
+    # Speed of both models on batches of contexts of the same length.
+    train_indices = RaggedArray.load(indices_files[0])
+    contexts = sample_contexts(train_indices, np.arange(len(train_indices)), args.timing_len)[0][:20 * batch_size]
+    feed_dicts = [{indices_data_placeholder: contexts[j:j + batch_size], keep_prob_placeholder: 1.,
+                   is_training_placeholder: False} for j in range(0, len(contexts), batch_size)]
+    teacher_time = time_model(sess, teacher_output, feed_dicts)
+    student_time = time_model(sess, model_output, feed_dicts)
+    print('Documents per second: {:.1f} for the teacher, {:.1f} for the student ({:.2f}x)'.format(
+        len(contexts) / teacher_time, len(contexts) / student_time, teacher_time / student_time))
+
+    if args.downstream:
+        from classification_exps import perform_exp
+        teacher_encoder = DocumentEncoder(sess, teacher_output, indices_data_placeholder, None, None,
+                                          doc_mask_placeholder, ZERO_IND, word_to_index, args.tokenizer)
+        student_encoder = DocumentEncoder(sess, model_output, indices_data_placeholder, keep_prob_placeholder,
+                                          is_training_placeholder, doc_mask_placeholder, ZERO_IND, word_to_index,
+                                          args.tokenizer)
+        teacher_accuracies = perform_exp(teacher_encoder, ['TREC', 'MR'])
+        student_accuracies = perform_exp(student_encoder, ['TREC', 'MR'])
+        for exp in ['TREC', 'MR']:
+            print('{} accuracy: {:.4f} for the teacher, {:.4f} for the student ({:+.4f})'.format(
+                exp, teacher_accuracies[exp], student_accuracies[exp],
+                student_accuracies[exp] - teacher_accuracies[exp]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Distill a trained CNN embedding model into a smaller one, trained '
+                                                 'to reproduce its embeddings.')
+    parser.add_argument('--teacher-checkpoint', type=str, default=os.path.join('./latest_model_gbw',
+                                                                                'gbw_model_latest'),
+                        help='Prefix of the checkpoint of the teacher.')
+    parser.add_argument('--teacher-num-residual', type=int, default=1,
+                        help='Number of layers to skip in residual connections, as the teacher was trained with.')
+    parser.add_argument('--loss', type=str, default='mse', choices=['mse', 'cosine', 'both'],
+                        help='Distance between the student and teacher embeddings.')
+    parser.add_argument('--context-len', default=5, type=int, help='The size of the minimum context.')
+    parser.add_argument('--batch-size', default=100, type=int, help='Batch size.')
+    parser.add_argument('--super-batch-size', default=1000, type=int,
+                        help='Number of documents sampled with the same context length.')
+    parser.add_argument('--num-filters', type=int, default=900, help='Number of convolutional filters of the student.')
+    parser.add_argument('--filter-size', type=int, default=5, help='The size of the convolutional filters.')
+    parser.add_argument('--num-layers', type=int, default=4,
+                        help='Number of layers of the student, including the last fully-connected layer.')
+    parser.add_argument('--num-residual', type=int, default=1, help='Number of layers to skip in residual connections.')
+    parser.add_argument('--top-k', type=int, default=3, help='The value of k when performing k-max pooling')
+    parser.add_argument('--conv1d', action='store_true', help='Use CNNEmbed1D for the student, instead of CNNEmbed.')
+    parser.add_argument('--dropout-keep-prob', type=float, default=0.8, help='The dropout keep prob.')
+    parser.add_argument('--l2-coeff', type=float, default=0., help='The weight decay coefficient (l2).')
+    parser.add_argument('--optimizer', type=str, default='lazy_adam', choices=OPTIMIZERS,
+                        help='\'lazy_adam\' only updates the rows of the word embeddings used by the batch, and their '
+                             'Adam moments. \'adam\' updates the whole embedding matrix on every step.')
+    parser.add_argument('--learning-rate', type=float, default=0.0003, help='The learning rate.')
+    parser.add_argument('--max-iter', type=int, default=1, help='Number of passes over the training files.')
+    parser.add_argument('--cache-dir', type=str, default='./gbw_cache',
+                        help='The directory containing the saved pre-processed and embedding files')
+    parser.add_argument('--data-dir', type=str, default='/home/shunan/Data/', help='Directory containing the data.')
+    parser.add_argument('--checkpoint-dir', type=str, default='./latest_student_gbw/',
+                        help='Checkpoints directory of the student.')
+    parser.add_argument('--tokenizer', type=str, default='nltk', choices=TOKENIZERS,
+                        help='The tokenizer used to encode the classification data, \'nltk\' or \'fast\'.')
+    parser.add_argument('--timing-len', type=int, default=20,
+                        help='Length of the contexts used to compare the speed of the teacher and the student.')
+    parser.add_argument('--downstream', action='store_true',
+                        help='After training, compare the TREC and MR accuracies of the teacher and the student.')
+    parser.add_argument('--prefetch-depth', type=int, default=4,
+                        help='Number of super batches to prepare ahead of the training steps.')
+    parser.add_argument('--prefetch-workers', type=int, default=1,
+                        help='Number of background threads preparing super batches.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,170 @@
+import numpy as np
+from tokenizer import get_tokenizer
+from util import RaggedArray, pad_batch
+
+
+def text_to_indices(text, word_to_index, zero_ind, tokenizer='nltk', doc_len=None, min_len=5):
+    """
+    Tokenize a sentence and convert it to indices, mapping unknown words to <unk>.
+
+    Args:
+        text (str): The sentence.
+        word_to_index (dict): Mapping from lower-cased words to their index in the embedding matrix.
+        zero_ind (int): Index to the zero vector, in the embedding matrix.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'.
+        doc_len (int): If given, pad or truncate the sentence to that length.
+        min_len (int): Sentences shorter than this are padded with zeros at the beginning.
+
+    Returns:
+        line_tok (numpy.ndarray): The indices.
+    """
+
+    tokens = get_tokenizer(tokenizer).tokenize(text)
+    unk_ind = word_to_index['<unk>']
+    line_tok = [word_to_index.get(word.lower(), unk_ind) for word in tokens]
+
+    if len(line_tok) < min_len:
+        # pad with zeros
+        line_tok = [zero_ind] * (min_len - len(line_tok)) + line_tok
+
+    if doc_len is not None:
+        # pad or truncate to that length
+        if len(line_tok) > doc_len:
+            line_tok = line_tok[:doc_len]
+        elif len(line_tok) < doc_len:
+            line_tok = [zero_ind] * (doc_len - len(line_tok)) + line_tok
+
+    return np.array(line_tok, dtype=np.int32)
+
+
+class DocumentEncoder(object):
+    """
+    Embed many documents with a trained CNNEmbed model, a few large batches at a time instead of one sess.run per
+    document. The documents are sorted by length and cut into batches of similar lengths, each batch is padded to its
+    longest document and the padding is masked, so the embeddings are the same as running the documents one by one.
+    """
+
+    def __init__(self, sess, model_output, indices_data_placeholder, keep_prob_placeholder, is_training_placeholder,
+                 doc_mask_placeholder, zero_ind, word_to_index=None, tokenizer='nltk', batch_size=256,
+                 max_batch_tokens=200000, min_doc_len=1):
+        """
+        Args:
+            sess: Tensorflow session holding the trained model.
+            model_output: The document embeddings, tf.squeeze of CNNEmbed.res.
+            indices_data_placeholder: Placeholder for the (batch_size x doc_len) indices.
+            keep_prob_placeholder: The dropout keep prob placeholder, or None for a graph from export_model.py.
+            is_training_placeholder: The batch norm training placeholder, or None for a graph from export_model.py.
+            doc_mask_placeholder: The mask placeholder the model was built with, see CNNEmbed.
+            zero_ind (int): Index to the zero vector, in the embedding matrix.
+            word_to_index (dict): Vocabulary, only needed to encode raw text.
+            tokenizer (str): The tokenizer used for raw text, 'nltk' or 'fast'.
+            batch_size (int): Maximum number of documents per sess.run.
+            max_batch_tokens (int): Maximum of batch size times padded length, to bound the memory of long documents.
+            min_doc_len (int): Minimum padded length of a batch, e.g. k for k-max pooling. Documents shorter than that
+                should be left out, as pooling would pick masked positions.
+        """
+
+        self.sess = sess
+        self.model_output = model_output
+        self.indices_data_placeholder = indices_data_placeholder
+        self.keep_prob_placeholder = keep_prob_placeholder
+        self.is_training_placeholder = is_training_placeholder
+        self.doc_mask_placeholder = doc_mask_placeholder
+        self.zero_ind = zero_ind
+        self.word_to_index = word_to_index
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.min_doc_len = min_doc_len
+
+    def tokenize(self, texts):
+        """
+        Convert sentences to a RaggedArray of indices, the same way as train_GBW.encode_text.
+        """
+
+        return RaggedArray.from_lists([text_to_indices(text, self.word_to_index, self.zero_ind, self.tokenizer)
+                                       for text in texts])
+
+    def batches(self, lengths):
+        """
+        Yield the indices of the documents in each batch, grouping documents of similar lengths.
+        """
+
+        order = np.argsort(lengths, kind='mergesort')
+        start = 0
+        while start < len(order):
+            end = start + 1
+            # The order is by increasing length, so the last document of the batch is the longest.
+            while end < len(order) and end - start < self.batch_size and \
+                    (end - start + 1) * max(lengths[order[end]], self.min_doc_len) <= self.max_batch_tokens:
+                end += 1
+            yield order[start:end]
+            start = end
+
+    def encode_batch(self, docs):
+        """
+        Return the embeddings of a list of documents, in the same order.
+
+        Args:
+            docs: Raw sentences (a list of strings), documents as indices (a RaggedArray or a list of arrays), or a
+                padded 2D array of indices where every row is a document.
+
+        Returns:
+            embeddings (numpy.ndarray): (num_docs x embed_dim) array.
+        """
+
+        if isinstance(docs, np.ndarray) and docs.ndim == 2:
+            docs = RaggedArray(docs.ravel(), np.arange(len(docs) + 1, dtype=np.int64) * docs.shape[1])
+        elif not isinstance(docs, RaggedArray):
+            if len(docs) and isinstance(docs[0], basestring):
+                docs = self.tokenize(docs)
+            else:
+                docs = RaggedArray.from_lists(docs)
+
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        for batch_inds in self.batches(docs.lengths()):
+            padded, mask = pad_batch(docs[batch_inds], self.zero_ind, self.min_doc_len)
+            batch_embeddings = np.reshape(self.run_batch(padded, mask), [len(batch_inds), -1])
+
+            if not len(embeddings):
+                embeddings = np.zeros((len(docs), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+            embeddings[batch_inds] = batch_embeddings
+
+        return embeddings
+
+    def run_batch(self, padded, mask):
+        """
+        Return the embeddings of one padded batch.
+        """
+
+        feed_dict = {self.indices_data_placeholder: padded, self.doc_mask_placeholder: mask}
+        if self.keep_prob_placeholder is not None:
+            feed_dict[self.keep_prob_placeholder] = 1.
+        if self.is_training_placeholder is not None:
+            feed_dict[self.is_training_placeholder] = False
+        return self.sess.run(self.model_output, feed_dict)
+
+
+class NumpyDocumentEncoder(DocumentEncoder):
+    """
+    DocumentEncoder running a CNNEmbedNumpy model, without Tensorflow.
+    """
+
+    def __init__(self, model, zero_ind, word_to_index=None, tokenizer='nltk', batch_size=256, max_batch_tokens=200000,
+                 min_doc_len=1):
+        """
+        Args:
+            model (CNNEmbedNumpy): The model, e.g. CNNEmbedNumpy.load('cnn_embed_inference.npz').
+            The other arguments are the same as for DocumentEncoder.
+        """
+
+        super(NumpyDocumentEncoder, self).__init__(None, None, None, None, None, None, zero_ind, word_to_index,
+                                                   tokenizer, batch_size, max_batch_tokens, min_doc_len)
+        self.model = model
+
+    def run_batch(self, padded, mask):
+        """
+        Return the embeddings of one padded batch.
+        """
+
+        return self.model.embed(padded, mask)
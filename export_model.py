@@ -0,0 +1,309 @@
+import argparse
+import os
+import numpy as np
+import tensorflow as tf
+from models.CNNEmbed import CNNEmbed
+from models.CNNEmbed1D import CNNEmbed1D
+from models.CNNEmbedNumpy import CNNEmbedNumpy
+from convert_checkpoint import CONV_KERNEL_PATTERN, CONVERSIONS, fold_batch_norm, fuse_gating, read_checkpoint, \
+    to_conv1d
+from util import RaggedArray, pad_batch
+
+# Names of the inputs and output of the exported graph.
+INDICES_NAME = 'indices'
+DOC_MASK_NAME = 'doc_mask'
+OUTPUT_NAME = 'doc_embedding'
+# Largest difference between the NumPy and Tensorflow embeddings accepted by --check, with a float32 and a float16
+# first layer table.
+CHECK_TOLERANCE = 1e-3
+CHECK_TOLERANCE_FLOAT16 = 5e-2
+
+
+def model_config(variables):
+    '''
+    Recover the CNNEmbed hyper-parameters from the variables of a checkpoint. Only residual_skip can't be told from
+    the shapes.
+
+    Args:
+        variables (dict): numpy arrays by checkpoint name.
+
+    Returns:
+        config (dict): embed_dim, num_layers, num_filters, filter_size, k_max, gating, fused_gating, conv1d and ranks.
+    '''
+
+    kernels = dict()
+    for name, value in variables.items():
+        match = CONV_KERNEL_PATTERN.match(name)
+        if match is not None:
+            kernels[match.group(1)] = (match.group(2), value)
+    if 'conv_0' not in kernels:
+        raise ValueError('The checkpoint has no CNNEmbed convolutions.')
+
+    suffix, first_kernel = kernels['conv_0']
+    fused_gating = suffix.startswith('wv_')
+    conv1d = first_kernel.ndim == 3
+    # The kernels of factorized convolutions have rank output channels, but the biases always have the full number.
+    out_chans = variables['conv_0/biases_{}'.format(suffix)].shape[0]
+    num_filters = out_chans / 2 if fused_gating else out_chans
+    ranks = []
+    for i in range(len(kernels)):
+        layer_suffix, kernel = kernels['conv_{}'.format(i)]
+        factorized = 'conv_{}/weights_{}_proj'.format(i, layer_suffix) in variables
+        ranks.append(kernel.shape[-1] if factorized else None)
+    if 'conv_1' in kernels:
+        second_kernel = kernels['conv_1'][1]
+        filter_size = second_kernel.shape[0] if conv1d else second_kernel.shape[1]
+    else:
+        filter_size = 5
+
+    return {
+        'embed_dim': variables['embedding'].shape[1],
+        'num_layers': len(kernels) + 1,
+        'num_filters': num_filters,
+        'filter_size': filter_size,
+        # k-max pooling with k = 1 is the same as max pooling.
+        'k_max': variables['fully_connected/weights'].shape[0] / num_filters,
+        # Without gating, the variables are only suffixed by the layer number.
+        'gating': not suffix.isdigit(),
+        'fused_gating': fused_gating,
+        'conv1d': conv1d,
+        'ranks': ranks,
+    }
+
+
+def build_inference_graph(variables, residual_skip, batch_norm=False, causal=False):
+    '''
+    Build the inference-only graph of a model with folded batch norms, from token indices to document embeddings.
+    There is no dropout, batch norm, loss or target embeddings, and the variables are frozen into constants.
+
+    Args:
+        variables (dict): numpy arrays by checkpoint name, after fold_batch_norm unless batch_norm is True.
+        residual_skip (int): Number of layers to skip in residual connections, as the model was trained with.
+        batch_norm (bool): If True, the variables aren't folded and the graph keeps the batch norms, in inference
+            mode. Used as the reference in check_numpy_model.
+        causal (bool): If the model was trained with causal convolutions.
+
+    Returns:
+        graph_def (tf.GraphDef): The frozen graph.
+    '''
+
+    config = model_config(variables)
+    graph = tf.Graph()
+    with graph.as_default(), tf.device('/cpu:0'):
+        indices_data_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, None], name=INDICES_NAME)
+        doc_mask_placeholder = tf.placeholder_with_default(tf.ones_like(indices_data_placeholder, dtype=tf.float32),
+                                                           shape=[None, None], name=DOC_MASK_NAME)
+        embedding = tf.get_variable('embedding', variables['embedding'].shape, dtype=tf.float32)
+        inputs = tf.gather(embedding, indices_data_placeholder)
+        if config['conv1d']:
+            model_class = CNNEmbed1D
+        else:
+            model_class = CNNEmbed
+            inputs = tf.transpose(tf.expand_dims(inputs, 3), [0, 2, 1, 3])
+
+        # A max pooling model reads as k_max=1, which is the same, but causal models need k_max=0.
+        k_max = 0 if causal else config['k_max']
+        _docCNN = model_class(inputs, None, None, False, 1., None, config['embed_dim'], config['num_layers'],
+                              config['num_filters'], residual_skip, k_max, config['filter_size'], 0.,
+                              config['fused_gating'], mask=doc_mask_placeholder, batch_norm=batch_norm,
+                              ranks=config['ranks'], causal=causal)
+        tf.reshape(_docCNN.res, [-1, config['embed_dim']], name=OUTPUT_NAME)
+
+        with tf.Session() as sess:
+            for var in tf.global_variables():
+                var.load(variables[var.op.name], sess)
+            return tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [OUTPUT_NAME])
+
+
+def export_model(checkpoint_prefix, output_path, residual_skip, conversions=(), causal=False):
+    '''
+    Fold the batch norms of a trained checkpoint and write the frozen inference graph.
+
+    Args:
+        checkpoint_prefix (str): Prefix of the checkpoint, e.g. latest_model_gbw/gbw_model_latest.
+        output_path (str): Path of the binary GraphDef to write.
+        residual_skip (int): Number of layers to skip in residual connections, as the model was trained with.
+        conversions (list): Names of functions in convert_checkpoint.CONVERSIONS to apply before folding, e.g.
+            fuse_gating for checkpoints of the unfused model.
+        causal (bool): If the model was trained with causal convolutions.
+    '''
+
+    variables = read_checkpoint(checkpoint_prefix)
+    for conversion in conversions:
+        variables = CONVERSIONS[conversion](variables)
+    variables = fold_batch_norm(variables)
+
+    graph_def = build_inference_graph(variables, residual_skip, causal=causal)
+    output_dir, output_name = os.path.split(output_path)
+    tf.train.write_graph(graph_def, output_dir or '.', output_name, as_text=False)
+
+    print('Saved the inference graph to {}'.format(output_path))
+
+
+def load_inference_graph(path):
+    '''
+    Load a graph written by export_model.
+
+    Args:
+        path (str): Path of the binary GraphDef.
+
+    Returns:
+        sess: Tensorflow session holding the graph.
+        model_output: The (batch_size x embed_dim) document embeddings.
+        indices_data_placeholder: Placeholder for the (batch_size x doc_len) indices.
+        doc_mask_placeholder: The mask placeholder, 1 for words and 0 for padding. Defaults to all ones.
+    '''
+
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    return import_inference_graph(graph_def)
+
+
+def import_inference_graph(graph_def):
+    '''
+    Import a graph built by build_inference_graph in a new session. Returns the same as load_inference_graph.
+    '''
+
+    graph = tf.Graph()
+    with graph.as_default():
+        model_output, indices_data_placeholder, doc_mask_placeholder = tf.import_graph_def(
+            graph_def, return_elements=['{}:0'.format(name) for name in [OUTPUT_NAME, INDICES_NAME, DOC_MASK_NAME]],
+            name='')
+
+    return tf.Session(graph=graph), model_output, indices_data_placeholder, doc_mask_placeholder
+
+
+def export_numpy_model(checkpoint_prefix, output_path, residual_skip, causal=False):
+    '''
+    Write the weights of a trained checkpoint for CNNEmbedNumpy, as an uncompressed .npz file. The gating halves are
+    fused, the batch norms folded into the convolutions and the kernels converted to the CNNEmbed1D layout.
+
+    Args:
+        checkpoint_prefix (str): Prefix of the checkpoint, of CNNEmbed or CNNEmbed1D.
+        output_path (str): Path of the .npz file to write.
+        residual_skip (int): Number of layers to skip in residual connections, as the model was trained with.
+        causal (bool): If the model was trained with causal convolutions.
+    '''
+
+    variables = read_checkpoint(checkpoint_prefix)
+    config = model_config(variables)
+    if config['gating'] and not config['fused_gating']:
+        variables = fuse_gating(variables)
+    variables = fold_batch_norm(variables)
+    if not config['conv1d']:
+        variables = to_conv1d(variables)
+
+    weights = dict()
+    for name, value in variables.items():
+        match = CONV_KERNEL_PATTERN.match(name)
+        if match is not None:
+            scope, suffix = match.groups()
+            weights['{}/weights'.format(scope)] = value
+            weights['{}/biases'.format(scope)] = variables['{}/biases_{}'.format(scope, suffix)]
+            if '{}_proj'.format(name) in variables:
+                # (1 x rank x out_chans) after to_conv1d.
+                weights['{}/projection'.format(scope)] = variables['{}_proj'.format(name)][0]
+    for name in ['embedding', 'fully_connected/weights', 'fully_connected/biases']:
+        weights[name] = variables[name]
+    weights['residual_skip'] = np.array(residual_skip)
+    weights['k_max'] = np.array(config['k_max'])
+    weights['gating'] = np.array(config['gating'])
+    weights['causal'] = np.array(causal)
+
+    # Not compressed, so CNNEmbedNumpy.load can memory-map the arrays.
+    np.savez(output_path, **weights)
+
+    print('Saved the NumPy model to {}'.format(output_path))
+
+
+def check_numpy_model(checkpoint_prefix, npz_path, residual_skip, num_docs=64, max_doc_len=60, seed=1234,
+                      table_path=None, causal=False):
+    '''
+    Compare the embeddings of CNNEmbedNumpy to those of the Tensorflow model with batch norm, on a padded batch of
+    random documents of different lengths.
+
+    Args:
+        checkpoint_prefix (str): Prefix of the checkpoint the .npz file was exported from.
+        npz_path (str): Path of the .npz file.
+        residual_skip (int): Number of layers to skip in residual connections, as the model was trained with.
+        num_docs (int): Number of random documents.
+        max_doc_len (int): Maximum length of the random documents.
+        seed (int): Random seed.
+        table_path (str): Optional first layer table of the NumPy model, see CNNEmbedNumpy.build_first_layer_table.
+        causal (bool): If the model was trained with causal convolutions.
+
+    Returns:
+        max_diff (float): Largest absolute difference between the embeddings.
+    '''
+
+    variables = read_checkpoint(checkpoint_prefix)
+    config = model_config(variables)
+    sess, model_output, indices_data_placeholder, doc_mask_placeholder = import_inference_graph(
+        build_inference_graph(variables, residual_skip, batch_norm=True, causal=causal))
+    numpy_model = CNNEmbedNumpy.load(npz_path, table_path=table_path)
+
+    # The last row of the embedding matrix is the zero vector used for padding.
+    zero_ind = len(variables['embedding']) - 1
+    min_doc_len = max(config['k_max'], 1)
+    rng = np.random.RandomState(seed)
+    docs = RaggedArray.from_lists([rng.randint(0, zero_ind, size=rng.randint(min_doc_len, max_doc_len + 1))
+                                   for _ in range(num_docs)])
+    padded, mask = pad_batch(docs, zero_ind, min_doc_len)
+
+    expected = sess.run(model_output, {indices_data_placeholder: padded, doc_mask_placeholder: mask})
+    max_diff = float(np.max(np.abs(numpy_model.embed(padded, mask) - expected)))
+    print('Largest difference between the NumPy and Tensorflow embeddings: {}'.format(max_diff))
+    return max_diff
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export a trained CNNEmbed checkpoint as a frozen inference graph, '
+                                                 'with the batch norms folded into the convolutions.')
+    parser.add_argument('--checkpoint', type=str, default=os.path.join('./latest_model_gbw', 'gbw_model_latest'),
+                        help='Prefix of the checkpoint to export.')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Path of the exported graph or .npz file. Defaults to ./cnn_embed_inference.pb or .npz.')
+    parser.add_argument('--format', type=str, default='graph', choices=['graph', 'npz'],
+                        help='\'graph\' writes a frozen Tensorflow graph, \'npz\' the weights for CNNEmbedNumpy.')
+    parser.add_argument('--first-layer-table', type=str, default=None,
+                        help='With --format=npz, also precompute the first layer for every word and save it to this '
+                             '.npy file, to load with CNNEmbedNumpy.load(table_path=...).')
+    parser.add_argument('--table-dtype', type=str, default='float16', choices=['float16', 'float32'],
+                        help='The dtype of the first layer table.')
+    parser.add_argument('--check', action='store_true',
+                        help='With --format=npz, compare the NumPy embeddings to the Tensorflow model after exporting, '
+                             'and exit with an error if they differ by more than --tolerance.')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='Largest difference accepted by --check. Defaults to {}, or {} with a float16 first layer '
+                             'table.'.format(CHECK_TOLERANCE, CHECK_TOLERANCE_FLOAT16))
+    parser.add_argument('--num-residual', type=int, default=1,
+                        help='Number of layers to skip in residual connections, as the model was trained with.')
+    parser.add_argument('--causal', action='store_true',
+                        help='The model was trained with causal convolutions, e.g. train.py --num-targets.')
+    parser.add_argument('--conversion', type=str, action='append', default=[], choices=sorted(CONVERSIONS),
+                        help='Conversion to apply before folding the batch norms, see convert_checkpoint.py.')
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = './cnn_embed_inference.{}'.format('npz' if args.format == 'npz' else 'pb')
+
+    if args.format == 'npz':
+        export_numpy_model(args.checkpoint, args.output, args.num_residual, args.causal)
+        if args.first_layer_table is not None:
+            CNNEmbedNumpy.load(args.output).build_first_layer_table(args.first_layer_table, np.dtype(args.table_dtype))
+            print('Saved the first layer table to {}'.format(args.first_layer_table))
+        if args.check:
+            max_diff = check_numpy_model(args.checkpoint, args.output, args.num_residual,
+                                         table_path=args.first_layer_table, causal=args.causal)
+            tolerance = args.tolerance
+            if tolerance is None:
+                half_table = args.first_layer_table is not None and args.table_dtype == 'float16'
+                tolerance = CHECK_TOLERANCE_FLOAT16 if half_table else CHECK_TOLERANCE
+            if max_diff > tolerance:
+                print('The difference is above the tolerance of {}.'.format(tolerance))
+                raise SystemExit(1)
+    else:
+        export_model(args.checkpoint, args.output, args.num_residual, args.conversion, args.causal)
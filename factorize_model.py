@@ -0,0 +1,140 @@
+import argparse
+import numpy as np
+from convert_checkpoint import CONV_KERNEL_PATTERN, fuse_gating, read_checkpoint, save_checkpoint
+from export_model import model_config
+
+
+def choose_rank(singular_values, in_size, out_size, max_error=None, speedup=None):
+    '''
+    Pick the rank of a factorized kernel, from an error or a speedup budget.
+
+    Args:
+        singular_values (numpy.ndarray): The singular values of the kernel, in decreasing order.
+        in_size (int): Rows of the kernel matrix, filter_height * filter_width * in_chans.
+        out_size (int): Output channels.
+        max_error (float): Largest relative Frobenius error of the factorized kernel.
+        speedup (float): Ratio of the multiply-adds of the full kernel to those of the factorized pair.
+
+    Returns:
+        rank (int): The rank, or None if factorizing doesn't save anything.
+    '''
+
+    if max_error is not None:
+        # residual[r] is the squared error of keeping the r largest singular values.
+        residual = np.append(np.cumsum((singular_values ** 2)[::-1])[::-1], 0.)
+        rank = int(np.argmax(np.sqrt(residual / residual[0]) <= max_error))
+    else:
+        rank = int(in_size * out_size / (speedup * (in_size + out_size)))
+
+    rank = max(rank, 1)
+    if rank * (in_size + out_size) >= in_size * out_size:
+        return None
+    return rank
+
+
+def factorize_kernel(kernel, rank):
+    '''
+    Factorize a conv kernel into a convolution to rank channels and a 1x1 projection, with a truncated SVD.
+
+    Args:
+        kernel (numpy.ndarray): (filter_height x filter_width x in_chans x out_chans) kernel of CNNEmbed, or
+            (filter_width x in_chans x out_chans) kernel of CNNEmbed1D.
+        rank (int): The rank.
+
+    Returns:
+        first (numpy.ndarray): The kernel with rank output channels.
+        projection (numpy.ndarray): (1 x 1 x rank x out_chans), or (1 x rank x out_chans), projection.
+        error (float): Relative Frobenius error of the factorized kernel.
+    '''
+
+    out_chans = kernel.shape[-1]
+    u, s, vt = np.linalg.svd(kernel.reshape([-1, out_chans]).astype(np.float64), full_matrices=False)
+    # Split the singular values evenly between the two factors.
+    root = np.sqrt(s[:rank])
+    first = (u[:, :rank] * root).reshape(kernel.shape[:-1] + (rank,))
+    projection = (root[:, np.newaxis] * vt[:rank]).reshape((1,) * (kernel.ndim - 2) + (rank, out_chans))
+    error = np.sqrt(np.sum(s[rank:] ** 2) / np.sum(s ** 2))
+    return first.astype(kernel.dtype), projection.astype(kernel.dtype), error
+
+
+def factorize_variables(variables, max_error=None, speedup=None, first_layer=False):
+    '''
+    Factorize the conv kernels of a checkpoint, with the rank of each layer chosen from the budget. The optimizer slots
+    of the factorized kernels are reset to zeros, so the model can be fine-tuned from the checkpoint.
+
+    Args:
+        variables (dict): numpy arrays by checkpoint name. Gated models have to be fused, see fuse_gating.
+        max_error (float): Largest relative Frobenius error of each kernel.
+        speedup (float): Speedup of each factorized kernel. Used if max_error isn't given.
+        first_layer (bool): Also factorize the first convolution, over the word embeddings.
+
+    Returns:
+        factorized (dict): The converted numpy arrays by checkpoint name.
+        ranks (list): The rank of each convolution, None for the ones left as they are.
+    '''
+
+    factorized = dict(variables)
+    kernels = []
+    for name in variables:
+        match = CONV_KERNEL_PATTERN.match(name)
+        if match is not None:
+            kernels.append((int(match.group(1)[len('conv_'):]), name))
+    kernels.sort()
+
+    ranks = []
+    for i, name in kernels:
+        kernel = variables[name]
+        out_chans = kernel.shape[-1]
+        in_size = kernel.size / out_chans
+        if '{}_proj'.format(name) in variables:
+            # Already factorized.
+            ranks.append(out_chans)
+            continue
+        ranks.append(None)
+        if i == 0 and not first_layer:
+            continue
+
+        singular_values = np.linalg.svd(kernel.reshape([in_size, out_chans]), compute_uv=False)
+        rank = choose_rank(singular_values, in_size, out_chans, max_error, speedup)
+        if rank is None:
+            print('{}: kept at full rank'.format(name))
+            continue
+
+        first, projection, error = factorize_kernel(kernel, rank)
+        factorized[name] = first
+        factorized['{}_proj'.format(name)] = projection
+        for slot_name in variables:
+            if slot_name.startswith(name + '/'):
+                slot = slot_name[len(name) + 1:]
+                factorized[slot_name] = np.zeros_like(first)
+                factorized['{}_proj/{}'.format(name, slot)] = np.zeros_like(projection)
+        ranks[-1] = rank
+        print('{}: rank {}, {:.1f}x fewer multiply-adds, relative error {:.4f}'.format(
+            name, rank, in_size * out_chans / float(rank * (in_size + out_chans)), error))
+
+    return factorized, ranks
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Factorize the convolutions of a CNNEmbed checkpoint into low rank '
+                                                 'pairs of convolutions, with a truncated SVD.')
+    parser.add_argument('--input', type=str, required=True, help='Prefix of the checkpoint to factorize.')
+    parser.add_argument('--output', type=str, required=True, help='Prefix of the factorized checkpoint.')
+    parser.add_argument('--max-error', type=float, default=None,
+                        help='Pick the smallest rank of each kernel with at most this relative error.')
+    parser.add_argument('--speedup', type=float, default=2.,
+                        help='Pick the rank of each kernel for this speedup, if --max-error isn\'t given.')
+    parser.add_argument('--first-layer', action='store_true',
+                        help='Also factorize the first convolution, over the word embeddings.')
+    args = parser.parse_args()
+
+    variables = read_checkpoint(args.input)
+    config = model_config(variables)
+    if config['gating'] and not config['fused_gating']:
+        variables = fuse_gating(variables)
+    variables, ranks = factorize_variables(variables, args.max_error, args.speedup, args.first_layer)
+    save_checkpoint(variables, args.output)
+
+    print('Build the model with ranks={}, e.g. fine-tune it with train_GBW.py --ranks={}'.format(
+        ranks, ','.join(str(rank or 0) for rank in ranks)))
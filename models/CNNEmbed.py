@@ -2,15 +2,21 @@ import tensorflow as tf
 import numpy as np
 
 USE_GATING = True
+# Added to padded positions before max and k-max pooling, so they are never selected.
+MASK_PENALTY = 1e30
 
 class CNNEmbed(object):
     '''
     Class for building a document embedding model using CNNs.
     '''
 
+    # Axis of the channels in the layers, (batch_size x 1 x doc_len x num_filters).
+    CHANNEL_AXIS = 3
+
     def __init__(self, input_data, target_embeddings, target_labels, is_training, keep_prob=0.8, max_doc_len=400,
                  embed_dim=300, num_layers=4, num_filters=900, residual_skip=2, k_max=0, filter_size=5,
-                 weight_decay_coeff=0):
+                 weight_decay_coeff=0, fused_gating=True, mask=None, batch_norm=True, ranks=None, causal=False,
+                 target_positions=None, negative_embeddings=None, negative_mask=None, negative_weight=1.):
         '''
         Create a CNN for learning document embeddings.
 
@@ -28,8 +34,41 @@ class CNNEmbed(object):
             residual_skip (int): Number of layers to skip for res-net connections.
             k_max (int): The value of k when performing k-max pooling
             filter_size (int): The width of the conv filters
+            fused_gating (bool): If True, compute the value and gate halves of each gated layer with one convolution
+                and one batch norm over 2 * num_filters channels. Checkpoints of the unfused model can be converted
+                with convert_checkpoint.py.
+            mask: Optional (batch_size x doc_len) float tensor, 1 for words and 0 for padding. Padded positions are set
+                to zero after every layer, like the zero padding around a single document, and are never selected by
+                max or k-max pooling. At inference, a padded batch then gives the same embeddings as running each
+                document on its own. In training, the batch norm statistics still include the padded positions.
+            batch_norm (bool): If False, build the inference-only model without the dropout and batch norm after each
+                convolution. Its weights are a checkpoint with the batch norms folded into the convolutions, see
+                export_model.py.
+            ranks (list): Optional rank of each convolution, None or 0 for a full rank one. A convolution of rank r is
+                a convolution to r channels followed by a 1x1 convolution to the output channels, with the kernels
+                weights_{name} and weights_{name}_proj. See factorize_model.py.
+            causal (bool): If True, the convolutions are only padded on the left, so the output at a position only
+                depends on the words up to it. prefix_res then holds the embedding of every prefix of the documents,
+                from a cumulative max over the positions, and res is the embedding of the whole document. Needs max
+                pooling, k_max=0.
+            target_positions: Optional (batch_size x num_targets) int32 tensor, to train a causal model on many
+                targets per document. Each target is the prefix ending at that position, scored against its words in
+                target_embeddings, then (batch_size x num_targets x (num_pos_words + num_neg_words) x embed_dim),
+                with target_labels of (batch_size x num_targets x (num_pos_words + num_neg_words)).
+            negative_embeddings: Optional (pool_size x embed_dim) tensor of negative samples shared by the whole batch.
+                Every document is scored against all of them with one matmul, and target_embeddings and
+                target_labels then only hold the words to predict.
+            negative_mask: Optional (batch_size x pool_size) float tensor, 0 for the shared negatives that appear in
+                the document's context and 1 elsewhere.
+            negative_weight (float): Weight of the loss of each shared negative, e.g. num_neg_words / pool_size to
+                weigh the pool like num_neg_words private negatives.
         '''
 
+        if causal and k_max:
+            raise ValueError('Causal models only support max pooling, k_max should be 0.')
+        if target_positions is not None and not causal:
+            raise ValueError('Training on target_positions needs a causal model.')
+
         self.input_data = input_data
         self.target_embeddings = target_embeddings
         self.target_labels = target_labels
@@ -43,6 +82,16 @@ class CNNEmbed(object):
         self.k_max = k_max
         self.filter_size = filter_size
         self.weight_decay_coeff = weight_decay_coeff
+        self.fused_gating = fused_gating
+        self.mask = mask
+        self.batch_norm = batch_norm
+        self.ranks = ranks
+        self.causal = causal
+        self.target_positions = target_positions
+        self.negative_embeddings = negative_embeddings
+        self.negative_mask = negative_mask
+        self.negative_weight = negative_weight
+        self.prefix_res = None
 
         # Build the model.
         self.build_model()
@@ -52,7 +101,8 @@ class CNNEmbed(object):
         Build the CNN model.
         '''
 
-        prev_layer = self.input_data
+        layer_mask = self.layer_mask()
+        prev_layer = self.apply_mask(self.input_data, layer_mask)
         res_input = None
         std = np.sqrt(2. / (1 * 5 * self.num_filters))
         trainable_weights = tf.get_collection('trainable_weights')
@@ -60,33 +110,37 @@ class CNNEmbed(object):
         for i in range(self.num_layers - 1):
             with tf.variable_scope('conv_{}'.format(i)):
                 if i == 0:
-                    filter_height = self.embed_dim
+                    filter_height, in_chans = self.first_layer_shape()
                     filter_width = 3
-                    in_chans = 1
                 else:
                     filter_height = 1
                     filter_width = self.filter_size
                     in_chans = self.num_filters
 
                 std = np.sqrt(2. / (1 * 5 * self.num_filters))
-                if USE_GATING:
-                    conv_w = self.conv_op(prev_layer, filter_width, filter_height, in_chans, 'w_{}'.format(i), std)
-                    conv_w = tf.nn.dropout(conv_w, keep_prob=self.keep_prob)
-                    conv_w = tf.contrib.layers.batch_norm(conv_w, center=True, scale=True, is_training=self.is_training,
-                                                          scope='batch_norm_w_{}'.format(i))
-
-                    conv_v = self.conv_op(prev_layer, filter_width, filter_height, in_chans, 'v_{}'.format(i), std)
-                    conv_v = tf.nn.dropout(conv_v, keep_prob=self.keep_prob)
-                    conv_v = tf.contrib.layers.batch_norm(conv_v, center=True, scale=True, is_training=self.is_training,
-                                                          scope='batch_norm_v_{}'.format(i))
+                if USE_GATING and self.fused_gating:
+                    # One convolution and batch norm for both halves, which is the same as running them separately
+                    # since batch norm is per channel.
+                    conv_wv = self.conv_op(prev_layer, filter_width, filter_height, in_chans, 'wv_{}'.format(i), std,
+                                           2 * self.num_filters, self.rank(i))
+                    conv_wv = self.normalize(conv_wv, 'batch_norm_wv_{}'.format(i))
+                    conv_w, conv_v = tf.split(conv_wv, 2, axis=self.CHANNEL_AXIS)
+                    gated_conv = tf.multiply(conv_w, tf.sigmoid(conv_v))
+                elif USE_GATING:
+                    conv_w = self.conv_op(prev_layer, filter_width, filter_height, in_chans, 'w_{}'.format(i), std,
+                                          rank=self.rank(i))
+                    conv_w = self.normalize(conv_w, 'batch_norm_w_{}'.format(i))
+
+                    conv_v = self.conv_op(prev_layer, filter_width, filter_height, in_chans, 'v_{}'.format(i), std,
+                                          rank=self.rank(i))
+                    conv_v = self.normalize(conv_v, 'batch_norm_v_{}'.format(i))
                     # Adding the gating
                     gated_conv = tf.multiply(conv_w, tf.sigmoid(conv_v))
                 else:
                     # remove the gating for this experiment. For simplicity, still using the same variable name.
-                    conv = self.conv_op(prev_layer, filter_width, filter_height, in_chans, str(i), std)
-                    conv = tf.nn.dropout(conv, keep_prob=self.keep_prob)
-                    conv = tf.contrib.layers.batch_norm(conv, center=True, scale=True, is_training=self.is_training,
-                                                        scope='batch_norm_{}'.format(i))
+                    conv = self.conv_op(prev_layer, filter_width, filter_height, in_chans, str(i), std,
+                                        rank=self.rank(i))
+                    conv = self.normalize(conv, 'batch_norm_{}'.format(i))
                     gated_conv = tf.nn.relu(conv)
 
                 # Residual connections
@@ -98,14 +152,15 @@ class CNNEmbed(object):
                 elif self.residual_skip and (i + 1) % self.residual_skip == 0:
                     res_input = gated_conv
 
-                prev_layer = gated_conv
+                prev_layer = self.apply_mask(gated_conv, layer_mask)
 
 
         # Final fully connected block.
+        prev_layer = self.pooling_input(self.apply_pooling_mask(prev_layer, layer_mask))
         with tf.variable_scope('fully_connected'):
             if self.k_max:
-                # If we're doing k-max pooling
-                output = tf.nn.top_k(tf.transpose(prev_layer, [0, 1, 3, 2]), self.k_max)[0]
+                # If we're doing k-max pooling. top_k works on the last axis, so the positions are moved there.
+                output = tf.nn.top_k(tf.transpose(prev_layer, [0, 2, 1]), self.k_max)[0]
                 output = tf.reshape(output, [-1, self.k_max * self.num_filters])
                 weights = tf.get_variable(name='weights', shape=[self.k_max * self.num_filters, self.embed_dim],
                                           dtype=tf.float32,
@@ -114,19 +169,127 @@ class CNNEmbed(object):
                                          initializer=tf.constant_initializer(0.0))
                 self.res = tf.nn.bias_add(tf.matmul(output, weights), biases)
             else:
-                average_h = tf.squeeze(tf.reduce_max(prev_layer, axis=2), axis=1)
+                average_h = tf.reduce_max(prev_layer, axis=1)
                 weights = tf.get_variable(name='weights', shape=[self.num_filters, self.embed_dim], dtype=tf.float32,
                                           initializer=tf.random_normal_initializer(0.0, std))
                 biases = tf.get_variable(name='biases', shape=[self.embed_dim], dtype=tf.float32,
                                          initializer=tf.constant_initializer(0.0))
                 self.res = tf.nn.bias_add(tf.matmul(average_h, weights), biases)
+                if self.causal:
+                    self.prefix_res = self.prefix_embeddings(prev_layer, weights, biases)
 
             tf.add_to_collection('trainable_weights', weights)
             tf.add_to_collection('trainable_weights', biases)
-            self.res = tf.expand_dims(tf.expand_dims(self.res, 0), 0)
-            self.res = tf.transpose(self.res, perm=[2, 1, 0, 3])
+            self.res = self.output_layout(self.res)
+
+    def first_layer_shape(self):
+        '''
+        Return the filter height and the number of input channels of the first convolution. The embeddings are a
+        (embed_dim x doc_len) image with one channel.
+        '''
+
+        return self.embed_dim, 1
+
+    def pooling_input(self, layer):
+        '''
+        Return the last convolutional layer as a (batch_size x doc_len x num_filters) tensor, for pooling.
+        '''
 
-    def conv_op(self, fan_in, filter_width, filter_height, in_chans, name, std):
+        return tf.squeeze(layer, axis=1)
+
+    def output_layout(self, res):
+        '''
+        Return the (batch_size x embed_dim) embeddings reshaped to (batch_size x 1 x 1 x embed_dim), the layout of res.
+        '''
+
+        res = tf.expand_dims(tf.expand_dims(res, 0), 0)
+        return tf.transpose(res, perm=[2, 1, 0, 3])
+
+    def rank(self, i):
+        '''
+        Return the rank of convolution i, or None if it's full rank.
+        '''
+
+        if not self.ranks or i >= len(self.ranks):
+            return None
+        return self.ranks[i] or None
+
+    def cumulative_max(self, layer):
+        '''
+        Return the max over the positions up to each position of a (batch_size x doc_len x num_filters) layer. Each
+        step takes the max with a copy shifted by twice as many positions, so there are log2(doc_len) steps.
+        '''
+
+        doc_len = tf.shape(layer)[1]
+
+        def shifted_max(shift, cum_max):
+            shifted = tf.pad(cum_max, [[0, 0], [shift, 0], [0, 0]], constant_values=-MASK_PENALTY)[:, :doc_len]
+            return 2 * shift, tf.maximum(cum_max, shifted)
+
+        _, cum_max = tf.while_loop(lambda shift, _: shift < doc_len, shifted_max, [tf.constant(1), layer],
+                                   shape_invariants=[tf.TensorShape([]),
+                                                     tf.TensorShape([None, None, self.num_filters])])
+        return cum_max
+
+    def prefix_embeddings(self, layer, weights, biases):
+        '''
+        Return the (batch_size x doc_len x embed_dim) embeddings of the prefixes ending at every position, from the
+        (batch_size x doc_len x num_filters) last layer of a causal model and the fully connected weights.
+        '''
+
+        batch_size, doc_len = tf.shape(layer)[0], tf.shape(layer)[1]
+        pooled = tf.reshape(self.cumulative_max(layer), [-1, self.num_filters])
+        prefix_res = tf.nn.bias_add(tf.matmul(pooled, weights), biases)
+        return tf.reshape(prefix_res, [batch_size, doc_len, self.embed_dim])
+
+    def normalize(self, conv, scope):
+        '''
+        Apply dropout and batch norm to the output of a convolution, unless the model is built without batch norm.
+        '''
+
+        if not self.batch_norm:
+            return conv
+        conv = tf.nn.dropout(conv, keep_prob=self.keep_prob)
+        return tf.contrib.layers.batch_norm(conv, center=True, scale=True, is_training=self.is_training, scope=scope)
+
+    def layer_mask(self):
+        '''
+        Return the mask reshaped to broadcast against the layers, (batch_size x 1 x doc_len x 1), or None.
+        '''
+
+        if self.mask is None:
+            return None
+        return tf.expand_dims(tf.expand_dims(self.mask, 1), 3)
+
+    def apply_mask(self, layer, layer_mask):
+        '''
+        Set the padded positions of a layer to zero.
+        '''
+
+        if layer_mask is None:
+            return layer
+        return tf.multiply(layer, layer_mask)
+
+    def apply_pooling_mask(self, layer, layer_mask):
+        '''
+        Push the padded positions of the last layer far below any real value, so pooling never selects them.
+        '''
+
+        if layer_mask is None:
+            return layer
+        return layer - (1. - layer_mask) * MASK_PENALTY
+
+    def conv_padding(self, filter_width):
+        '''
+        Return the number of zeros to pad before and after the document in a convolution. Causal models pad all
+        filter_width - 1 of them before, so no position sees the words after it.
+        '''
+
+        if self.causal:
+            return [filter_width - 1, 0]
+        return [filter_width / 2, filter_width / 2]
+
+    def conv_op(self, fan_in, filter_width, filter_height, in_chans, name, std, out_chans=None, rank=None):
         '''
         Create a convolutional layer.
 
@@ -137,17 +300,22 @@ class CNNEmbed(object):
             in_chans (int): Number of input channels
             name (str): Name to use for the tensor
             std (float): Standard deviation used to initialize the tensor values.
+            out_chans (int): Number of output channels. Defaults to num_filters.
+            rank (int): If given, factorize the convolution through rank channels.
 
         Returns:
             An output tensor, after applying the convolution operation.
         '''
 
-        paddings = [[0, 0], [0, 0], [filter_width / 2, filter_width / 2], [0, 0]]
+        if out_chans is None:
+            out_chans = self.num_filters
+
+        paddings = [[0, 0], [0, 0], self.conv_padding(filter_width), [0, 0]]
         fan_in = tf.pad(fan_in, paddings, 'CONSTANT')
 
         kernel = tf.get_variable(
             name='weights_{}'.format(name),
-            shape=[filter_height, filter_width, in_chans, self.num_filters],
+            shape=[filter_height, filter_width, in_chans, rank or out_chans],
             initializer=tf.random_normal_initializer(0., std),
             dtype=tf.float32)
 
@@ -158,9 +326,18 @@ class CNNEmbed(object):
             padding='VALID',
             data_format='NHWC')
 
+        if rank:
+            projection = tf.get_variable(
+                name='weights_{}_proj'.format(name),
+                shape=[1, 1, rank, out_chans],
+                initializer=tf.random_normal_initializer(0., std),
+                dtype=tf.float32)
+            conv = tf.nn.conv2d(conv, projection, strides=[1, 1, 1, 1], padding='VALID', data_format='NHWC')
+            tf.add_to_collection('trainable_weights', projection)
+
         biases = tf.get_variable(
             name='biases_{}'.format(name),
-            shape=[self.num_filters],
+            shape=[out_chans],
             initializer=tf.constant_initializer(0.0, dtype=tf.float32),
             dtype=tf.float32)
 
@@ -173,11 +350,89 @@ class CNNEmbed(object):
         Return the sigmoid loss.
         '''
 
+        if self.target_positions is not None:
+            return self.multi_target_loss()
+
+        scores = self.target_scores()
+        losses = tf.nn.sigmoid_cross_entropy_with_logits(logits=scores, labels=self.target_labels)
+        doc_losses = tf.reduce_sum(losses, 1)
+        if self.negative_embeddings is not None:
+            doc_losses += self.shared_negatives_loss(tf.reshape(self.res, [-1, self.embed_dim]))
+        # Adding weight decay
+        wd_loss = tf.add_n([tf.nn.l2_loss(t) for t in tf.get_collection('trainable_weights')])
+        return tf.reduce_mean(doc_losses + self.weight_decay_coeff * wd_loss)
+
+    def target_scores(self):
+        '''
+        Return the (batch_size x (num_pos_words + num_neg_words)) scores of the target words.
+        '''
+
         cnn_output = tf.transpose(self.res, [0, 3, 2, 1])
         scores = tf.multiply(cnn_output, self.target_embeddings)
         scores = tf.reduce_sum(scores, 1)
-        scores = tf.squeeze(scores, axis=2)
+        return tf.squeeze(scores, axis=2)
+
+    def multi_target_loss(self):
+        '''
+        Return the sigmoid loss of the prefixes ending at target_positions, averaged over the targets of all documents.
+        '''
+
+        num_targets = tf.shape(self.target_positions)[1]
+        doc_inds = tf.tile(tf.expand_dims(tf.range(tf.shape(self.target_positions)[0]), 1), [1, num_targets])
+        prefixes = tf.gather_nd(self.prefix_res, tf.stack([doc_inds, self.target_positions], 2))
+        scores = tf.reduce_sum(tf.multiply(tf.expand_dims(prefixes, 2), self.target_embeddings), 3)
         losses = tf.nn.sigmoid_cross_entropy_with_logits(logits=scores, labels=self.target_labels)
+        target_losses = tf.reduce_sum(losses, 2)
+        if self.negative_embeddings is not None:
+            target_losses += self.shared_negatives_loss(prefixes)
+        # Adding weight decay
+        wd_loss = tf.add_n([tf.nn.l2_loss(t) for t in tf.get_collection('trainable_weights')])
+        return tf.reduce_mean(target_losses + self.weight_decay_coeff * wd_loss)
+
+    def shared_negatives_loss(self, embeddings):
+        '''
+        Return the weighted sigmoid loss of the shared negatives, summed over the pool.
+
+        Args:
+            embeddings: (batch_size x embed_dim), or (batch_size x num_targets x embed_dim), tensor of embeddings.
+
+        Returns:
+            A (batch_size) or (batch_size x num_targets) tensor.
+        '''
+
+        # One (num_embeddings x embed_dim) x (embed_dim x pool_size) matmul scores every embedding against the pool.
+        scores = tf.matmul(tf.reshape(embeddings, [-1, self.embed_dim]), self.negative_embeddings, transpose_b=True)
+        scores = tf.reshape(scores, tf.concat([tf.shape(embeddings)[:-1], [-1]], 0))
+        losses = tf.nn.sigmoid_cross_entropy_with_logits(logits=scores, labels=tf.zeros_like(scores))
+        if self.negative_mask is not None:
+            mask = self.negative_mask
+            if embeddings.get_shape().ndims == 3:
+                # The same mask for all the targets of a document.
+                mask = tf.expand_dims(mask, 1)
+            losses = tf.multiply(losses, mask)
+        return self.negative_weight * tf.reduce_sum(losses, -1)
+
+    def distillation_loss(self, teacher_embeddings, loss_type='mse'):
+        '''
+        Return the loss for training the model to reproduce the embeddings of a teacher model.
+
+        Args:
+            teacher_embeddings: (batch_size x embed_dim) tensor of the teacher's embeddings of the same documents.
+            loss_type (str): 'mse' for the mean squared error, 'cosine' for one minus the cosine similarity, or 'both'
+                for their sum.
+        '''
+
+        student_embeddings = tf.reshape(self.res, [-1, self.embed_dim])
+        losses = []
+        if loss_type in ['mse', 'both']:
+            losses.append(tf.reduce_mean(tf.squared_difference(student_embeddings, teacher_embeddings), 1))
+        if loss_type in ['cosine', 'both']:
+            student_unit = tf.nn.l2_normalize(student_embeddings, 1)
+            teacher_unit = tf.nn.l2_normalize(teacher_embeddings, 1)
+            losses.append(1. - tf.reduce_sum(student_unit * teacher_unit, 1))
+        if not losses:
+            raise ValueError('Unknown distillation loss \'{}\', should be mse, cosine or both.'.format(loss_type))
+
         # Adding weight decay
         wd_loss = tf.add_n([tf.nn.l2_loss(t) for t in tf.get_collection('trainable_weights')])
-        return tf.reduce_mean(tf.reduce_sum(losses, 1) + self.weight_decay_coeff * wd_loss)
+        return tf.reduce_mean(tf.add_n(losses) + self.weight_decay_coeff * wd_loss)
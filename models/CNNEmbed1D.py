@@ -0,0 +1,126 @@
+import tensorflow as tf
+from models.CNNEmbed import CNNEmbed
+
+
+class CNNEmbed1D(CNNEmbed):
+    '''
+    The CNNEmbed model built on 1D convolutions over (batch_size x doc_len x embed_dim) inputs.
+
+    CNNEmbed works on (batch_size x embed_dim x doc_len x 1) tensors and treats the first layer as an
+    (embed_dim x 3) 2D convolution, so the inputs and targets have to be expanded and transposed to that layout, and
+    the output transposed back. Here the gathered embeddings are used as they are, and the convolutions run over the
+    document length with the embedding (or filter) dimension as channels. The outputs are the same as CNNEmbed's,
+    given weights converted with convert_checkpoint.py --conversion to_conv1d. The variables have the same names.
+    '''
+
+    # Axis of the channels in the layers, (batch_size x doc_len x num_filters).
+    CHANNEL_AXIS = 2
+
+    def __init__(self, input_data, target_embeddings, target_labels, is_training, keep_prob=0.8, max_doc_len=400,
+                 embed_dim=300, num_layers=4, num_filters=900, residual_skip=2, k_max=0, filter_size=5,
+                 weight_decay_coeff=0, fused_gating=True, mask=None, batch_norm=True, ranks=None, causal=False,
+                 target_positions=None, negative_embeddings=None, negative_mask=None, negative_weight=1.):
+        '''
+        Create a CNN for learning document embeddings.
+
+        Args:
+            input_data: (batch_size x doc_len x embed_dim) tensor of word embeddings.
+            target_embeddings: (batch_size x (num_pos_words + num_neg_words) x embed_dim) tensor of target word
+                embeddings.
+            The other arguments are the same as for CNNEmbed.
+        '''
+
+        super(CNNEmbed1D, self).__init__(input_data, target_embeddings, target_labels, is_training, keep_prob,
+                                         max_doc_len, embed_dim, num_layers, num_filters, residual_skip, k_max,
+                                         filter_size, weight_decay_coeff, fused_gating, mask, batch_norm, ranks,
+                                         causal, target_positions, negative_embeddings, negative_mask,
+                                         negative_weight)
+
+    def first_layer_shape(self):
+        '''
+        Return the filter height, not used by conv_op, and the number of input channels of the first convolution. The
+        embedding dimension is the input channels.
+        '''
+
+        return 1, self.embed_dim
+
+    def pooling_input(self, layer):
+        '''
+        Return the last convolutional layer, which is already (batch_size x doc_len x num_filters).
+        '''
+
+        return layer
+
+    def output_layout(self, res):
+        '''
+        Return the (batch_size x embed_dim) embeddings as they are.
+        '''
+
+        return res
+
+    def layer_mask(self):
+        '''
+        Return the mask reshaped to broadcast against the layers, (batch_size x doc_len x 1), or None.
+        '''
+
+        if self.mask is None:
+            return None
+        return tf.expand_dims(self.mask, 2)
+
+    def conv_op(self, fan_in, filter_width, filter_height, in_chans, name, std, out_chans=None, rank=None):
+        '''
+        Create a 1D convolutional layer over the document length.
+
+        Args:
+            fan_in: (batch_size x doc_len x in_chans) input tensor to the convolutional operation.
+            filter_width (int): Width of the conv filter
+            filter_height (int): Not used, the embedding dimension is the input channels here.
+            in_chans (int): Number of input channels
+            name (str): Name to use for the tensor
+            std (float): Standard deviation used to initialize the tensor values.
+            out_chans (int): Number of output channels. Defaults to num_filters.
+            rank (int): If given, factorize the convolution through rank channels.
+
+        Returns:
+            An output tensor, after applying the convolution operation.
+        '''
+
+        if out_chans is None:
+            out_chans = self.num_filters
+
+        paddings = [[0, 0], self.conv_padding(filter_width), [0, 0]]
+        fan_in = tf.pad(fan_in, paddings, 'CONSTANT')
+
+        kernel = tf.get_variable(
+            name='weights_{}'.format(name),
+            shape=[filter_width, in_chans, rank or out_chans],
+            initializer=tf.random_normal_initializer(0., std),
+            dtype=tf.float32)
+
+        conv = tf.nn.conv1d(fan_in, kernel, stride=1, padding='VALID', data_format='NWC')
+
+        if rank:
+            projection = tf.get_variable(
+                name='weights_{}_proj'.format(name),
+                shape=[1, rank, out_chans],
+                initializer=tf.random_normal_initializer(0., std),
+                dtype=tf.float32)
+            conv = tf.nn.conv1d(conv, projection, stride=1, padding='VALID', data_format='NWC')
+            tf.add_to_collection('trainable_weights', projection)
+
+        biases = tf.get_variable(
+            name='biases_{}'.format(name),
+            shape=[out_chans],
+            initializer=tf.constant_initializer(0.0, dtype=tf.float32),
+            dtype=tf.float32)
+
+        tf.add_to_collection('trainable_weights', kernel)
+        tf.add_to_collection('trainable_weights', biases)
+        return tf.nn.bias_add(conv, biases)
+
+    def target_scores(self):
+        '''
+        Return the (batch_size x (num_pos_words + num_neg_words)) scores of the target words.
+        '''
+
+        return tf.reduce_sum(tf.multiply(tf.expand_dims(self.res, 1), self.target_embeddings), 2)
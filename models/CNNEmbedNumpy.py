@@ -0,0 +1,332 @@
+import numpy as np
+from util import load_npz
+
+# Added to padded positions before max and k-max pooling, as in CNNEmbed.
+MASK_PENALTY = 1e30
+
+
+class CNNEmbedNumpy(object):
+    '''
+    Inference-only CNNEmbed in NumPy, so a trained model can embed documents without TensorFlow.
+
+    The weights are exported from a checkpoint with export_model.py --format npz: the batch norms are folded into the
+    convolutions, the gating halves are fused and the kernels are in the CNNEmbed1D layout,
+    (filter_width x in_chans x out_chans). The layers run on (batch_size x doc_len x channels) arrays, and the outputs
+    match CNNEmbed with is_training=False and keep_prob=1.
+    '''
+
+    def __init__(self, weights):
+        '''
+        Args:
+            weights (dict): Arrays by name, as written by export_model.export_numpy_model: embedding,
+                conv_{i}/weights, conv_{i}/biases, fully_connected/weights, fully_connected/biases, and the scalars
+                residual_skip, k_max, gating and optionally causal. Factorized convolutions also have a
+                (rank x out_chans) conv_{i}/projection, applied after their (filter_width x in_chans x rank) kernel.
+        '''
+
+        self.embedding = weights['embedding']
+        self.residual_skip = int(weights['residual_skip'])
+        self.k_max = int(weights['k_max'])
+        self.gating = bool(weights['gating'])
+        self.causal = bool(weights['causal']) if 'causal' in weights else False
+
+        self.conv_weights = []
+        self.conv_biases = []
+        self.conv_projections = []
+        while 'conv_{}/weights'.format(len(self.conv_weights)) in weights:
+            i = len(self.conv_weights)
+            self.conv_weights.append(weights['conv_{}/weights'.format(i)])
+            self.conv_biases.append(weights['conv_{}/biases'.format(i)])
+            self.conv_projections.append(weights.get('conv_{}/projection'.format(i)))
+
+        self.fc_weights = weights['fully_connected/weights']
+        self.fc_biases = weights['fully_connected/biases']
+        self.embed_dim = self.fc_weights.shape[1]
+        # (vocab_size x filter_width x out_chans) projections of every word by every tap of the first layer, see
+        # build_first_layer_table.
+        self.first_layer_table = None
+        # Largest absolute input of every layer, only set while calibrating.
+        self.input_ranges = None
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', table_path=None):
+        '''
+        Load the weights from an uncompressed .npz file. By default they are memory-mapped, so loading is cheap and
+        only the rows of the embedding matrix that are used are read.
+
+        Args:
+            path (str): Path of the .npz file.
+            mmap_mode (str): Mode of the memory maps, or None to read everything.
+            table_path (str): Optional .npy file saved by build_first_layer_table, loaded with the same mmap_mode.
+        '''
+
+        model = cls(load_npz(path, mmap_mode))
+        if table_path is not None:
+            model.first_layer_table = np.load(table_path, mmap_mode=mmap_mode)
+        return model
+
+    def build_first_layer_table(self, path=None, dtype=np.float16, chunk_size=4096):
+        '''
+        Precompute the first layer for every word of the vocabulary. The embeddings are fixed at inference, so the
+        first convolution at position t is sum_j kernel[j] . embedding[word at t + j - left_padding], and
+        kernel[j] . embedding[word] can be looked up instead of computed. The table has
+        vocab_size x filter_width x out_chans entries, so it's much larger than the embedding matrix, and is best
+        stored in float16 and memory-mapped.
+
+        Args:
+            path (str): If given, the table is written to this .npy file and memory-mapped from it, and can be loaded
+                again with load(table_path=path).
+            dtype: The dtype of the table. The lookups are summed in float32.
+            chunk_size (int): Number of words projected at a time.
+        '''
+
+        kernel = self.float_kernel(0)
+        shape = (len(self.embedding), kernel.shape[0], len(self.conv_biases[0]))
+        if path is None:
+            table = np.zeros(shape, dtype=dtype)
+        else:
+            table = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+        for start in range(0, len(self.embedding), chunk_size):
+            words = np.asarray(self.embedding[start:start + chunk_size], dtype=np.float32)
+            projections = np.einsum('we,jec->wjc', words, kernel)
+            if self.conv_projections[0] is not None:
+                projections = np.dot(projections, self.conv_projections[0])
+            table[start:start + chunk_size] = projections
+
+        if path is not None:
+            table.flush()
+            del table
+            table = np.load(path, mmap_mode='r')
+        self.first_layer_table = table
+
+    def float_kernel(self, i):
+        '''
+        The float32 kernel of convolution i.
+        '''
+
+        return np.asarray(self.conv_weights[i], dtype=np.float32)
+
+    def first_layer(self, indices, layer_mask):
+        '''
+        The first convolution, from the lookup table, with one gather and add per filter position.
+        '''
+
+        filter_width = self.first_layer_table.shape[1]
+        batch_size, doc_len = indices.shape
+        output = np.zeros((batch_size, doc_len + 2 * (filter_width / 2), self.first_layer_table.shape[2]),
+                          dtype=np.float32)
+        for j in range(filter_width):
+            # The projection of the word at position t by tap j goes to the output at position t + left_padding - j.
+            projection = self.first_layer_table[indices, j]
+            if layer_mask is not None:
+                projection = projection * layer_mask
+            output[:, filter_width - 1 - j:filter_width - 1 - j + doc_len] += projection
+
+        start = filter_width - 1 - self.left_padding(filter_width)
+        output = output[:, start:start + doc_len]
+        output += self.conv_biases[0]
+        return output
+
+    def calibrate(self, embed_batches):
+        '''
+        Record the largest absolute value of the input of every convolution and of the final projection, over the
+        batches embedded by embed_batches, e.g. a NumpyDocumentEncoder.encode_batch call on a sample of documents.
+
+        Args:
+            embed_batches: Function without arguments that embeds the calibration documents with this model.
+
+        Returns:
+            input_ranges (numpy.ndarray): num_conv_layers + 1 values, the last one for the final projection.
+        '''
+
+        self.input_ranges = np.zeros(len(self.conv_weights) + 1, dtype=np.float32)
+        try:
+            embed_batches()
+            return self.input_ranges
+        finally:
+            self.input_ranges = None
+
+    def record_range(self, i, layer):
+        '''
+        Update the range of the input of layer i, when calibrating.
+        '''
+
+        if self.input_ranges is not None and layer.size:
+            self.input_ranges[i] = max(self.input_ranges[i], np.max(np.abs(layer)))
+
+    def conv_layer(self, layer, i):
+        '''
+        Convolution i of the model.
+        '''
+
+        self.record_range(i, layer)
+        if self.conv_projections[i] is None:
+            return self.conv(layer, self.conv_weights[i], self.conv_biases[i])
+        return np.dot(self.conv(layer, self.conv_weights[i]), self.conv_projections[i]) + self.conv_biases[i]
+
+    def projection(self, output):
+        '''
+        The final fully connected projection, from the pooled filters to the embedding.
+        '''
+
+        self.record_range(len(self.conv_weights), output)
+        return np.dot(output, self.fc_weights) + self.fc_biases
+
+    def left_padding(self, filter_width):
+        '''
+        Number of zeros before the document in a convolution, filter_width - 1 for causal models, as in CNNEmbed.
+        '''
+
+        return filter_width - 1 if self.causal else filter_width / 2
+
+    def conv(self, layer, kernel, biases=None):
+        '''
+        1D convolution over the document length, with zero padding to keep the length.
+
+        Args:
+            layer: (batch_size x doc_len x in_chans) array.
+            kernel: (filter_width x in_chans x out_chans) array.
+            biases: (out_chans) array, or None.
+
+        Returns:
+            (batch_size x doc_len x out_chans) array.
+        '''
+
+        filter_width = kernel.shape[0]
+        batch_size, doc_len, in_chans = layer.shape
+        padded = np.zeros((batch_size, doc_len + 2 * (filter_width / 2), in_chans), dtype=np.float32)
+        left = self.left_padding(filter_width)
+        padded[:, left:left + doc_len] = layer
+
+        # One matmul per filter position, instead of building the (doc_len x filter_width * in_chans) patches.
+        output = np.dot(padded[:, :doc_len], kernel[0])
+        for j in range(1, filter_width):
+            output += np.dot(padded[:, j:j + doc_len], kernel[j])
+        if biases is not None:
+            output += biases
+        return output
+
+    def embed(self, indices, mask=None):
+        '''
+        Embed a padded batch of documents.
+
+        Args:
+            indices: (batch_size x doc_len) array of indices into the embedding matrix.
+            mask: Optional (batch_size x doc_len) array, 1 for words and 0 for padding, see CNNEmbed.
+
+        Returns:
+            (batch_size x embed_dim) float32 array of document embeddings.
+        '''
+
+        layer_mask = None if mask is None else np.asarray(mask, dtype=np.float32)[:, :, np.newaxis]
+        if self.first_layer_table is None:
+            prev_layer = np.asarray(self.embedding[indices], dtype=np.float32)
+            if layer_mask is not None:
+                prev_layer = prev_layer * layer_mask
+        res_input = None
+
+        for i in range(len(self.conv_weights)):
+            if i == 0 and self.first_layer_table is not None:
+                # The word embeddings aren't needed, the first layer is looked up from the indices.
+                conv = self.first_layer(indices, layer_mask)
+            else:
+                conv = self.conv_layer(prev_layer, i)
+            if self.gating:
+                conv_w, conv_v = np.split(conv, 2, axis=2)
+                # sigmoid(x) = (1 + tanh(x / 2)) / 2, which doesn't overflow.
+                gated_conv = conv_w * (0.5 + 0.5 * np.tanh(0.5 * conv_v))
+            else:
+                gated_conv = np.maximum(conv, 0.)
+
+            # Residual connections
+            if self.residual_skip and (i + 1) % self.residual_skip == 0 and res_input is not None:
+                gated_conv = (gated_conv + res_input) * np.float32(np.sqrt(0.5))
+
+            if self.residual_skip and i == 0:
+                res_input = gated_conv
+            elif self.residual_skip and (i + 1) % self.residual_skip == 0:
+                res_input = gated_conv
+
+            prev_layer = gated_conv if layer_mask is None else gated_conv * layer_mask
+
+        if layer_mask is not None:
+            prev_layer = prev_layer - (1. - layer_mask) * np.float32(MASK_PENALTY)
+
+        if self.k_max:
+            # The k largest values of each filter, in decreasing order, as tf.nn.top_k.
+            doc_len = prev_layer.shape[1]
+            top_k = np.partition(prev_layer, doc_len - self.k_max, axis=1)[:, doc_len - self.k_max:]
+            top_k = np.sort(top_k, axis=1)[:, ::-1]
+            output = np.transpose(top_k, [0, 2, 1]).reshape([len(prev_layer), -1])
+        else:
+            output = np.max(prev_layer, axis=1)
+
+        return self.projection(output)
+
+
+class QuantizedCNNEmbedNumpy(CNNEmbedNumpy):
+    '''
+    CNNEmbedNumpy with int8 weights, written by quantize_model.py. The conv kernels and the final projection are
+    quantized symmetrically per output channel, and their inputs per layer, with scales calibrated on a sample of
+    documents. Each layer multiplies the quantized values and rescales the result,
+    (x_q . w_q) * input_scale * weight_scale. The embedding matrix, biases and first layer table stay in float.
+
+    This simulates int8 inference: NumPy has no int8 matrix product, and its integer products don't use BLAS, so the
+    quantized values are converted to float32 once when the model is created and multiplied in float32, which is exact
+    up to float32 rounding of the sums. The file is a quarter of the size, and the outputs are the ones an int8 kernel
+    would give, but the speed and the memory at inference are those of the float model.
+    '''
+
+    def __init__(self, weights):
+        '''
+        Args:
+            weights (dict): The arrays of CNNEmbedNumpy, with int8 conv_{i}/weights and fully_connected/weights, and
+                conv_{i}/weight_scales, conv_{i}/input_scale, fully_connected/weight_scales and
+                fully_connected/input_scale.
+        '''
+
+        super(QuantizedCNNEmbedNumpy, self).__init__(weights)
+        self.weight_scales = [weights['conv_{}/weight_scales'.format(i)] for i in range(len(self.conv_weights))]
+        self.weight_scales.append(weights['fully_connected/weight_scales'])
+        self.input_scales = [float(weights['conv_{}/input_scale'.format(i)]) for i in range(len(self.conv_weights))]
+        self.input_scales.append(float(weights['fully_connected/input_scale']))
+        # The quantized values as float32, converted once rather than on every batch.
+        self.conv_kernels = [np.asarray(kernel, dtype=np.float32) for kernel in self.conv_weights]
+        self.fc_kernel = np.asarray(self.fc_weights, dtype=np.float32)
+
+    def float_kernel(self, i):
+        '''
+        The dequantized kernel of convolution i.
+        '''
+
+        return self.conv_kernels[i] * self.weight_scales[i]
+
+    def quantize_input(self, layer, i):
+        '''
+        Round the input of layer i to the int8 range, kept in a float32 array.
+        '''
+
+        return np.clip(np.rint(layer / self.input_scales[i]), -127, 127).astype(np.float32)
+
+    def conv_layer(self, layer, i):
+        '''
+        Convolution i of the model, on the quantized input and kernel.
+        '''
+
+        conv = self.conv(self.quantize_input(layer, i), self.conv_kernels[i])
+        conv *= self.input_scales[i] * self.weight_scales[i]
+        if self.conv_projections[i] is not None:
+            # The projections of factorized convolutions stay in float.
+            conv = np.dot(conv, self.conv_projections[i])
+        conv += self.conv_biases[i]
+        return conv
+
+    def projection(self, output):
+        '''
+        The final fully connected projection, on the quantized input and weights.
+        '''
+
+        i = len(self.conv_weights)
+        output = np.dot(self.quantize_input(output, i), self.fc_kernel)
+        return output * (self.input_scales[i] * self.weight_scales[i]) + self.fc_biases
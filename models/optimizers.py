@@ -0,0 +1,34 @@
+import tensorflow as tf
+
+OPTIMIZERS = ['lazy_adam', 'adam']
+
+
+def get_train_op(loss, learning_rate, optimizer='lazy_adam'):
+    '''
+    Create the training op for the embedding model.
+
+    The gradient of the word embedding matrix only has the rows gathered by the batch, as tf.IndexedSlices. Plain Adam
+    still decays the moments of every row and updates the whole matrix on every step. Lazy Adam only updates the
+    gathered rows and their moments, and is the same as Adam for the dense gradients of the conv weights.
+
+    LazyAdamOptimizer subclasses AdamOptimizer and keeps its slot names (Adam and Adam_1) and beta power accumulators,
+    so a checkpoint trained with either optimizer can be restored and trained further with the other.
+
+    Args:
+        loss: The loss tensor to minimize.
+        learning_rate: The learning rate, a float or a tensor.
+        optimizer (str): 'lazy_adam' or 'adam'.
+
+    Returns:
+        The training op.
+    '''
+
+    if optimizer == 'lazy_adam':
+        opt = tf.contrib.opt.LazyAdamOptimizer(learning_rate=learning_rate)
+    elif optimizer == 'adam':
+        opt = tf.train.AdamOptimizer(learning_rate=learning_rate)
+    else:
+        raise ValueError('Unknown optimizer \'{}\', should be one of {}.'.format(optimizer, OPTIMIZERS))
+
+    grads_and_vars = opt.compute_gradients(loss)
+    return opt.apply_gradients(grads_and_vars)
@@ -1,17 +1,141 @@
+import argparse
 import os
+import collections
 import cPickle
+import json
+import multiprocessing
 import nltk
-import struct
+import mmap
 import numpy as np
 from scipy.io import loadmat
 import glob
 import cPickle
 import pdb
+import shutil
+import tempfile
+import time
+from util import RaggedArray, RAGGED_OFFSETS_SUFFIX, RAGGED_TOKENS_SUFFIX
+from tokenizer import TOKENIZER_VERSION, TOKENIZERS, get_tokenizer
 
 
-def tokenize_sentence(data, data_type, word_to_index, max_doc_len, fixed_length):
+# Bump this whenever the output of read_dataset or remap_to_local_vocab changes, so cached outputs are rebuilt.
+PREPROCESS_VERSION = 1
+
+WORD2VEC_FILE = 'word2vec/GoogleNews-vectors-negative300.bin'
+# The raw files of each dataset, relative to the data directory.
+DATASET_FILES = {
+    'imdb': ['imdb_sentiment/imdb_sentiment.mat'],
+    'amazon': ['amazon_food/amazon_train_data.pkl', 'amazon_food/amazon_test_data.pkl'],
+    'wikipedia': ['wikipedia_100/alldata.txt', 'wikipedia_100/alldata-label.txt'],
+}
+
+# Output layout of get_data_gbw, inside data_path/gbw/tokenized.
+GBW_MANIFEST_FILE = 'manifest.json'
+GBW_TMP_DIR = 'tmp'
+
+# State for the tokenization worker processes. It's set before the pool is created, so the forked workers inherit it
+# instead of receiving a copy of word_to_index with every chunk.
+_TOKENIZE_STATE = dict()
+
+
+def map_chunks(fn, data, num_workers=None, chunk_size=1000):
+    """
+    Apply fn to consecutive chunks of data in a pool of processes, and yield the results in the order of the chunks.
+    Only a few chunks per worker are in flight at once, so the results can be consumed as they arrive.
+
+    Args:
+        fn (callable): Module-level function that takes a chunk (a slice of data) and returns a picklable result.
+        data: A list or array of documents.
+        num_workers (int): Number of processes. None uses all the cores, and 1 runs everything in this process.
+        chunk_size (int): Number of documents per chunk.
+
+    Returns:
+        A generator over the results of fn, one per chunk.
+    """
+
+    chunks = (data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size))
+    if num_workers == 1:
+        for chunk in chunks:
+            yield fn(chunk)
+        return
+
+    num_workers = num_workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(fn, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def tokenize_text(text, data_type, tknzr):
     """
-    Convert data, an array containing IMDB sentiment data, into a list of indices into the word2vec matrix.
+    Split a document into lower-cased tokens.
+
+    Args:
+        text (str): The document.
+        data_type (str): Data to use, 'imdb', 'amazon', or 'wikipedia'
+        tknzr: The tokenizer for the TweetTokenizer + nltk.word_tokenize chain, from tokenizer.get_tokenizer. The
+            IMDB data only uses nltk.word_tokenize.
+
+    Returns:
+        tokens (list): The tokens of the document.
+    """
+
+    if data_type == 'imdb':
+        tokens = nltk.word_tokenize(text)
+    elif data_type == 'amazon':
+        tokens = tknzr.tokenize(text)
+    else:
+        tokens = tknzr.tokenize(text.decode('latin-1'))
+
+    return [word.lower() for word in tokens]
+
+
+def _tokenize_chunk(chunk):
+    """
+    Tokenize a chunk of documents and convert them to indices into word2vec, dropping unknown words. Runs in the worker
+    processes of tokenize_sentence.
+    """
+
+    data_type = _TOKENIZE_STATE['data_type']
+    word_to_index = _TOKENIZE_STATE['word_to_index']
+    max_doc_len = _TOKENIZE_STATE['max_doc_len']
+    fixed_length = _TOKENIZE_STATE['fixed_length']
+    tknzr = get_tokenizer(_TOKENIZE_STATE['tokenizer'])
+
+    tokenized = []
+    for sentence in chunk:
+        tokenized_sentence = tokenize_text(sentence, data_type, tknzr)
+        index_list = [word_to_index[word] for word in tokenized_sentence if word in word_to_index]
+        if fixed_length and len(index_list) > max_doc_len:
+            index_list = index_list[:max_doc_len]
+
+        tokenized.append(index_list)
+
+    return RaggedArray.from_lists(tokenized)
+
+
+def _tokenize_words_chunk(chunk):
+    """
+    Tokenize a chunk of documents, keeping the tokens as strings. Runs in the worker processes of
+    tokenize_sentence_wikipedia.
+    """
+
+    tknzr = get_tokenizer(_TOKENIZE_STATE['tokenizer'])
+    return [tokenize_text(sentence, _TOKENIZE_STATE['data_type'], tknzr) for sentence in chunk]
+
+
+def tokenize_sentence(data, data_type, word_to_index, max_doc_len, fixed_length, num_workers=None, chunk_size=1000,
+                      tokenizer='nltk'):
+    """
+    Convert data, an array containing IMDB sentiment data, into a list of indices into the word2vec matrix. The
+    documents are tokenized in parallel, in chunks, and the output keeps their order.
 
     Args:
         data: An array containing the IMDB sentiment data, as unicode strings.
@@ -19,130 +143,191 @@ def tokenize_sentence(data, data_type, word_to_index, max_doc_len, fixed_length)
         word_to_index (dict): Dict that maps words to their index in the word2vec matrix
         max_doc_len (int): Maximum length of input, if using CNN-pad
         fixed_length (bool): True if using CNN-pad
+        num_workers (int): Number of tokenization processes. None uses all the cores.
+        chunk_size (int): Number of documents given to a process at a time.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'. See tokenizer.py.
 
     Returns:
-        tokenized (list): list of lists, where each list is a document from the IMDB data converted to their word2vec
-            indices
+        tokenized (RaggedArray): The documents, each one converted to their word2vec indices
     """
 
-    tokenized = []
-    tknzr = nltk.tokenize.TweetTokenizer()
-
-    for sentence in data:
-        if data_type == 'imdb':
-            sentence = sentence[0][0]
-            tokens = nltk.word_tokenize(sentence)
-        elif data_type == 'amazon':
-            tokens = nltk.word_tokenize(' '.join(tknzr.tokenize(sentence)))
-        else:
-            tokens = nltk.word_tokenize(' '.join(tknzr.tokenize(sentence.decode('latin-1'))))
+    if data_type == 'imdb':
+        data = [sentence[0][0] for sentence in data]
 
-        tokenized_sentence = [word.lower() for word in tokens]
-        tokenized_sentence = [word for word in tokenized_sentence if word in word_to_index]
-        index_list = [word_to_index[word] for word in tokenized_sentence]
-        length = len(index_list)
-        if fixed_length and length > max_doc_len:
-            index_list = index_list[:max_doc_len]
+    _TOKENIZE_STATE.update(data_type=data_type, word_to_index=word_to_index, max_doc_len=max_doc_len,
+                           fixed_length=fixed_length, tokenizer=tokenizer)
+    try:
+        chunks = list(map_chunks(_tokenize_chunk, data, num_workers, chunk_size))
+    finally:
+        _TOKENIZE_STATE.clear()
 
-        tokenized.append(index_list)
-
-    return tokenized
+    return RaggedArray.concatenate(chunks)
 
 
-def tokenize_sentence_wikipedia(data, word_embeddings, word_to_index, max_doc_len, fixed_length):
+def tokenize_sentence_wikipedia(data, word_embeddings, word_to_index, max_doc_len, fixed_length, num_workers=None,
+                                chunk_size=1000, tokenizer='nltk', spill_dir=None):
     """
     Tokenizing the sentence specifically for the Wikipedia data. This is more difficult.
 
+    Tokens that appear fewer than 9 times are mapped to <unk>, which needs the frequencies of the whole corpus before
+    any document can be converted. So this makes two passes. The first one gives every distinct token an id, in order
+    of first appearance, counts the ids in an array, and spills each chunk of documents to disk as ids. The second one
+    reads the chunks back and maps the ids to indices. Only the distinct tokens are kept in memory as strings.
+
     :param data:
     :param word_embeddings:
     :param word_to_index:
     :param max_doc_len:
     :param fixed_length:
+    :param num_workers: Number of tokenization processes. None uses all the cores.
+    :param chunk_size: Number of documents given to a process at a time.
+    :param tokenizer: The tokenizer to use, 'nltk' or 'fast'.
+    :param spill_dir: Directory for the spilled chunks, removed at the end. None uses a temporary directory.
     :return:
     """
 
-    tokenized = []
-    freqs = dict()
-    tknzr = nltk.tokenize.TweetTokenizer()
-
-    for sentence in data:
-        tokens = nltk.word_tokenize(' '.join(tknzr.tokenize(sentence.decode('latin-1'))))
-        tokens = [word.lower() for word in tokens]
-
-        for tok in tokens:
-            if tok in freqs:
-                freqs[tok] += 1
-            else:
-                freqs[tok] = 1
-
-        tokenized.append(tokens)
-
-    # We only keep tokens that have appeared at least 10 times in the data and map everything else to <unk>.
-    converted_to_indices = []
-    word_to_index['<unk>'] = word_embeddings.shape[0]
-    curr_ind = word_embeddings.shape[0] + 1
-    num_new_tokens = 1
-    for tokens in tokenized:
-        indexed_sen = []
-        for tok in tokens:
-            if freqs[tok] >= 9:
-                if tok in word_to_index:
-                    indexed_sen.append(word_to_index[tok])
-                else:
+    spill_dir = tempfile.mkdtemp(dir=spill_dir)
+    try:
+        # First pass: count the tokens and spill the documents as token ids.
+        token_ids = dict()
+        freqs = np.zeros(0, dtype=np.int64)
+        num_chunks = 0
+        _TOKENIZE_STATE.update(data_type='wikipedia', tokenizer=tokenizer)
+        try:
+            for chunk_tokens in map_chunks(_tokenize_words_chunk, data, num_workers, chunk_size):
+                chunk_ids = RaggedArray.from_lists(
+                    [[token_ids.setdefault(tok, len(token_ids)) for tok in tokens] for tokens in chunk_tokens])
+                chunk_freqs = np.bincount(chunk_ids.tokens, minlength=len(token_ids))
+                chunk_freqs[:len(freqs)] += freqs
+                freqs = chunk_freqs
+
+                chunk_ids.save(os.path.join(spill_dir, str(num_chunks)))
+                num_chunks += 1
+        finally:
+            _TOKENIZE_STATE.clear()
+
+        # We only keep tokens that have appeared at least 10 times in the data and map everything else to <unk>. The
+        # ids are in order of first appearance, so new words get the same indices as when converting the documents in
+        # order.
+        words = [None] * len(token_ids)
+        for tok, tok_id in token_ids.iteritems():
+            words[tok_id] = tok
+        del token_ids
+
+        word_to_index['<unk>'] = word_embeddings.shape[0]
+        curr_ind = word_embeddings.shape[0] + 1
+        num_new_tokens = 1
+        id_to_index = np.empty(len(words), dtype=np.int32)
+        for tok_id, tok in enumerate(words):
+            if freqs[tok_id] >= 9:
+                if tok not in word_to_index:
                     word_to_index[tok] = curr_ind
-                    indexed_sen.append(curr_ind)
                     curr_ind += 1
                     num_new_tokens += 1
+                id_to_index[tok_id] = word_to_index[tok]
             else:
-                indexed_sen.append(word_to_index['<unk>'])
+                id_to_index[tok_id] = word_to_index['<unk>']
+        del words
+
+        # Second pass: convert the spilled chunks to indices.
+        converted_to_indices = []
+        for i in xrange(num_chunks):
+            chunk_ids = RaggedArray.load(os.path.join(spill_dir, str(i)))
+            chunk = RaggedArray(id_to_index[chunk_ids.tokens], np.array(chunk_ids.offsets))
+            if fixed_length:
+                chunk = chunk.truncate(max_doc_len)
+            converted_to_indices.append(chunk)
+    finally:
+        shutil.rmtree(spill_dir)
+
+    word_embeddings = np.vstack((word_embeddings, np.random.uniform(-1, 1, size=[num_new_tokens, 300])))
+    return RaggedArray.concatenate(converted_to_indices), word_embeddings, word_to_index
 
-        if fixed_length and len(indexed_sen) > max_doc_len:
-            indexed_sen = indexed_sen[:max_doc_len]
 
-        converted_to_indices.append(indexed_sen)
+def _scan_word2vec_binary(buf, offset, num_vectors, vector_len):
+    """
+    Find the words and the byte offsets of their vectors in a word2vec binary file.
 
-    word_embeddings = np.vstack((word_embeddings, np.random.uniform(-1, 1, size=[num_new_tokens, 300])))
-    return converted_to_indices, word_embeddings, word_to_index
+    Args:
+        buf (mmap.mmap): The memory-mapped word2vec binary file.
+        offset (int): Byte offset of the first entry, right after the header.
+        num_vectors (int): Number of vectors in the file.
+        vector_len (int): Dimensionality of each vector.
+
+    Returns:
+        words (list): The words, in file order.
+        vec_offsets (numpy.ndarray): Byte offset of each word's vector.
+    """
+
+    row_bytes = 4 * vector_len
+    words = []
+    vec_offsets = np.empty(num_vectors, dtype=np.int64)
+    pos = offset
+    for n in xrange(num_vectors):
+        end = buf.find(' ', pos)
+        # Some writers put a newline after each vector, which ends up in front of the next word.
+        words.append(buf[pos:end].strip())
+        vec_offsets[n] = end + 1
+        pos = end + 1 + row_bytes
+
+    return words, vec_offsets
 
 
-def load_word2vec(data_path):
+def load_word2vec(data_path, chunk_size=4096):
     """
     Load the pre-trained word2vec vectors and return them, along with a mapping from words to their index in word2vec.
 
+    The first call parses the binary file and stores the vectors as a float32 .npy file, with a vocabulary file next
+    to it. Later calls memory-map the .npy file instead of parsing the binary again.
+
     Args:
         data_path (str): Path to the directory containing word2vec
+        chunk_size (int): Number of vectors to decode at once when parsing the binary file.
 
     Returns:
-        word_vectors (numpy.ndarray): Array of pre-trained word2vec vectors.
+        word_vectors (numpy.ndarray): Array of pre-trained word2vec vectors, as float32.
         word_to_index (dict): Mapping from words in word2vec to their index in word_vectors.
     """
 
-    word2vec_f = open(os.path.join(data_path, 'word2vec/GoogleNews-vectors-negative300.bin'), 'rb')
-
-    c = None
-    # read the header
-    header = ''
-    while c != '\n':
-        c = word2vec_f.read(1)
-        header += c
+    bin_fn = os.path.join(data_path, WORD2VEC_FILE)
+    vectors_fn = os.path.splitext(bin_fn)[0] + '.npy'
+    vocab_fn = os.path.splitext(bin_fn)[0] + '.vocab.txt'
 
-    num_vectors, vector_len = (int(x) for x in header.split())
-    word_vectors = np.zeros((num_vectors, vector_len))
-    word_to_index = dict()
-    float_size = 4  # 32bit float
+    bin_mtime = os.path.getmtime(bin_fn)
+    if os.path.isfile(vectors_fn) and os.path.isfile(vocab_fn) and os.path.getmtime(vectors_fn) >= bin_mtime and \
+            os.path.getmtime(vocab_fn) >= bin_mtime:
+        word_vectors = np.load(vectors_fn, mmap_mode='r')
+        with open(vocab_fn, 'rb') as f:
+            words = f.read().split('\n')
+        word_to_index = dict(zip(words, xrange(len(words))))
+        return word_vectors, word_to_index
 
-    for n in range(num_vectors):
-        word = []
-        c = word2vec_f.read(1)
-        while c != ' ':
-            word.append(c)
-            c = word2vec_f.read(1)
-        word = ''.join(word).strip()
+    with open(bin_fn, 'rb') as word2vec_f:
+        buf = mmap.mmap(word2vec_f.fileno(), 0, access=mmap.ACCESS_READ)
 
-        binary_vector = word2vec_f.read(float_size * vector_len)
-        vec = [struct.unpack_from('f', binary_vector, i)[0] for i in xrange(0, len(binary_vector), float_size)]
-        word_vectors[n, :] = np.array(vec)
-        word_to_index[word] = n
+    # read the header
+    header_end = buf.find('\n')
+    num_vectors, vector_len = (int(x) for x in buf[:header_end].split())
+    words, vec_offsets = _scan_word2vec_binary(buf, header_end + 1, num_vectors, vector_len)
+
+    # Decode the vectors a chunk at a time, by gathering their bytes and reinterpreting them as 32bit floats.
+    word_vectors = np.empty((num_vectors, vector_len), dtype=np.float32)
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    byte_cols = np.arange(4 * vector_len)
+    for start in xrange(0, num_vectors, chunk_size):
+        rows = vec_offsets[start:start + chunk_size]
+        word_vectors[start:start + chunk_size] = raw[rows[:, None] + byte_cols].view('<f4')
+    del raw
+    buf.close()
+
+    word_to_index = dict(zip(words, xrange(num_vectors)))
+
+    # Write the sidecar files, renaming them into place so an interrupted run never leaves a partial cache behind.
+    np.save(vectors_fn + '.tmp.npy', word_vectors)
+    os.rename(vectors_fn + '.tmp.npy', vectors_fn)
+    with open(vocab_fn + '.tmp', 'wb') as f:
+        f.write('\n'.join(words))
+    os.rename(vocab_fn + '.tmp', vocab_fn)
 
     return word_vectors, word_to_index
 
@@ -167,25 +352,59 @@ def load_word2vec_fast(data_path):
     return word_vectors, word_to_index
 
 
-def get_data_imdb(data_path, max_doc_len, fixed_length=True):
+def remap_to_local_vocab(word_vectors, data_indices):
     """
-    Return the IMDB test and training data as a list of lists of indices.
+    Keep only the word vectors used by the data, and convert the documents to indices into that smaller matrix. A zero
+    vector is added at the end, for padding.
+
+    Args:
+        word_vectors (numpy.ndarray): The full word2vec matrix.
+        data_indices (list): RaggedArrays of documents, as indices into word_vectors.
+
+    Returns:
+        input_embeddings (numpy.ndarray): The word vectors used by the data, followed by a zero vector.
+        local_indices (list): RaggedArrays with the same documents, as indices into input_embeddings.
+    """
+
+    all_tokens = np.concatenate([indices.tokens for indices in data_indices] + [np.zeros(0, dtype=np.int32)])
+    all_unique_indices, local_tokens = np.unique(all_tokens, return_inverse=True)
+    local_tokens = local_tokens.astype(np.int32)
+
+    input_embeddings = word_vectors[all_unique_indices]
+    # add an empty to vector and reverse vector
+    input_embeddings = np.vstack([input_embeddings, np.zeros([input_embeddings.shape[1]])])
+    print('Number of unique words in this dataset is {}'.format(len(input_embeddings)))
+
+    local_indices = []
+    start = 0
+    for indices in data_indices:
+        end = start + len(indices.tokens)
+        local_indices.append(RaggedArray(local_tokens[start:end], np.asarray(indices.offsets)))
+        start = end
+
+    return input_embeddings, local_indices
+
+
+def read_imdb(data_path, max_doc_len, fixed_length=True, num_workers=None):
+    """
+    Tokenize the IMDB test and training data, as indices into the word2vec matrix.
 
     Args:
         data_path (str): Path to the directory containing the data.
         max_doc_len (int): Maximum length of input, if using CNN-pad
         fixed_length (bool): True if using CNN-pad
+        num_workers (int): Number of tokenization processes. None uses all the cores.
 
     Returns:
-        input_embeddings (numpy.ndarray): Input word embeddings to the CNN
-        train_data_indices (list): list of list of indices to word2vec, for training
+        word_vectors (numpy.ndarray): The word vectors the documents index into
+        train_data_indices (RaggedArray): documents as indices into word_vectors, for training
         train_labels (numpy.ndarray): 1D array of labels, for training
-        test_data_indices (list): list of list of indices to word2vec, for testing
+        test_data_indices (RaggedArray): documents as indices into word_vectors, for testing
         test_labels (numpy.ndarray): 1D array of labels, for training
     """
 
     # Read pre-trained word2vec vectors and dictionary
-    word_vectors, word_to_index = load_word2vec_fast(data_path)
+    word_vectors, word_to_index = load_word2vec(data_path)
 
     # Read train test data and label
     temp = loadmat(os.path.join(data_path, 'imdb_sentiment/imdb_sentiment.mat'))
@@ -195,64 +414,37 @@ def get_data_imdb(data_path, max_doc_len, fixed_length=True):
     test_labels = temp['test_labels']
 
     print('Tokenizing data and converting to indices.')
-    train_data_indices = tokenize_sentence(train_data, 'imdb', word_to_index, max_doc_len, fixed_length)
-    test_data_indices = tokenize_sentence(test_data, 'imdb', word_to_index, max_doc_len, fixed_length)
-
-    # Create the unique word dict used by the model
-    flatten_train = [item for sublist in train_data_indices for item in sublist]
-    train_data_indices_unique = list(set(flatten_train))
-
-    flatten_test = [item for sublist in test_data_indices for item in sublist]
-    test_data_indices_unique = list(set(flatten_test))
-
-    train_data_indices_unique.extend(test_data_indices_unique)
-    all_unique_indices = list(set(train_data_indices_unique))
-
-    reverse_index = {}
-    for i in range(len(all_unique_indices)):
-        reverse_index[all_unique_indices[i]] = i
-
-    input_embeddings = word_vectors[all_unique_indices]
-    # add an empty to vector and reverse vector
-    input_embeddings = np.vstack([input_embeddings, np.zeros(input_embeddings.shape[1])])
-    reverse_index[-1] = input_embeddings.shape[0] - 1
-    print('Number of unique words in this dataset is {}'.format(len(input_embeddings)))
-
-    for i in range(len(train_data_indices)):
-        for j in range(len(train_data_indices[i])):
-            train_data_indices[i][j] = reverse_index[train_data_indices[i][j]]
-    for i in range(len(test_data_indices)):
-        for j in range(len(test_data_indices[i])):
-            test_data_indices[i][j] = reverse_index[test_data_indices[i][j]]
+    train_data_indices = tokenize_sentence(train_data, 'imdb', word_to_index, max_doc_len, fixed_length, num_workers)
+    test_data_indices = tokenize_sentence(test_data, 'imdb', word_to_index, max_doc_len, fixed_length, num_workers)
 
     # Convert list to np array
-    train_data_indices = np.array(train_data_indices)
     train_labels = np.array(train_labels)
-    test_data_indices = np.array(test_data_indices)
     test_labels = np.array(test_labels)
 
-    return input_embeddings, train_data_indices, train_labels, test_data_indices, test_labels
+    return word_vectors, train_data_indices, train_labels, test_data_indices, test_labels
 
 
-def get_data_amazon(data_path, max_doc_len, fixed_length=True):
+def read_amazon(data_path, max_doc_len, fixed_length=True, num_workers=None, tokenizer='nltk'):
     """
-    Return the Amazon Fine Food Reviews test and training data as a list of lists of indices.
+    Tokenize the Amazon Fine Food Reviews test and training data, as indices into the word2vec matrix.
 
     Args:
         data_path (str): Path to the directory containing the data.
         max_doc_len (int): Maximum length of input, if using CNN-pad
         fixed_length (bool): True if using CNN-pad
+        num_workers (int): Number of tokenization processes. None uses all the cores.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'. See tokenizer.py.
 
     Returns:
-        input_embeddings (numpy.ndarray): Input word embeddings to the CNN
-        train_data_indices (list): list of list of indices to word2vec, for training
+        word_vectors (numpy.ndarray): The word vectors the documents index into
+        train_data_indices (RaggedArray): documents as indices into word_vectors, for training
         train_labels (numpy.ndarray): 1D array of labels, for training
-        test_data_indices (list): list of list of indices to word2vec, for testing
+        test_data_indices (RaggedArray): documents as indices into word_vectors, for testing
         test_labels (numpy.ndarray): 1D array of labels, for training
     """
 
     # Read pre-trained word2vec vectors and dictionary
-    word_vectors, word_to_index = load_word2vec_fast(data_path)
+    word_vectors, word_to_index = load_word2vec(data_path)
 
     with open(os.path.join(data_path, 'amazon_food/amazon_train_data.pkl')) as train_data_fn:
         train_data = cPickle.load(train_data_fn)
@@ -266,26 +458,8 @@ def get_data_amazon(data_path, max_doc_len, fixed_length=True):
     test_score = test_data[1]
     all_text = train_text + test_text
 
-    data_indices = tokenize_sentence(all_text, 'amazon', word_to_index, max_doc_len, fixed_length)
-    # Create the unique word dict used by the model
-    flatten_data = [item for sublist in data_indices for item in sublist]
-    all_unique_indices = list(set(flatten_data))
-
-    reverse_index = {}
-    for i in range(len(all_unique_indices)):
-        reverse_index[all_unique_indices[i]] = i
-
-    input_embeddings = word_vectors[all_unique_indices]
-    # add an empty to vector and reverse vector
-    input_embeddings = np.vstack([input_embeddings, np.zeros([input_embeddings.shape[1]])])
-    reverse_index[-1] = input_embeddings.shape[0] - 1
-    print('Number of unique words in this dataset is {}'.format(len(input_embeddings)))
-
-    # Convert index from whole vocabulary to local vocabulary
-    for i in range(len(data_indices)):
-        for j in range(len(data_indices[i])):
-            data_indices[i][j] = reverse_index[data_indices[i][j]]
-    data_indices = np.array(data_indices)
+    data_indices = tokenize_sentence(all_text, 'amazon', word_to_index, max_doc_len, fixed_length, num_workers,
+                                     tokenizer=tokenizer)
 
     train_data_indices = data_indices[:80000]
     train_labels = np.array(train_score)
@@ -295,23 +469,26 @@ def get_data_amazon(data_path, max_doc_len, fixed_length=True):
     test_labels = np.array(test_score)
     test_labels -= 1
 
-    return input_embeddings, train_data_indices, train_labels, test_data_indices, test_labels
+    return word_vectors, train_data_indices, train_labels, test_data_indices, test_labels
 
 
-def get_data_wikipedia(data_path, max_doc_len, fixed_length=True):
+def read_wikipedia(data_path, max_doc_len, fixed_length=True, num_workers=None, tokenizer='nltk'):
     """
-    Return the Wikipedia test and training data as a list of lists of indices.
+    Tokenize the Wikipedia test and training data, as indices into the word2vec matrix extended with random vectors for
+    the frequent words that aren't in word2vec.
 
     Args:
         data_path (str): Path to the directory containing the data.
         max_doc_len (int): Maximum length of input, if using CNN-pad
         fixed_length (bool): True if using CNN-pad
+        num_workers (int): Number of tokenization processes. None uses all the cores.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'. See tokenizer.py.
 
     Returns:
-        input_embeddings (numpy.ndarray): Input word embeddings to the CNN
-        train_data_indices (list): list of list of indices to word2vec, for training
+        word_vectors (numpy.ndarray): The word vectors the documents index into
+        train_data_indices (RaggedArray): documents as indices into word_vectors, for training
         train_labels (numpy.ndarray): 1D array of labels, for training
-        test_data_indices (list): list of list of indices to word2vec, for testing
+        test_data_indices (RaggedArray): documents as indices into word_vectors, for testing
         test_labels (numpy.ndarray): 1D array of labels, for training
     """
 
@@ -319,7 +496,7 @@ def get_data_wikipedia(data_path, max_doc_len, fixed_length=True):
     skip_inds = [114767, 136434, 181703, 301236, 55718, 56001, 72101, 99528]
 
     # Read pre-trained word2vec vectors and dictionary
-    word_vectors, word_to_index = load_word2vec_fast(data_path)
+    word_vectors, word_to_index = load_word2vec(data_path)
     data_file = open(os.path.join(data_path, 'wikipedia_100/alldata.txt'), 'r')
     labels_file = open(os.path.join(data_path, 'wikipedia_100/alldata-label.txt'), 'r')
     train_data = []
@@ -347,26 +524,8 @@ def get_data_wikipedia(data_path, max_doc_len, fixed_length=True):
 
     all_text = train_data + test_data
     data_indices, word_vectors, word_to_index = tokenize_sentence_wikipedia(all_text, word_vectors, word_to_index,
-                                                                            max_doc_len, fixed_length)
-    # Create the unique word dict used by the model
-    flatten_data = [item for sublist in data_indices for item in sublist]
-    all_unique_indices = list(set(flatten_data))
-
-    reverse_index = {}
-    for i in range(len(all_unique_indices)):
-        reverse_index[all_unique_indices[i]] = i
-
-    input_embeddings = word_vectors[all_unique_indices]
-    # add an empty to vector and reverse vector
-    input_embeddings = np.vstack([input_embeddings, np.zeros([input_embeddings.shape[1]])])
-    reverse_index[-1] = input_embeddings.shape[0] - 1
-    print('Number of unique words in this dataset is {}'.format(len(input_embeddings)))
-
-    # Convert index from whole vocabulary to local vocabulary
-    for i in range(len(data_indices)):
-        for j in range(len(data_indices[i])):
-            data_indices[i][j] = reverse_index[data_indices[i][j]]
-    data_indices = np.array(data_indices)
+                                                                            max_doc_len, fixed_length, num_workers,
+                                                                            tokenizer=tokenizer)
 
     # remap the labels.
     all_labels = list(set(test_labels))
@@ -385,19 +544,109 @@ def get_data_wikipedia(data_path, max_doc_len, fixed_length=True):
     test_data_indices = data_indices[-90000:]
     test_labels = np.array([class_map[x] for x in test_labels])
 
+    return word_vectors, train_data_indices, train_labels, test_data_indices, test_labels
+
+
+def read_dataset(dataset, data_path, max_doc_len, fixed_length=True, num_workers=None, tokenizer='nltk'):
+    """
+    Tokenize a dataset, as indices into the word2vec matrix. This is the first stage of get_data.
+
+    Args:
+        dataset (str): Data to use, 'imdb', 'amazon', or 'wikipedia'
+        data_path (str): Path to the directory containing the data.
+        max_doc_len (int): Maximum length of input, if using CNN-pad
+        fixed_length (bool): True if using CNN-pad
+        num_workers (int): Number of tokenization processes. None uses all the cores.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'. Not used for IMDB.
+
+    Returns:
+        The outputs of read_imdb, read_amazon or read_wikipedia.
+    """
+
+    if dataset == 'imdb':
+        return read_imdb(data_path, max_doc_len, fixed_length, num_workers)
+    elif dataset == 'amazon':
+        return read_amazon(data_path, max_doc_len, fixed_length, num_workers, tokenizer)
+    elif dataset == 'wikipedia':
+        return read_wikipedia(data_path, max_doc_len, fixed_length, num_workers, tokenizer)
+
+    raise ValueError('Unknown dataset \'{}\'.'.format(dataset))
+
+
+def get_data(dataset, data_path, max_doc_len, fixed_length=True, num_workers=None, tokenizer='nltk'):
+    """
+    Return the test and training data of a dataset, as indices into the word vectors used by that dataset.
+
+    Args:
+        dataset (str): Data to use, 'imdb', 'amazon', or 'wikipedia'
+        data_path (str): Path to the directory containing the data.
+        max_doc_len (int): Maximum length of input, if using CNN-pad
+        fixed_length (bool): True if using CNN-pad
+        num_workers (int): Number of tokenization processes. None uses all the cores.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'. Not used for IMDB.
+
+    Returns:
+        input_embeddings (numpy.ndarray): Input word embeddings to the CNN
+        train_data_indices (RaggedArray): documents as indices into input_embeddings, for training
+        train_labels (numpy.ndarray): 1D array of labels, for training
+        test_data_indices (RaggedArray): documents as indices into input_embeddings, for testing
+        test_labels (numpy.ndarray): 1D array of labels, for training
+    """
+
+    word_vectors, train_data_indices, train_labels, test_data_indices, test_labels = read_dataset(
+        dataset, data_path, max_doc_len, fixed_length, num_workers, tokenizer)
+
+    # Create the unique word dict used by the model, and convert index from whole vocabulary to local vocabulary
+    input_embeddings, (train_data_indices, test_data_indices) = \
+        remap_to_local_vocab(word_vectors, [train_data_indices, test_data_indices])
+
     return input_embeddings, train_data_indices, train_labels, test_data_indices, test_labels
 
 
-def get_data_gbw(data_path, max_doc_len=None):
+def get_data_imdb(data_path, max_doc_len, fixed_length=True, num_workers=None):
+    """
+    Return the IMDB test and training data as a list of lists of indices. See get_data.
+    """
+
+    return get_data('imdb', data_path, max_doc_len, fixed_length, num_workers)
+
+
+def get_data_amazon(data_path, max_doc_len, fixed_length=True, num_workers=None, tokenizer='nltk'):
+    """
+    Return the Amazon Fine Food Reviews test and training data as a list of lists of indices. See get_data.
+    """
+
+    return get_data('amazon', data_path, max_doc_len, fixed_length, num_workers, tokenizer)
+
+
+def get_data_wikipedia(data_path, max_doc_len, fixed_length=True, num_workers=None, tokenizer='nltk'):
+    """
+    Return the Wikipedia test and training data as a list of lists of indices. See get_data.
+    """
+
+    return get_data('wikipedia', data_path, max_doc_len, fixed_length, num_workers, tokenizer)
+
+
+def build_gbw_vocab(data_path, cache_dir='./gbw_cache'):
     '''
-    Turn the GBW dataset into a list of indices. Store the indices locally.
+    Build the lower-cased word2vec vocabulary used for GBW, with an <unk> vector and a zero vector at the end, and save
+    it in cache_dir. If it's already there, it's loaded instead, so the random <unk> vector doesn't change between runs.
 
     Args:
         data_path (str): Path to the directory containing the data.
-        max_doc_len (int): Maximum length of input, if using CNN-pad. None, otherwise.
+        cache_dir (str): Directory for vector_up.npy and word_to_index.pkl.
+
+    Returns:
+        word_to_index (dict): Mapping from lower-cased words to their index in the saved vectors.
     '''
 
-    word_vectors, word_to_index = load_word2vec_fast(data_path)
+    vectors_fn = os.path.join(cache_dir, 'vector_up.npy')
+    vocab_fn = os.path.join(cache_dir, 'word_to_index.pkl')
+    if os.path.isfile(vectors_fn) and os.path.isfile(vocab_fn):
+        with open(vocab_fn, 'r') as f:
+            return cPickle.load(f)
+
+    word_vectors, word_to_index = load_word2vec(data_path)
     all_inds = []
     new_word_to_index = dict()
     for word in word_to_index:
@@ -427,47 +676,143 @@ def get_data_gbw(data_path, max_doc_len=None):
     # Adding zero vector
     word_vectors = np.vstack([word_vectors, np.zeros([word_vectors.shape[1]])])
 
-    # Saving the embeddings
-    np.save('./gbw_cache/vector_up.npy', word_vectors)
-    with open('./gbw_cache/word_to_index.pkl', 'w') as f:
+    # Saving the embeddings. The vocabulary is written last, since its presence marks the cache as complete.
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    np.save(vectors_fn + '.tmp.npy', word_vectors)
+    os.rename(vectors_fn + '.tmp.npy', vectors_fn)
+    with open(vocab_fn + '.tmp', 'w') as f:
         cPickle.dump(word_to_index, f)
+    os.rename(vocab_fn + '.tmp', vocab_fn)
+
+    return word_to_index
+
+
+def _tokenize_gbw_shard(fn):
+    '''
+    Tokenize one GBW shard and save it as a RaggedArray in the output directory. The files are written to a temporary
+    directory first and renamed into place. Runs in the worker processes of get_data_gbw.
+
+    Returns:
+        name (str): Name of the shard.
+        num_docs (int): Number of documents kept.
+        num_tokens (int): Total number of tokens.
+        num_bytes (int): Size of the raw shard.
+        seconds (float): Time taken.
+    '''
+
+    t1 = time.time()
+    word_to_index = _TOKENIZE_STATE['word_to_index']
+    max_doc_len = _TOKENIZE_STATE['max_doc_len']
+    out_dir = _TOKENIZE_STATE['out_dir']
+    tknzr = get_tokenizer(_TOKENIZE_STATE['tokenizer'])
+    unk_ind = word_to_index['<unk>']
+
+    all_docs = []
+    with open(fn, 'r') as f:
+        for line in f:
+            # use tokenizer here
+            tokens = tknzr.tokenize(line)
+            line_tok = [word_to_index.get(word.lower(), unk_ind) for word in tokens]
+
+            if max_doc_len is not None and len(line_tok) > max_doc_len:
+                line_tok = line_tok[:max_doc_len]
+
+            if len(line_tok) > 0:
+                all_docs.append(line_tok)
+
+    name = os.path.basename(fn)
+    docs = RaggedArray.from_lists(all_docs)
+    tmp_prefix = os.path.join(out_dir, GBW_TMP_DIR, name)
+    docs.save(tmp_prefix)
+    for suffix in (RAGGED_OFFSETS_SUFFIX, RAGGED_TOKENS_SUFFIX):
+        os.rename(tmp_prefix + suffix, os.path.join(out_dir, name) + suffix)
+
+    return name, len(docs), len(docs.tokens), os.path.getsize(fn), time.time() - t1
+
+
+def _save_manifest(manifest_fn, manifest):
+    '''
+    Write the manifest of get_data_gbw, renaming it into place so it's never left half-written.
+    '''
+
+    with open(manifest_fn + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(manifest_fn + '.tmp', manifest_fn)
+
+
+def get_data_gbw(data_path, max_doc_len=None, tokenizer='nltk', num_workers=None, cache_dir='./gbw_cache'):
+    '''
+    Turn the GBW dataset into a list of indices. Store the indices locally, one RaggedArray per shard.
+
+    The shards are tokenized in parallel, one shard per process at a time. Finished shards are recorded in
+    gbw/tokenized/manifest.json, so a run that was interrupted only redoes the shards that weren't finished. Changing
+    max_doc_len or the tokenizer starts over.
+
+    Args:
+        data_path (str): Path to the directory containing the data.
+        max_doc_len (int): Maximum length of input, if using CNN-pad. None, otherwise.
+        tokenizer (str): The tokenizer to use, 'nltk' or 'fast'.
+        num_workers (int): Number of processes. None uses all the cores.
+        cache_dir (str): Directory for the vocabulary and the word vectors, see build_gbw_vocab.
+
+    Returns:
+        lengths (numpy.ndarray): The length of every document, in the order of the shards.
+    '''
 
     # rather than remap the vocabulary to a smaller, because the dataset is so large, I'll just store the entire
     # word2vec vocabulary. The amount of memory saved is probably insignificant, after removing duplicates after
     # converting to lowercase.
-    gbw_files = glob.glob(os.path.join(data_path, 'gbw/training-monolingual.tokenized.shuffled/*'))
-    tknzr = nltk.tokenize.TweetTokenizer()
-    lengths = []
-    file_num = 1
-    for fn in gbw_files:
-        token_fn = os.path.join(data_path, 'gbw/tokenized', fn.split('/')[-1] + '.npy')
-        all_docs = []
-        with open(fn, 'r') as f:
-            for line in f:
-                # use tokenizer here
-                tokens = nltk.word_tokenize(' '.join(tknzr.tokenize(line)))
-                tokens = [word.lower() for word in tokens]
-                line_tok = []
-                for word in tokens:
-                    if word in word_to_index:
-                        line_tok.append(word_to_index[word])
-                    else:
-                        line_tok.append(word_to_index['<unk>'])
-
-                if max_doc_len is not None and len(line_tok) > max_doc_len:
-                    line_tok = line_tok[:max_doc_len]
-
-                if len(line_tok) > 0:
-                    all_docs.append(line_tok)
-                    lengths.append(len(line_tok))
-
-        np.save(token_fn, all_docs)
-        print('Finished file {} of 100'.format(file_num))
-        file_num += 1
-
-    return lengths
+    word_to_index = build_gbw_vocab(data_path, cache_dir)
+
+    gbw_files = sorted(glob.glob(os.path.join(data_path, 'gbw/training-monolingual.tokenized.shuffled/*')))
+    out_dir = os.path.join(data_path, 'gbw/tokenized')
+    if not os.path.isdir(os.path.join(out_dir, GBW_TMP_DIR)):
+        os.makedirs(os.path.join(out_dir, GBW_TMP_DIR))
+
+    params = {'max_doc_len': max_doc_len, 'tokenizer': [tokenizer, TOKENIZER_VERSION],
+              'vocab_size': len(word_to_index)}
+    manifest_fn = os.path.join(out_dir, GBW_MANIFEST_FILE)
+    manifest = {'params': params, 'shards': dict()}
+    if os.path.isfile(manifest_fn):
+        with open(manifest_fn, 'r') as f:
+            old_manifest = json.load(f)
+        if old_manifest['params'] == params:
+            manifest = old_manifest
+        else:
+            print('The pre-processing parameters changed, tokenizing every shard again.')
+
+    pending = [fn for fn in gbw_files if os.path.basename(fn) not in manifest['shards']]
+    print('{} of {} shards already tokenized.'.format(len(gbw_files) - len(pending), len(gbw_files)))
+
+    if pending:
+        num_workers = min(num_workers or multiprocessing.cpu_count(), len(pending))
+        _TOKENIZE_STATE.update(word_to_index=word_to_index, max_doc_len=max_doc_len, tokenizer=tokenizer,
+                               out_dir=out_dir)
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            for name, num_docs, num_tokens, num_bytes, seconds in pool.imap_unordered(_tokenize_gbw_shard, pending):
+                manifest['shards'][name] = {'num_docs': num_docs, 'num_tokens': num_tokens, 'seconds': seconds}
+                _save_manifest(manifest_fn, manifest)
+                print('Finished {} ({} of {}): {} docs in {:.1f}s, {:.0f} docs/s, {:.2f} MB/s'.format(
+                    name, len(manifest['shards']), len(gbw_files), num_docs, seconds, num_docs / max(seconds, 1e-9),
+                    num_bytes / max(seconds, 1e-9) / 2 ** 20))
+        finally:
+            pool.terminate()
+            _TOKENIZE_STATE.clear()
+
+    return np.concatenate([RaggedArray.load(os.path.join(out_dir, os.path.basename(fn))).lengths()
+                           for fn in gbw_files] + [np.zeros(0, dtype=np.int64)])
 
 
 if __name__ == '__main__':
 
-    get_data_gbw('/home/shunan/Data/')
+    parser = argparse.ArgumentParser(description='Tokenize the GBW dataset for train_GBW.py.')
+    parser.add_argument('--data-dir', type=str, default='/home/shunan/Data/', help='Directory containing the data.')
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='Number of processes used to tokenize the shards. Defaults to all cores.')
+    parser.add_argument('--tokenizer', type=str, default='nltk', choices=TOKENIZERS,
+                        help='The tokenizer to use, see tokenizer.py.')
+    args = parser.parse_args()
+
+    get_data_gbw(args.data_dir, tokenizer=args.tokenizer, num_workers=args.num_workers)
@@ -0,0 +1,160 @@
+import argparse
+import codecs
+import cPickle
+import time
+import numpy as np
+from document_encoder import NumpyDocumentEncoder
+from models.CNNEmbedNumpy import CNNEmbedNumpy, QuantizedCNNEmbedNumpy
+from tokenizer import TOKENIZERS
+from util import load_npz
+
+
+def quantize_symmetric(weights, axis):
+    '''
+    Quantize an array to int8 with one symmetric scale per index along axis.
+
+    Args:
+        weights (numpy.ndarray): The float array.
+        axis (int): The axis of the output channels.
+
+    Returns:
+        quantized (numpy.ndarray): int8 array of the same shape.
+        scales (numpy.ndarray): float32 scales, weights ~ quantized * scales.
+    '''
+
+    weights = np.asarray(weights, dtype=np.float32)
+    reduce_axes = tuple(a for a in range(weights.ndim) if a != axis % weights.ndim)
+    scales = np.max(np.abs(weights), axis=reduce_axes) / 127.
+    # Channels that are all zeros get any scale.
+    scales[scales == 0] = 1.
+    quantized = np.clip(np.rint(weights / scales), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def quantize_weights(weights, input_ranges):
+    '''
+    Quantize the weights of a CNNEmbedNumpy model for QuantizedCNNEmbedNumpy.
+
+    Args:
+        weights (dict): The arrays of the float model, as written by export_model.py --format npz.
+        input_ranges (numpy.ndarray): The largest absolute input of every layer, from CNNEmbedNumpy.calibrate.
+
+    Returns:
+        quantized (dict): The arrays of the quantized model.
+    '''
+
+    quantized = dict(weights)
+    names = ['conv_{}'.format(i) for i in range(len(input_ranges) - 1)] + ['fully_connected']
+    for name, input_range in zip(names, input_ranges):
+        # The output channels are the last axis of the conv kernels and of the projection.
+        quantized[name + '/weights'], quantized[name + '/weight_scales'] = quantize_symmetric(
+            weights[name + '/weights'], -1)
+        quantized[name + '/input_scale'] = np.array(max(input_range, 1e-8) / 127., dtype=np.float32)
+
+    return quantized
+
+
+def cosine_similarities(reference, embeddings):
+    '''
+    Cosine similarity between the rows of two arrays of embeddings.
+    '''
+
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)
+    return np.sum(reference * embeddings, axis=1) / np.maximum(norms, 1e-12)
+
+
+def timed_encode(encoder, docs):
+    '''
+    Embed docs with encoder, and return the embeddings and the number of documents per second.
+    '''
+
+    start = time.time()
+    embeddings = encoder.encode_batch(docs)
+    return embeddings, len(docs) / max(time.time() - start, 1e-6)
+
+
+def quantize_model(model_path, output_path, texts, word_to_index, tokenizer='nltk', num_calibration=1000):
+    '''
+    Calibrate and quantize a NumPy model, then report the drift of the embeddings and the speed of both models.
+
+    Args:
+        model_path (str): The float model, written by export_model.py --format npz.
+        output_path (str): The .npz file for the quantized model.
+        texts (list): Sentences. The first num_calibration calibrate the scales, and the drift is measured on the
+            next num_calibration, or on the calibration sentences if there aren't any others.
+        word_to_index (dict): The vocabulary of the model.
+        tokenizer (str): The tokenizer, 'nltk' or 'fast'.
+        num_calibration (int): Number of calibration sentences.
+
+    Returns:
+        float_encoder, quantized_encoder: NumpyDocumentEncoders for the two models.
+    '''
+
+    model = CNNEmbedNumpy.load(model_path)
+    zero_ind = len(model.embedding) - 1
+    float_encoder = NumpyDocumentEncoder(model, zero_ind, word_to_index, tokenizer, min_doc_len=max(model.k_max, 1))
+    calibration_docs = float_encoder.tokenize(texts[:num_calibration])
+    eval_docs = float_encoder.tokenize(texts[num_calibration:2 * num_calibration]) or calibration_docs
+
+    input_ranges = model.calibrate(lambda: float_encoder.encode_batch(calibration_docs))
+    weights = load_npz(model_path)
+    np.savez(output_path, **quantize_weights(weights, input_ranges))
+
+    quantized_model = QuantizedCNNEmbedNumpy.load(output_path)
+    quantized_encoder = NumpyDocumentEncoder(quantized_model, zero_ind, word_to_index, tokenizer,
+                                             min_doc_len=max(model.k_max, 1))
+
+    layer_names = [name for name in weights if name.endswith('/weights')]
+    float_size = sum(weights[name].nbytes for name in layer_names)
+    quantized_size = sum(array.nbytes for array in quantized_model.conv_weights + [quantized_model.fc_weights])
+    print('Saved the quantized model to {}'.format(output_path))
+    print('Conv and projection weights on disk: {:.1f}MB in float32, {:.1f}MB in int8'.format(float_size / 1e6,
+                                                                                             quantized_size / 1e6))
+
+    reference, float_speed = timed_encode(float_encoder, eval_docs)
+    embeddings, quantized_speed = timed_encode(quantized_encoder, eval_docs)
+    similarities = cosine_similarities(reference, embeddings)
+    print('Cosine similarity to the float32 embeddings, over {} documents: mean {:.5f}, min {:.5f}'.format(
+        len(eval_docs), np.mean(similarities), np.min(similarities)))
+    # There is no int8 matrix product in NumPy, so this isn't the speed of int8 kernels, see QuantizedCNNEmbedNumpy.
+    print('Documents per second: {:.1f} in float32, {:.1f} with the int8 weights simulated in float32'.format(
+        float_speed, quantized_speed))
+
+    return float_encoder, quantized_encoder
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Quantize a NumPy CNNEmbed model to int8 weights.')
+    parser.add_argument('--model', type=str, default='./cnn_embed_inference.npz',
+                        help='The float model, written by export_model.py --format npz.')
+    parser.add_argument('--output', type=str, default='./cnn_embed_inference_int8.npz',
+                        help='Path of the quantized model.')
+    parser.add_argument('--calibration-text', type=str, required=True,
+                        help='Text file with one sentence per line, to calibrate the scales and measure the drift.')
+    parser.add_argument('--num-calibration', type=int, default=1000, help='Number of calibration sentences.')
+    parser.add_argument('--vocab', type=str, default='./gbw_cache/word_to_index.pkl',
+                        help='The word_to_index.pkl of the model.')
+    parser.add_argument('--tokenizer', type=str, default='nltk', choices=TOKENIZERS,
+                        help='The tokenizer used to encode the sentences, \'nltk\' or \'fast\'.')
+    parser.add_argument('--downstream', action='store_true',
+                        help='Also compare the TREC and MR accuracies of the two models. Needs Tensorflow and the '
+                             'classification data, see classification_exps.py.')
+    args = parser.parse_args()
+
+    with codecs.open(args.calibration_text, 'r', encoding='utf-8', errors='replace') as f:
+        texts = [line.strip() for line in f if line.strip()]
+    with open(args.vocab, 'r') as f:
+        word_to_index = cPickle.load(f)
+
+    float_encoder, quantized_encoder = quantize_model(args.model, args.output, texts, word_to_index, args.tokenizer,
+                                                      args.num_calibration)
+
+    if args.downstream:
+        from classification_exps import perform_exp
+        float_accuracies = perform_exp(float_encoder, ['TREC', 'MR'])
+        quantized_accuracies = perform_exp(quantized_encoder, ['TREC', 'MR'])
+        for exp in ['TREC', 'MR']:
+            print('{} accuracy: {:.4f} in float32, {:.4f} with int8 weights ({:+.4f})'.format(
+                exp, float_accuracies[exp], quantized_accuracies[exp],
+                quantized_accuracies[exp] - float_accuracies[exp]))
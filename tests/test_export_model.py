@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import models.CNNEmbed
+from convert_checkpoint import save_checkpoint
+from export_model import CHECK_TOLERANCE, build_inference_graph, check_numpy_model, export_numpy_model, \
+    import_inference_graph
+from models.CNNEmbed import CNNEmbed
+from models.CNNEmbed1D import CNNEmbed1D
+from models.CNNEmbedNumpy import CNNEmbedNumpy
+from util import RaggedArray, pad_batch
+
+VOCAB_SIZE = 50
+EMBED_DIM = 6
+NUM_FILTERS = 4
+NUM_LAYERS = 4
+FILTER_SIZE = 5
+RESIDUAL_SKIP = 2
+
+# gating, fused_gating, k_max, conv1d, causal
+LAYOUTS = [
+    (True, True, 0, False, False),
+    (True, False, 0, False, False),
+    (True, True, 3, False, False),
+    (True, False, 3, False, False),
+    (False, False, 0, False, False),
+    (False, False, 3, False, False),
+    (True, True, 0, True, False),
+    (True, False, 3, True, False),
+    (False, False, 3, True, False),
+    (True, True, 0, False, True),
+    (True, False, 0, True, True),
+]
+
+
+def random_checkpoint(prefix, fused_gating, k_max, conv1d, causal, seed=0):
+    '''
+    Save a checkpoint of a tiny model with random weights and batch norm statistics.
+    '''
+
+    rng = np.random.RandomState(seed)
+    with tf.Graph().as_default():
+        indices = tf.placeholder(dtype=tf.int32, shape=[None, None])
+        embedding = tf.get_variable('embedding', [VOCAB_SIZE, EMBED_DIM], dtype=tf.float32)
+        inputs = tf.gather(embedding, indices)
+        if conv1d:
+            model_class = CNNEmbed1D
+        else:
+            model_class = CNNEmbed
+            inputs = tf.transpose(tf.expand_dims(inputs, 3), [0, 2, 1, 3])
+        model_class(inputs, None, None, False, 1., None, EMBED_DIM, NUM_LAYERS, NUM_FILTERS, RESIDUAL_SKIP, k_max,
+                    FILTER_SIZE, 0., fused_gating, causal=causal)
+
+        variables = dict()
+        for var in tf.global_variables():
+            shape = var.get_shape().as_list()
+            if var.op.name.endswith('moving_variance'):
+                value = rng.uniform(0.5, 1.5, size=shape)
+            else:
+                value = rng.normal(0., 0.5, size=shape)
+            variables[var.op.name] = value.astype(np.float32)
+
+    # The last row of the embedding matrix is the zero vector used for padding.
+    variables['embedding'][-1] = 0.
+    save_checkpoint(variables, prefix)
+    return variables
+
+
+def random_batch(k_max, seed=1):
+    '''
+    Return a padded batch of random documents of different lengths, and its mask.
+    '''
+
+    rng = np.random.RandomState(seed)
+    min_doc_len = max(k_max, 1)
+    docs = RaggedArray.from_lists([rng.randint(0, VOCAB_SIZE - 1, size=rng.randint(min_doc_len, 15))
+                                   for _ in range(8)])
+    return pad_batch(docs, VOCAB_SIZE - 1, min_doc_len)
+
+
+@pytest.mark.parametrize('gating, fused_gating, k_max, conv1d, causal', LAYOUTS)
+def test_numpy_model_matches_tensorflow(tmpdir, monkeypatch, gating, fused_gating, k_max, conv1d, causal):
+    monkeypatch.setattr(models.CNNEmbed, 'USE_GATING', gating)
+    prefix = str(tmpdir.join('model'))
+    npz_path = str(tmpdir.join('model.npz'))
+    variables = random_checkpoint(prefix, fused_gating, k_max, conv1d, causal)
+    export_numpy_model(prefix, npz_path, RESIDUAL_SKIP, causal)
+
+    padded, mask = random_batch(k_max)
+    sess, model_output, indices_data_placeholder, doc_mask_placeholder = import_inference_graph(
+        build_inference_graph(variables, RESIDUAL_SKIP, batch_norm=True, causal=causal))
+    expected = sess.run(model_output, {indices_data_placeholder: padded, doc_mask_placeholder: mask})
+
+    # The padding, at the beginning of the documents, doesn't change the embeddings.
+    for i in range(len(padded)):
+        doc_len = int(mask[i].sum())
+        single = sess.run(model_output, {indices_data_placeholder: padded[i:i + 1, -doc_len:]})
+        assert np.allclose(single[0], expected[i], atol=1e-5)
+
+    numpy_model = CNNEmbedNumpy.load(npz_path)
+    assert np.allclose(numpy_model.embed(padded, mask), expected, atol=1e-5)
+
+    table_path = str(tmpdir.join('first_layer.npy'))
+    numpy_model.build_first_layer_table(table_path, np.float32)
+    table_model = CNNEmbedNumpy.load(npz_path, table_path=table_path)
+    assert np.allclose(table_model.embed(padded, mask), expected, atol=1e-5)
+
+    assert check_numpy_model(prefix, npz_path, RESIDUAL_SKIP, num_docs=8, max_doc_len=15, causal=causal) < \
+        CHECK_TOLERANCE
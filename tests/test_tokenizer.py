@@ -0,0 +1,44 @@
+import codecs
+import os
+
+import nltk
+import pytest
+
+import tokenizer
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tokenizer_conformance.txt')
+
+
+def punkt_available():
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        return False
+    return True
+
+
+pytestmark = pytest.mark.skipif(not punkt_available(), reason='The NLTK punkt models are not installed.')
+
+
+def read_fixture():
+    with codecs.open(FIXTURE_PATH, 'r', encoding='utf-8') as f:
+        return [line.rstrip(u'\n') for line in f]
+
+
+@pytest.mark.parametrize('text', read_fixture())
+def test_fast_tokenizer_matches_nltk(text):
+    tweet_tokenizer = nltk.tokenize.TweetTokenizer()
+    expected = nltk.word_tokenize(' '.join(tweet_tokenizer.tokenize(text)))
+    assert tokenizer.FastTokenizer().tokenize(text) == expected
+
+
+def test_fast_tokenizer_cache():
+    fast = tokenizer.FastTokenizer(max_cache_size=4)
+    texts = read_fixture()
+    first = [fast.tokenize(text) for text in texts]
+    assert len(fast.cache) <= 4
+    assert [fast.tokenize(text) for text in texts] == first
+
+
+def test_check_conformance():
+    assert tokenizer.check_conformance(read_fixture(), verbose=False) == 0
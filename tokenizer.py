@@ -0,0 +1,154 @@
+import argparse
+import codecs
+import os
+import time
+import nltk
+
+# Bump this whenever the output of a tokenizer changes, so that anything derived from its output can be invalidated.
+TOKENIZER_VERSION = 1
+TOKENIZERS = ['nltk', 'fast']
+# Tricky strings that the fast tokenizer must split like the NLTK one, used when no files are given.
+CONFORMANCE_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'data',
+                                   'tokenizer_conformance.txt')
+
+# One tokenizer of each kind per process, so the fast tokenizer's cache is shared by all callers.
+_TOKENIZER_INSTANCES = dict()
+
+
+class NltkTokenizer(object):
+    '''
+    The reference tokenizer: the TweetTokenizer followed by nltk.word_tokenize.
+    '''
+
+    def __init__(self):
+        self.tweet_tokenizer = nltk.tokenize.TweetTokenizer()
+
+    def tokenize(self, text):
+        '''
+        Return the tokens of text.
+        '''
+
+        return nltk.word_tokenize(' '.join(self.tweet_tokenizer.tokenize(text)))
+
+
+class FastTokenizer(object):
+    '''
+    Tokenizer that gives the same output as NltkTokenizer, but much faster.
+
+    The TweetTokenizer is a single regular expression and is kept as is. The output of word_tokenize on the joined
+    tweet tokens is the concatenation of its output on every tweet token, since its rules don't look across the spaces
+    between tokens once the tweet tokenizer has split the punctuation off. The only exception is a period at the end of
+    a sentence, and the tweet tokenizer already separates those. So the expensive part, sentence splitting followed by
+    the Treebank regular expressions, is skipped and each distinct tweet token is split once and cached.
+    '''
+
+    def __init__(self, max_cache_size=1000000):
+        '''
+        Args:
+            max_cache_size (int): Maximum number of distinct tweet tokens to cache. The cache is emptied when it's full.
+        '''
+
+        self.tweet_tokenizer = nltk.tokenize.TweetTokenizer()
+        self.word_tokenizer = getattr(nltk.tokenize, '_treebank_word_tokenizer', None) or \
+            nltk.tokenize.TreebankWordTokenizer()
+        self.max_cache_size = max_cache_size
+        self.cache = dict()
+
+    def split_token(self, token):
+        '''
+        Return the word_tokenize tokens of a single tweet token, as they would be in the middle of a sentence.
+        '''
+
+        tokens = self.cache.get(token)
+        if tokens is None:
+            # Surround the token by what follows and precedes it in the joined text, so rules that look at the
+            # neighbouring spaces behave the same. The trailing word is dropped again.
+            tokens = self.word_tokenizer.tokenize(' ' + token + ' x')
+            if tokens and tokens[-1] == 'x':
+                tokens = tuple(tokens[:-1])
+            else:
+                tokens = tuple(self.word_tokenizer.tokenize(' ' + token))
+
+            if len(self.cache) >= self.max_cache_size:
+                self.cache.clear()
+            self.cache[token] = tokens
+
+        return tokens
+
+    def tokenize(self, text):
+        '''
+        Return the tokens of text.
+        '''
+
+        tokens = []
+        for token in self.tweet_tokenizer.tokenize(text):
+            tokens.extend(self.split_token(token))
+        return tokens
+
+
+def get_tokenizer(name):
+    '''
+    Return the tokenizer with the given name, 'nltk' or 'fast'. Tokenizers are created once per process.
+    '''
+
+    if name not in TOKENIZERS:
+        raise ValueError('Unknown tokenizer \'{}\', should be one of {}.'.format(name, TOKENIZERS))
+
+    if name not in _TOKENIZER_INSTANCES:
+        _TOKENIZER_INSTANCES[name] = FastTokenizer() if name == 'fast' else NltkTokenizer()
+    return _TOKENIZER_INSTANCES[name]
+
+
+def check_conformance(texts, verbose=True):
+    '''
+    Compare the fast tokenizer against the NLTK tokenizer on a sample of documents, and print the mismatches and the
+    speedup.
+
+    Args:
+        texts (list): The documents, as unicode strings.
+        verbose (bool): If True, print every document where the outputs differ.
+
+    Returns:
+        num_mismatches (int): Number of documents where the outputs differ.
+    '''
+
+    reference = NltkTokenizer()
+    fast = FastTokenizer()
+
+    t1 = time.time()
+    expected = [reference.tokenize(text) for text in texts]
+    t2 = time.time()
+    actual = [fast.tokenize(text) for text in texts]
+    t3 = time.time()
+
+    num_mismatches = 0
+    for text, exp_tokens, act_tokens in zip(texts, expected, actual):
+        if exp_tokens != act_tokens:
+            num_mismatches += 1
+            if verbose:
+                print(u'Mismatch for: {}\n  nltk: {}\n  fast: {}'.format(text, exp_tokens, act_tokens))
+
+    print('{} of {} documents differ.'.format(num_mismatches, len(texts)))
+    print('nltk: {:.3f}s, fast: {:.3f}s, speedup: {:.1f}x'.format(t2 - t1, t3 - t2, (t2 - t1) / max(t3 - t2, 1e-9)))
+    return num_mismatches
+
+
+if __name__ == '__main__':
+
+    # Conformance check on sample corpora, one document per line, e.g. a GBW shard or the SentEval files.
+    parser = argparse.ArgumentParser(description='Compare the fast tokenizer against the NLTK tokenizers.')
+    parser.add_argument('files', nargs='*', default=[CONFORMANCE_FIXTURE],
+                        help='Text files, with one document per line. Defaults to the checked-in fixture.')
+    parser.add_argument('--max-docs', type=int, default=10000, help='Maximum number of documents to use per file.')
+    parser.add_argument('--encoding', type=str, default='utf-8', help='Encoding of the files.')
+    args = parser.parse_args()
+
+    total_mismatches = 0
+    for fn in args.files:
+        print('Checking {}'.format(fn))
+        with codecs.open(fn, 'r', encoding=args.encoding, errors='replace') as f:
+            texts = [line.strip() for _, line in zip(range(args.max_docs), f)]
+        total_mismatches += check_conformance(texts)
+
+    if total_mismatches:
+        raise SystemExit(1)
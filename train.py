@@ -1,14 +1,22 @@
 import argparse
+import itertools
 import tensorflow as tf
 from preprocess import *
 from util import *
 from models.CNNEmbed import CNNEmbed
+from models.CNNEmbed1D import CNNEmbed1D
+from models.optimizers import OPTIMIZERS, get_train_op
+from convert_checkpoint import checkpoint_fused_gating
 from models.SentimentClassifier import SentimentClassifier
+from tokenizer import TOKENIZERS
+from document_encoder import DocumentEncoder
+from data_cache import PreprocessingCache, get_data_cached, get_sup_data_cached
 import os
 
 RESTORE = False
 
-def training_pass(sess, train_op, data_inds, target_inds, batch_target, placeholders, keep_prob, is_training):
+def training_pass(sess, train_op, data_inds, target_inds, batch_target, placeholders, keep_prob, is_training,
+                  extra_feeds=None):
     """
     Do a training pass through a batch of the data.
 
@@ -21,6 +29,8 @@ def training_pass(sess, train_op, data_inds, target_inds, batch_target, placehol
         placeholders (list): Tensorflow placeholders used for training
         keep_prob (float): The keep prob, used for dropout
         is_training (bool): Bool which is True if model is training, False if performing inference.
+        extra_feeds (dict): Values of the other placeholders of the batch, e.g. the positions of the targets when
+            training on several targets per document.
 
     Returns:
         None
@@ -34,6 +44,8 @@ def training_pass(sess, train_op, data_inds, target_inds, batch_target, placehol
 
     feed_dict = {indices_data_placeholder: data_inds, indices_target_placeholder: target_inds,
                  target_place_holder: batch_target, kp_placeholder: keep_prob, is_training_placeholder: is_training}
+    if extra_feeds:
+        feed_dict.update(extra_feeds)
     sess.run([train_op], feed_dict)
 
 
@@ -55,12 +67,15 @@ def main(args):
     checkpoint_path = args.checkpoint_dir
     max_iter = args.max_iter
     gap_max = args.gap_max
+    num_targets = args.num_targets
+    shared_negatives = args.shared_negatives
     k_max = 0
 
     hyper_param_list = {'context_len': context_len, 'batch_size': batch_size, 'num_filters': num_filters,
                         'filter_size': filter_size, 'num_layers': num_layers, 'pos_words_num': pos_words_num,
                         'neg_words_num': neg_words_num, 'num_residual': num_residual, 'keep_prob': keep_prob,
-                        'l2_coeff': l2_coeff, 'gap_max': gap_max}
+                        'l2_coeff': l2_coeff, 'gap_max': gap_max, 'num_targets': num_targets,
+                        'shared_negatives': shared_negatives}
 
     if args.dataset == 'imdb':
         max_doc_len = 400
@@ -86,36 +101,12 @@ def main(args):
 
     classifier_max_iter = 500
 
-    vector_up_fn = os.path.join(args.cache_dir, 'vector_up.npy')
-    train_data_inds_fn = os.path.join(args.cache_dir, 'train_data_indices.npy')
-    train_labels_fn = os.path.join(args.cache_dir, 'train_labels.npy')
-    test_data_indices_fn = os.path.join(args.cache_dir, 'test_data_indices.npy')
-    test_labels_fn = os.path.join(args.cache_dir, 'test_labels.npy')
-
     ###########################################Preprocessing#########################################
-    if not args.preprocessing:
-        # Load the variables. This will generate an error if those files don't exist.
-        vector_up = np.load(vector_up_fn)
-        train_data_indices = np.load(train_data_inds_fn)
-        train_labels = np.load(train_labels_fn)
-        test_data_indices = np.load(test_data_indices_fn)
-        test_labels = np.load(test_labels_fn)
-    else:
-        # Preprocess data
-        if args.dataset == 'imdb':
-            vector_up, train_data_indices, train_labels, test_data_indices, test_labels = get_data_imdb(
-                data_dir, max_doc_len, fixed_length)
-        elif args.dataset == 'amazon':
-            vector_up, train_data_indices, train_labels, test_data_indices, test_labels = get_data_amazon(
-                data_dir, max_doc_len, fixed_length)
-        elif args.dataset == 'wikipedia':
-            vector_up, train_data_indices, train_labels, test_data_indices, test_labels = \
-                get_data_wikipedia(data_dir, max_doc_len, fixed_length)
-        np.save(vector_up_fn, vector_up)
-        np.save(train_data_inds_fn, train_data_indices)
-        np.save(train_labels_fn, train_labels)
-        np.save(test_data_indices_fn, test_data_indices)
-        np.save(test_labels_fn, test_labels)
+    # The cached files are keyed by the dataset and pre-processing parameters, and only rebuilt when those change.
+    cache = PreprocessingCache(args.cache_dir, max_size=int(args.cache_size * 2 ** 30))
+    data_key, vector_up, train_data_indices, train_labels, test_data_indices, test_labels = get_data_cached(
+        cache, args.dataset, data_dir, max_doc_len, fixed_length, args.num_workers, args.tokenizer,
+        rebuild=args.preprocessing)
 
     #Get the index of zero vector
     zero_vector_index = vector_up.shape[0] - 1
@@ -124,33 +115,59 @@ def main(args):
     # Build the model graphs
     print("all of our inputs follow NHWC: batch, height, width, channel.")
     train_data_indices_sup, test_data_indices_sup, \
-    train_labels_sup, test_labels_sup = get_sup_data(train_data_indices, test_data_indices, train_labels, test_labels,
-                 unlabeled_class, split_class, fixed_length, max_doc_len, args.num_classes, zero_vector_index)
+    train_labels_sup, test_labels_sup = get_sup_data_cached(cache, data_key, train_data_indices, test_data_indices,
+                                                            train_labels, test_labels, unlabeled_class, split_class,
+                                                            fixed_length, max_doc_len, args.num_classes,
+                                                            zero_vector_index, rebuild=args.preprocessing)
+
+    restore_prefix = os.path.join(checkpoint_path, 'model-40')
+    # Build the layout of the restored checkpoint, which may be from before fused gating.
+    fused_gating = checkpoint_fused_gating(restore_prefix) if RESTORE else True
 
     ###########################################Embedding learning Graph#########################################
     doc2vec_graph = tf.Graph()
     with doc2vec_graph.as_default(), tf.device("/gpu:0"):
         indices_data_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, None])
-        indices_target_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, pos_words_num + neg_words_num])
+        # With num_targets, the targets have an extra (num_targets) axis after the batch. With shared negatives,
+        # they are only the words to predict, and the negatives are one pool for the whole batch.
+        target_width = pos_words_num if shared_negatives else pos_words_num + neg_words_num
+        target_shape = [None, None, target_width] if num_targets else [None, target_width]
+        indices_target_placeholder = tf.placeholder(dtype=tf.int32, shape=target_shape)
+        target_positions_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, None]) if num_targets else None
+        negatives_placeholder = tf.placeholder(dtype=tf.int32, shape=[None]) if shared_negatives else None
+        negative_mask_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, None]) if shared_negatives else None
 
         embedding = tf.get_variable("embedding", [vector_up.shape[0], embed_dim], dtype=tf.float32, trainable=True)
         assign_embedding_op = tf.assign(embedding, vector_up)
+        # 1 for words and 0 for padding. Only fed when embedding padded batches of documents with different lengths.
+        doc_mask_placeholder = tf.placeholder_with_default(tf.ones_like(indices_data_placeholder, dtype=tf.float32),
+                                                           shape=[None, None], name='doc_mask')
         inputs = tf.gather(embedding, indices_data_placeholder)
-        inputs = tf.expand_dims(inputs, 3)
-        inputs = tf.transpose(inputs, [0, 2, 1, 3])
-
         targets_embeds = tf.gather(embedding, indices_target_placeholder)
-        targets_embeds = tf.expand_dims(targets_embeds, 3)
-        targets_embeds = tf.transpose(targets_embeds, [0, 2, 1, 3])
-
-        target_place_holder = tf.placeholder(tf.float32, [None, pos_words_num + neg_words_num])
+        negative_embeds = tf.gather(embedding, negatives_placeholder) if shared_negatives else None
+        if args.conv1d:
+            # CNNEmbed1D takes the gathered (batch, doc_len, embed_dim) embeddings as they are.
+            model_class = CNNEmbed1D
+        else:
+            model_class = CNNEmbed
+            inputs = tf.expand_dims(inputs, 3)
+            inputs = tf.transpose(inputs, [0, 2, 1, 3])
+            if not num_targets:
+                targets_embeds = tf.expand_dims(targets_embeds, 3)
+                targets_embeds = tf.transpose(targets_embeds, [0, 2, 1, 3])
+
+        target_place_holder = tf.placeholder(tf.float32, target_shape)
         # Placeholder for training
         keep_prob_placeholder = tf.placeholder(dtype=tf.float32, name='dropout_rate')
         is_training_placeholder = tf.placeholder(dtype=tf.bool, name='training_boolean')
 
         # build model
-        _docCNN = CNNEmbed(inputs, targets_embeds, target_place_holder, is_training_placeholder, keep_prob_placeholder,
-                           max_doc_len, embed_dim, num_layers, num_filters, num_residual, k_max, filter_size, l2_coeff)
+        _docCNN = model_class(inputs, targets_embeds, target_place_holder, is_training_placeholder,
+                              keep_prob_placeholder, max_doc_len, embed_dim, num_layers, num_filters, num_residual,
+                              k_max, filter_size, l2_coeff, fused_gating, mask=doc_mask_placeholder,
+                              causal=bool(num_targets), target_positions=target_positions_placeholder,
+                              negative_embeddings=negative_embeds, negative_mask=negative_mask_placeholder,
+                              negative_weight=neg_words_num / float(max(shared_negatives, 1)))
 
         global_step = tf.Variable(0, trainable=False)
 
@@ -163,9 +180,7 @@ def main(args):
         # setting the learning rate
         with tf.control_dependencies(update_ops):
             learning_rate_t = tf.train.exponential_decay(learning_rate, global_step, 1, 0.99)
-            optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate_t)
-            grads_and_vars = optimizer.compute_gradients(loss)
-            train_op = optimizer.apply_gradients(grads_and_vars)
+            train_op = get_train_op(loss, learning_rate_t, args.optimizer)
 
         session_conf = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
         sess_docCNN = tf.Session(config=session_conf)
@@ -203,7 +218,14 @@ def main(args):
     sess_docCNN.run(assign_embedding_op)
     overall_highest = 0
 
-    batch_target = np.hstack((np.full((batch_size, pos_words_num), 1), np.full((batch_size, neg_words_num), 0)))
+    batch_target = np.hstack((np.full((batch_size, pos_words_num), 1),
+                              np.full((batch_size, 0 if shared_negatives else neg_words_num), 0)))
+    if num_targets:
+        batch_target = np.repeat(batch_target[:, np.newaxis], num_targets, axis=1)
+    # Embeds the supervised data for the classifier in large, masked batches.
+    encoder = DocumentEncoder(sess_docCNN, test_obj_cal_output, indices_data_placeholder, keep_prob_placeholder,
+                              is_training_placeholder, doc_mask_placeholder, zero_vector_index,
+                              min_doc_len=max(k_max, 1))
 
     # Batch generator
     if gap_max is not None:
@@ -211,8 +233,16 @@ def main(args):
     else:
         forward_gap = None
     # vector_up.shape[0] - 1, because last element is zero vector
+    # Without a fixed input length, batches can be bucketed by context length and padded less.
+    num_buckets = None if fixed_length else args.num_buckets
     batch_generator = BatchGenerator(train_data_indices, pos_words_num, neg_words_num, max_doc_len, context_len,
-                                     vector_up.shape[0] - 1, batch_size, vector_up.shape[0] - 1, gap=forward_gap)
+                                     vector_up.shape[0] - 1, batch_size, vector_up.shape[0] - 1, gap=forward_gap,
+                                     num_buckets=num_buckets, min_doc_len=max(k_max, 1), num_targets=num_targets,
+                                     shared_negatives=shared_negatives)
+    # Sample the batches of all epochs on background threads, so sampling overlaps with the training steps.
+    epoch_tasks = itertools.chain.from_iterable(batch_generator.epoch_tasks() for _ in range(max_iter))
+    prefetcher = BatchPrefetcher(batch_generator.generate_batch, epoch_tasks, args.prefetch_workers,
+                                 args.prefetch_depth)
 
     # dict to store the accuracy values.
     if args.accuracy_file:
@@ -225,7 +255,7 @@ def main(args):
 
     if RESTORE:
         # TODO: delete this global variable when making the code open source
-        saver.restore(sess_docCNN, os.path.join(checkpoint_path, 'model-40'))
+        saver.restore(sess_docCNN, restore_prefix)
 
     itr = 0
     # Training Loop
@@ -234,21 +264,29 @@ def main(args):
         batch_per_epoch = data_size / batch_size
         print('Number of batches: {}'.format(batch_per_epoch))
         sess_docCNN.run(global_step.assign(itr + 1))
-        batch_generator.generate_training_batches()
         train_times = []
         placeholders = [indices_data_placeholder, indices_target_placeholder, target_place_holder,
                         keep_prob_placeholder, is_training_placeholder]
         for i in range(batch_per_epoch):
             t1 = time.time()
-            ret_val = batch_generator.get_data()
-            data_inds, target_inds = ret_val
-            training_pass(sess_docCNN, train_op, data_inds, target_inds, batch_target, placeholders, keep_prob, True)
+            # With num_targets, the batches also have the positions of the targets, and with shared negatives they
+            # end with the pool of negatives and its mask.
+            batch = next(prefetcher)
+            data_inds, target_inds = batch[:2]
+            extra_feeds = dict()
+            if num_targets:
+                extra_feeds[target_positions_placeholder] = batch[2]
+            if shared_negatives:
+                extra_feeds[negatives_placeholder], extra_feeds[negative_mask_placeholder] = batch[-2:]
+            training_pass(sess_docCNN, train_op, data_inds, target_inds, batch_target, placeholders, keep_prob, True,
+                          extra_feeds)
             train_times.append(time.time() - t1)
 
             if i % 100 == 0:
                 feed_dict = {indices_data_placeholder: data_inds, indices_target_placeholder: target_inds,
                              target_place_holder: batch_target, keep_prob_placeholder: 1.,
                              is_training_placeholder: False}
+                feed_dict.update(extra_feeds)
                 loss_out = sess_docCNN.run([loss], feed_dict)
                 print('Iteration: {}, batch: {}, loss: {}'.format(itr, i, loss_out))
                 print('Average train time: {:.5f}'.format(np.mean(train_times)))
@@ -262,35 +300,15 @@ def main(args):
             print('training a new classifier')
             # Forward pass to get the embeddings
             sess_classifier.run(train_init_op_classifier)
-            train_data_size = len(train_data_indices_sup)
-            test_data_size = len(test_data_indices_sup)
-
-            train_data_doc2vec_sup = []
-            test_data_doc2vec_sup = []
-
-            for i in range(train_data_size):
-                if len(train_data_indices_sup[i]) < k_max:
-                    continue
-                classifier_train_inds = np.expand_dims(train_data_indices_sup[i], axis=0)
-
-                feed_dict_train = {indices_data_placeholder: classifier_train_inds, keep_prob_placeholder: 1.,
-                                   is_training_placeholder: False}
-                train_doc2vec = sess_docCNN.run(test_obj_cal_output, feed_dict_train)
-                train_data_doc2vec_sup.append(train_doc2vec)
-
-            train_data_doc2vec_sup = np.array(train_data_doc2vec_sup)
-
-            for i in range(test_data_size):
-                if len(test_data_indices_sup[i]) < k_max:
-                    continue
-                classifier_test_data = np.expand_dims(test_data_indices_sup[i], axis=0)
-
-                feed_dict_test = {indices_data_placeholder: classifier_test_data, keep_prob_placeholder: 1.,
-                                  is_training_placeholder: False}
-                test_doc2vec = sess_docCNN.run(test_obj_cal_output, feed_dict_test)
-                test_data_doc2vec_sup.append(test_doc2vec)
-
-            test_data_doc2vec_sup = np.array(test_data_doc2vec_sup)
+            # Documents shorter than k can't be k-max pooled, so they are left out.
+            if fixed_length:
+                train_data_doc2vec_sup = encoder.encode_batch(train_data_indices_sup)
+                test_data_doc2vec_sup = encoder.encode_batch(test_data_indices_sup)
+            else:
+                train_data_doc2vec_sup = encoder.encode_batch(
+                    train_data_indices_sup[train_data_indices_sup.lengths() >= k_max])
+                test_data_doc2vec_sup = encoder.encode_batch(
+                    test_data_indices_sup[test_data_indices_sup.lengths() >= k_max])
 
             acc_test_best = 0
 
@@ -350,6 +368,7 @@ def main(args):
             saver.save(sess_docCNN, os.path.join(checkpoint_path, 'model'), global_step=itr)
         itr += 1
 
+    prefetcher.close()
     if args.accuracy_file:
         accs.append((hyper_param_list, acc_values))
         with open(args.accuracy_file, 'w') as f:
@@ -375,9 +394,19 @@ if __name__ == '__main__':
     parser.add_argument('--dropout-keep-prob', type=float, default=0.8, help='The dropout keep prob.')
     parser.add_argument('--l2-coeff', type=float, default=0., help='The weight decay coefficient (l2).')
     parser.add_argument('--preprocessing', action='store_true',
-                        help='If true, redo the pre-processing. Otherwise, load the saved pre-processed files.')
+                        help='If true, redo the pre-processing and overwrite the cached files. Otherwise, cached files '
+                             'made with the same dataset and parameters are reused.')
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='Number of processes used to tokenize the data when pre-processing. Defaults to all '
+                             'cores.')
+    parser.add_argument('--tokenizer', type=str, default='nltk', choices=TOKENIZERS,
+                        help='The tokenizer used when pre-processing. \'fast\' gives the same tokens as \'nltk\' '
+                             '(the TweetTokenizer followed by nltk.word_tokenize), see tokenizer.py.')
     parser.add_argument('--cache-dir', type=str, default='./cache',
                         help='The directory containing the saved pre-processed and embedding files')
+    parser.add_argument('--cache-size', type=float, default=20.,
+                        help='Size budget of the cache directory in GB. The least recently used pre-processed files '
+                             'are removed beyond it.')
     parser.add_argument('--dataset', type=str, required=True,
                         help='The dataset to use, either \'amazon\', \'imdb\', or \'wikipedia\'.')
     parser.add_argument('--data-dir', type=str, required=True, help='Directory containing the data.')
@@ -385,10 +414,32 @@ if __name__ == '__main__':
     parser.add_argument('--model', type=str, default='CNN_pad',
                         help='The model to use, which is \'CNN_pad\', \'CNN_pool\' or \'CNN_topk\'')
     parser.add_argument('--embed-dim', type=int, default=300, help='The dimensionality of the word embeddings.')
+    parser.add_argument('--conv1d', action='store_true',
+                        help='Use CNNEmbed1D, built on 1D convolutions over (batch, doc_len, embed_dim) inputs, '
+                             'instead of CNNEmbed. Convert CNNEmbed checkpoints with convert_checkpoint.py '
+                             '--conversion to_conv1d.')
+    parser.add_argument('--optimizer', type=str, default='lazy_adam', choices=OPTIMIZERS,
+                        help='\'lazy_adam\' only updates the rows of the word embeddings used by the batch, and their '
+                             'Adam moments. \'adam\' updates the whole embedding matrix on every step.')
     parser.add_argument('--learning-rate', type=float, default=0.0003, help='The learning rate.')
     parser.add_argument('--top-k', type=int, default=0, help='The value of k when performing k-max pooling')
     parser.add_argument('--max-iter', type=int, default=100, help='The maximum number of training iterations.')
     parser.add_argument('--accuracy-file', type=str, help='File to store the accuracy values.')
+    parser.add_argument('--num-buckets', type=int, default=0,
+                        help='Number of context length buckets for CNN_pool and CNN_topk. Each batch is only padded to '
+                             'its bucket length. If 0, every batch is padded to the maximum document length.')
+    parser.add_argument('--num-targets', type=int, default=0,
+                        help='Train a causal model, with causal convolutions and a cumulative max pooling, on this '
+                             'many (prefix, next words) targets per document, all scored from one pass over the '
+                             'document. Only for max pooling (CNN_pad and CNN_pool). If 0, one target per document.')
+    parser.add_argument('--shared-negatives', type=int, default=0,
+                        help='Score every document of a batch against one shared pool of this many negative samples, '
+                             'masked against each document\'s context, with one matmul. The pool weighs as much as '
+                             '--num-negative-words private negatives. If 0, each document gets its own negatives.')
+    parser.add_argument('--prefetch-depth', type=int, default=10,
+                        help='Number of training batches to prepare ahead of the training step.')
+    parser.add_argument('--prefetch-workers', type=int, default=1,
+                        help='Number of background threads preparing training batches.')
 
     args = parser.parse_args()
     main(args)
@@ -3,6 +3,11 @@ import tensorflow as tf
 from preprocess import *
 from util import *
 from models.CNNEmbed import CNNEmbed
+from models.CNNEmbed1D import CNNEmbed1D
+from models.optimizers import OPTIMIZERS, get_train_op
+from convert_checkpoint import checkpoint_fused_gating
+from tokenizer import TOKENIZERS
+from document_encoder import DocumentEncoder, text_to_indices
 from sklearn.linear_model import LogisticRegression
 from sklearn.utils import shuffle
 import os
@@ -17,33 +22,13 @@ ZERO_IND = 483018
 VOCAB_SIZE = 483019
 
 def encode_text(sess, model_output, indices_data_placeholder, keep_prob_placeholder, is_training_placeholder,
-                word_to_index, text, doc_len=None):
+                word_to_index, text, doc_len=None, tokenizer='nltk'):
     """
-    Encode the text, which is just a sentence, as a vector using the CNN embedding model and return the output.
+    Encode the text, which is just a sentence, as a vector using the CNN embedding model and return the output. To
+    encode many sentences, DocumentEncoder.encode_batch is much faster.
     """
 
-    tknzr = nltk.tokenize.TweetTokenizer()
-    tokens = nltk.word_tokenize(' '.join(tknzr.tokenize(text)))
-    tokens = [word.lower() for word in tokens]
-    line_tok = []
-    for word in tokens:
-        if word in word_to_index:
-            line_tok.append(word_to_index[word])
-        else:
-            line_tok.append(word_to_index['<unk>'])
-
-    if len(line_tok) < 5:
-        # pad with zeros
-        line_tok = [ZERO_IND for _ in range(5 - len(line_tok))] + line_tok
-
-    if doc_len is not None:
-        # pad or truncate to that length
-        if len(line_tok) > doc_len:
-            line_tok = line_tok[:doc_len]
-        elif len(line_tok) < doc_len:
-            line_tok = [ZERO_IND for _ in range(doc_len - len(line_tok))] + line_tok
-
-    line_tok = np.array(line_tok)
+    line_tok = text_to_indices(text, word_to_index, ZERO_IND, tokenizer, doc_len)
     line_tok = np.reshape(line_tok, (1, len(line_tok)))
 
     # Feed it through model
@@ -52,33 +37,36 @@ def encode_text(sess, model_output, indices_data_placeholder, keep_prob_placehol
     return encoding[0]
 
 
-def perform_trec_exp(sess, model_output, indices_data_placeholder, keep_prob_placeholder,
-                     is_training_placeholder, word_to_index):
+def perform_trec_exp(encoder):
     """
     Perform a classification experiments and output the results. For now, just perform classification on the TREC data,
     since there is a defined test/train split.
+
+    Args:
+        encoder (DocumentEncoder): Encoder for the trained model, with the GBW vocabulary.
+
+    Returns:
+        accuracy (float): The accuracy on the TREC test set.
     """
 
-    X_train, y_train, X_test, y_test = [], [], [], []
+    train_text, y_train, test_text, y_test = [], [], [], []
     tgt2idx = {'ABBR': 0, 'DESC': 1, 'ENTY': 2, 'HUM': 3, 'LOC': 4, 'NUM': 5}
 
     with codecs.open(os.path.join(CLASSIFICATION_DIR, 'train_5500.label'), 'r', encoding='utf-8', errors='replace') as f:
         for line in f:
             line = line.strip().split(':')
             y_train.append(tgt2idx[line[0]])
-            X_train.append(encode_text(sess, model_output, indices_data_placeholder, keep_prob_placeholder,
-                                       is_training_placeholder, word_to_index, line[1]))
+            train_text.append(line[1])
 
     with codecs.open(os.path.join(CLASSIFICATION_DIR, 'TREC_10.label'), 'r', encoding='utf-8', errors='replace') as f:
         for line in f:
             line = line.strip().split(':')
             y_test.append(tgt2idx[line[0]])
-            X_test.append(encode_text(sess, model_output, indices_data_placeholder, keep_prob_placeholder,
-                                      is_training_placeholder, word_to_index, line[1]))
+            test_text.append(line[1])
 
-    X_train = np.array(X_train)
+    X_train = encoder.encode_batch(train_text)
     y_train = np.array(y_train)
-    X_test = np.array(X_test)
+    X_test = encoder.encode_batch(test_text)
     y_test = np.array(y_test)
     X_train, y_train = shuffle(X_train, y_train)
 
@@ -86,10 +74,113 @@ def perform_trec_exp(sess, model_output, indices_data_placeholder, keep_prob_pla
     clf = LogisticRegression(C=128)
     clf.fit(X_train, y_train)
 
-    print('TREC classification accuracy: {}'.format(str(clf.score(X_test, y_test))))
+    accuracy = clf.score(X_test, y_test)
+    print('TREC classification accuracy: {}'.format(str(accuracy)))
+    return accuracy
+
+
+def sample_contexts(train_indices, doc_inds, doc_len, pos_words_num=0):
+    """
+    Sample one context of doc_len words from each document, leaving room for pos_words_num words after it.
+
+    Args:
+        train_indices (RaggedArray): The documents of the current file.
+        doc_inds (numpy.ndarray): Indices of the documents. Documents that are too short are skipped.
+        doc_len (int): Length of the contexts.
+        pos_words_num (int): Number of words needed after each context.
+
+    Returns:
+        data_inds (numpy.ndarray): The contexts, as an array of indices.
+        starts (numpy.ndarray): Offset of each sampled document in train_indices.tokens.
+        end_inds (numpy.ndarray): Position of the end of each context in its document.
+    """
+
+    lengths = train_indices.lengths()[doc_inds]
+    doc_inds = doc_inds[lengths >= doc_len + pos_words_num]
+    lengths = lengths[lengths >= doc_len + pos_words_num]
+    starts = train_indices.offsets[:-1][doc_inds]
+
+    # The context ends uniformly in range(doc_len, len(elem) - pos_words_num), or at doc_len if that's empty.
+    num_end_inds = np.maximum(lengths - pos_words_num - doc_len, 1)
+    end_inds = doc_len + (np.random.random_sample(len(doc_inds)) * num_end_inds).astype(np.int64)
+
+    data_inds = train_indices.tokens[(starts + end_inds - doc_len)[:, None] + np.arange(doc_len)]
+    return data_inds, starts, end_inds
+
+
+def generate_super_batch(train_indices, doc_inds, doc_len, pos_words_num, neg_words_num, shared_negatives=0):
+    """
+    Sample the training data for a super batch, where every context has the same length.
+
+    Args:
+        train_indices (RaggedArray): The documents of the current file.
+        doc_inds (numpy.ndarray): Indices of the documents in the super batch. Documents that are too short are skipped.
+        doc_len (int): Length of the contexts.
+        pos_words_num (int): Number of next words to predict.
+        neg_words_num (int): Number of negative samples.
+        shared_negatives (int): If not 0, the size of a pool of negative samples shared by the whole super batch,
+            drawn instead of neg_words_num negative samples per context.
+
+    Returns:
+        data_inds (numpy.ndarray): The contexts, as an array of indices.
+        target_inds (numpy.ndarray): The next words to predict, followed by the negative samples.
+        negative_inds, negative_mask (numpy.ndarray): Only with shared_negatives, the pool of negative samples and its
+            (num_docs x shared_negatives) mask, see sample_shared_negatives.
+    """
+
+    tokens = train_indices.tokens
+    data_inds, starts, end_inds = sample_contexts(train_indices, doc_inds, doc_len, pos_words_num)
+    pos_targets = tokens[(starts + end_inds)[:, None] + np.arange(pos_words_num)]
+    neg_targets, _ = sample_negatives(tokens, starts, end_inds + pos_words_num,
+                                      0 if shared_negatives else neg_words_num, VOCAB_SIZE)
+
+    super_batch = (data_inds, np.concatenate((pos_targets, neg_targets), axis=1))
+    if shared_negatives:
+        super_batch += sample_shared_negatives(tokens, starts, end_inds + pos_words_num, shared_negatives, VOCAB_SIZE)
+    return super_batch
+
+
+def generate_multi_target_super_batch(train_indices, doc_inds, doc_len, pos_words_num, neg_words_num, context_len,
+                                      num_targets, shared_negatives=0):
+    """
+    Sample the training data for a super batch of a causal model, with several targets per context. Each target is a
+    prefix of the context, of at least context_len words, and the next words after it.
+
+    Args:
+        train_indices (RaggedArray): The documents of the current file.
+        doc_inds (numpy.ndarray): Indices of the documents in the super batch. Documents that are too short are skipped.
+        doc_len (int): Length of the contexts, at least context_len.
+        pos_words_num (int): Number of next words to predict.
+        neg_words_num (int): Number of negative samples.
+        context_len (int): Length of the shortest prefix.
+        num_targets (int): Number of targets per context.
+        shared_negatives (int): If not 0, the size of a pool of negative samples shared by the whole super batch.
+
+    Returns:
+        data_inds (numpy.ndarray): The contexts, as an array of indices.
+        target_inds (numpy.ndarray): (num_docs x num_targets x (pos_words_num + neg_words_num)) array of the next words
+            to predict, followed by the negative samples.
+        target_positions (numpy.ndarray): (num_docs x num_targets) position of the last word of each prefix.
+        negative_inds, negative_mask (numpy.ndarray): Only with shared_negatives, as for generate_super_batch.
+    """
+
+    data_inds, starts, end_inds = sample_contexts(train_indices, doc_inds, doc_len, pos_words_num)
+    target_positions = np.random.randint(context_len - 1, doc_len, size=(len(data_inds), num_targets))
+    # The words to predict follow the prefix, and are in the document since the context leaves room for them.
+    t_inds = (end_inds - doc_len)[:, None] + target_positions + 1
+    target_inds, _ = sample_multi_targets(train_indices.tokens, starts, t_inds, pos_words_num,
+                                          0 if shared_negatives else neg_words_num, VOCAB_SIZE)
+
+    super_batch = (data_inds, target_inds, target_positions.astype(np.int32))
+    if shared_negatives:
+        # Masked against the whole context and the words after it, which covers every target.
+        super_batch += sample_shared_negatives(train_indices.tokens, starts, end_inds + pos_words_num,
+                                               shared_negatives, VOCAB_SIZE)
+    return super_batch
 
 
-def training_pass(sess, train_op, data_inds, target_inds, batch_target, placeholders, keep_prob, is_training):
+def training_pass(sess, train_op, data_inds, target_inds, batch_target, placeholders, keep_prob, is_training,
+                  extra_feeds=None):
     """
     Do a training pass through a batch of the data.
 
@@ -102,6 +193,8 @@ def training_pass(sess, train_op, data_inds, target_inds, batch_target, placehol
         placeholders (list): Tensorflow placeholders used for training
         keep_prob (float): The keep prob, used for dropout
         is_training (bool): Bool which is True if model is training, False if performing inference.
+        extra_feeds (dict): Values of the other placeholders of the batch, e.g. the positions of the targets when
+            training on several targets per document.
 
     Returns:
         None
@@ -115,6 +208,8 @@ def training_pass(sess, train_op, data_inds, target_inds, batch_target, placehol
 
     feed_dict = {indices_data_placeholder: data_inds, indices_target_placeholder: target_inds,
                  target_place_holder: batch_target, kp_placeholder: keep_prob, is_training_placeholder: is_training}
+    if extra_feeds:
+        feed_dict.update(extra_feeds)
     sess.run([train_op], feed_dict)
 
 
@@ -135,11 +230,15 @@ def main(args):
     checkpoint_path = args.checkpoint_dir
     max_iter = args.max_iter
     k_max = args.top_k
+    num_targets = args.num_targets
+    shared_negatives = args.shared_negatives
+    ranks = [int(rank) for rank in args.ranks.split(',')] if args.ranks else None
 
     hyper_param_list = {'context_len': context_len, 'batch_size': batch_size, 'num_filters': num_filters,
                         'filter_size': filter_size, 'num_layers': num_layers, 'pos_words_num': pos_words_num,
                         'neg_words_num': neg_words_num, 'num_residual': num_residual, 'keep_prob': keep_prob,
-                        'l2_coeff': l2_coeff}
+                        'l2_coeff': l2_coeff, 'num_targets': num_targets,
+                        'shared_negatives': shared_negatives}
 
     max_doc_len = 50
     embed_dim = 300
@@ -147,32 +246,57 @@ def main(args):
     with open(os.path.join(args.cache_dir, 'word_to_index.pkl'), 'r') as f:
         word_to_index = cPickle.load(f)
 
-    indices_files = glob.glob(os.path.join(data_dir, 'gbw/tokenized/*'))
+    indices_files = [fn[:-len(RAGGED_TOKENS_SUFFIX)] for fn in
+                     glob.glob(os.path.join(data_dir, 'gbw/tokenized/*' + RAGGED_TOKENS_SUFFIX))]
+
+    restore_prefix = os.path.join(checkpoint_path, 'gbw_model_latest')
+    # Build the layout of the restored checkpoint, which may be from before fused gating.
+    fused_gating = checkpoint_fused_gating(restore_prefix) if RESTORE else True
 
     ###########################################Embedding learning Graph#########################################
     doc2vec_graph = tf.Graph()
     with doc2vec_graph.as_default(), tf.device("/gpu:0"):
         indices_data_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, None])
-        indices_target_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, pos_words_num + neg_words_num])
+        # With num_targets, the targets have an extra (num_targets) axis after the batch. With shared negatives,
+        # they are only the words to predict, and the negatives are one pool for the whole batch.
+        target_width = pos_words_num if shared_negatives else pos_words_num + neg_words_num
+        target_shape = [None, None, target_width] if num_targets else [None, target_width]
+        indices_target_placeholder = tf.placeholder(dtype=tf.int32, shape=target_shape)
+        target_positions_placeholder = tf.placeholder(dtype=tf.int32, shape=[None, None]) if num_targets else None
+        negatives_placeholder = tf.placeholder(dtype=tf.int32, shape=[None]) if shared_negatives else None
+        negative_mask_placeholder = tf.placeholder(dtype=tf.float32, shape=[None, None]) if shared_negatives else None
 
         embedding = tf.get_variable("embedding", [vector_up.shape[0], embed_dim], dtype=tf.float32, trainable=True)
         assign_embedding_op = tf.assign(embedding, vector_up)
+        # 1 for words and 0 for padding. Only fed when embedding padded batches of documents with different lengths.
+        doc_mask_placeholder = tf.placeholder_with_default(tf.ones_like(indices_data_placeholder, dtype=tf.float32),
+                                                           shape=[None, None], name='doc_mask')
         inputs = tf.gather(embedding, indices_data_placeholder)
-        inputs = tf.expand_dims(inputs, 3)
-        inputs = tf.transpose(inputs, [0, 2, 1, 3])
-
         targets_embeds = tf.gather(embedding, indices_target_placeholder)
-        targets_embeds = tf.expand_dims(targets_embeds, 3)
-        targets_embeds = tf.transpose(targets_embeds, [0, 2, 1, 3])
-
-        target_place_holder = tf.placeholder(tf.float32, [None, pos_words_num + neg_words_num])
+        negative_embeds = tf.gather(embedding, negatives_placeholder) if shared_negatives else None
+        if args.conv1d:
+            # CNNEmbed1D takes the gathered (batch, doc_len, embed_dim) embeddings as they are.
+            model_class = CNNEmbed1D
+        else:
+            model_class = CNNEmbed
+            inputs = tf.expand_dims(inputs, 3)
+            inputs = tf.transpose(inputs, [0, 2, 1, 3])
+            if not num_targets:
+                targets_embeds = tf.expand_dims(targets_embeds, 3)
+                targets_embeds = tf.transpose(targets_embeds, [0, 2, 1, 3])
+
+        target_place_holder = tf.placeholder(tf.float32, target_shape)
         # Placeholder for training
         keep_prob_placeholder = tf.placeholder(dtype=tf.float32, name='dropout_rate')
         is_training_placeholder = tf.placeholder(dtype=tf.bool, name='training_boolean')
 
         # build model
-        _docCNN = CNNEmbed(inputs, targets_embeds, target_place_holder, is_training_placeholder, keep_prob_placeholder,
-                           max_doc_len, embed_dim, num_layers, num_filters, num_residual, k_max, filter_size, l2_coeff)
+        _docCNN = model_class(inputs, targets_embeds, target_place_holder, is_training_placeholder,
+                              keep_prob_placeholder, max_doc_len, embed_dim, num_layers, num_filters, num_residual,
+                              k_max, filter_size, l2_coeff, fused_gating, mask=doc_mask_placeholder, ranks=ranks,
+                              causal=bool(num_targets), target_positions=target_positions_placeholder,
+                              negative_embeddings=negative_embeds, negative_mask=negative_mask_placeholder,
+                              negative_weight=neg_words_num / float(max(shared_negatives, 1)))
 
         global_step = tf.Variable(0, trainable=False)
 
@@ -185,9 +309,7 @@ def main(args):
         # setting the learning rate
         with tf.control_dependencies(update_ops):
             learning_rate_t = tf.train.exponential_decay(learning_rate, global_step, 1, 0.99)
-            optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate_t)
-            grads_and_vars = optimizer.compute_gradients(loss)
-            train_op = optimizer.apply_gradients(grads_and_vars)
+            train_op = get_train_op(loss, learning_rate_t, args.optimizer)
 
         session_conf = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
         sess_docCNN = tf.Session(config=session_conf)
@@ -199,7 +321,7 @@ def main(args):
 
     use_restored_files = False
     if RESTORE:
-        saver.restore(sess_docCNN, os.path.join(checkpoint_path, 'gbw_model_latest'))
+        saver.restore(sess_docCNN, restore_prefix)
         with open('./gbw_cache/files_order.pkl', 'r') as f:
             indices_files = cPickle.load(f)
             use_restored_files = True
@@ -207,7 +329,14 @@ def main(args):
         sess_docCNN.run(train_init_op_docCNN)
         sess_docCNN.run(assign_embedding_op)
 
-    batch_target = np.hstack((np.full((batch_size, pos_words_num), 1), np.full((batch_size, neg_words_num), 0)))
+    # Embeds the classification data in large, masked batches.
+    encoder = DocumentEncoder(sess_docCNN, model_output, indices_data_placeholder, keep_prob_placeholder,
+                              is_training_placeholder, doc_mask_placeholder, ZERO_IND, word_to_index, args.tokenizer)
+
+    batch_target = np.hstack((np.full((batch_size, pos_words_num), 1),
+                              np.full((batch_size, 0 if shared_negatives else neg_words_num), 0)))
+    if num_targets:
+        batch_target = np.repeat(batch_target[:, np.newaxis], num_targets, axis=1)
     # doc_lengths = [15, 24, 32, 41, 47]
     doc_lengths = range(context_len, 50)
     super_batch_size = 1000  # use the same doc len in a super batch
@@ -228,61 +357,37 @@ def main(args):
 
         while file_num < len(indices_files):
             tokenized_file = indices_files[file_num]
-            train_indices = np.load(tokenized_file)
-            np.random.shuffle(train_indices)
-
-            # we randomize the document lengths, so the model sees both long and short docs/sentences.
-            doc_len = np.random.choice(doc_lengths)
-            ind1 = 0
-            ind2 = super_batch_size
-            while ind1 < len(train_indices):
-                curr_train_inds = train_indices[ind1:ind2]
-                all_data = []
-                pos_targets = []
-                neg_targets = []
-                for j in range(len(curr_train_inds)):
-                    elem = curr_train_inds[j]
-                    if len(elem) >= doc_len + pos_words_num:
-                        end_inds = range(doc_len, len(elem) - pos_words_num)
-                        if len(end_inds) > 0:
-                            end_ind = np.random.choice(end_inds)
-                        else:
-                            end_ind = doc_len
-
-                        all_data.append(elem[(end_ind-doc_len):end_ind])
-                        pos_targets.append(elem[end_ind:end_ind+pos_words_num])
-                        neg_samples = np.random.choice(VOCAB_SIZE, size=neg_words_num, replace=False)
-                        context_inds = set(elem[:end_ind+pos_words_num])
-                        while context_inds.intersection(set(neg_samples)):
-                            neg_samples = np.random.choice(VOCAB_SIZE, size=neg_words_num, replace=False)
-
-                        neg_targets.append(neg_samples)
-
-                    if len(all_data) == batch_size or (j == len(curr_train_inds) - 1 and len(all_data) > 0):
-                        data_inds = np.array(all_data)
-                        target_inds = np.concatenate((np.array(pos_targets), np.array(neg_targets)), axis=1)
-                        training_pass(sess_docCNN, train_op, data_inds, target_inds,
-                                      batch_target[:target_inds.shape[0], :], placeholders, keep_prob, True)
-
-                        all_data = []
-                        pos_targets = []
-                        neg_targets = []
-
-                # batch_generator = BatchGenerator(curr_train_inds, pos_words_num, neg_words_num, doc_len, context_len,
-                #                                  vector_up.shape[0] - 1, batch_size, vector_up.shape[0] - 1)
-                # data_size = batch_generator.get_data_size()
-                # num_batches = data_size / batch_size
-                # batch_generator.generate_training_batches()
-                #
-                # for i in range(num_batches):
-                #     ret_val = batch_generator.get_data()
-                #     data_inds, target_inds = ret_val
-                #     training_pass(sess_docCNN, train_op, data_inds, target_inds, batch_target, placeholders, keep_prob,
-                #                   True)
-
-                doc_len = np.random.choice(doc_lengths)
-                ind1 += super_batch_size
-                ind2 += super_batch_size
+            train_indices = RaggedArray.load(tokenized_file)
+            # Shuffle an order over the documents, rather than the memory-mapped documents themselves.
+            train_order = np.random.permutation(len(train_indices))
+
+            # we randomize the document lengths, so the model sees both long and short docs/sentences. The super
+            # batches are sampled on background threads while the training steps run.
+            super_batches = ((train_order[ind:ind + super_batch_size], np.random.choice(doc_lengths))
+                             for ind in range(0, len(train_indices), super_batch_size))
+            if num_targets:
+                produce_fn = lambda task: generate_multi_target_super_batch(
+                    train_indices, task[0], task[1], pos_words_num, neg_words_num, context_len, num_targets,
+                    shared_negatives)
+            else:
+                produce_fn = lambda task: generate_super_batch(train_indices, task[0], task[1], pos_words_num,
+                                                               neg_words_num, shared_negatives)
+            prefetcher = BatchPrefetcher(produce_fn, super_batches, args.prefetch_workers, args.prefetch_depth)
+
+            for super_batch in prefetcher:
+                all_data, all_targets = super_batch[:2]
+                for j in range(0, len(all_data), batch_size):
+                    data_inds = all_data[j:j + batch_size]
+                    target_inds = all_targets[j:j + batch_size]
+                    extra_feeds = dict()
+                    if num_targets:
+                        extra_feeds[target_positions_placeholder] = super_batch[2][j:j + batch_size]
+                    if shared_negatives:
+                        # The batches of a super batch share its pool.
+                        extra_feeds[negatives_placeholder] = super_batch[-2]
+                        extra_feeds[negative_mask_placeholder] = super_batch[-1][j:j + batch_size]
+                    training_pass(sess_docCNN, train_op, data_inds, target_inds, batch_target[:target_inds.shape[0]],
+                                  placeholders, keep_prob, True, extra_feeds)
 
             # Finished one of the files
             # feed_dict = {indices_data_placeholder: data_inds, indices_target_placeholder: target_inds,
@@ -292,8 +397,7 @@ def main(args):
             print('-----------------------------------------------')
             if (file_num + 1) % 10 == 0:
                 print('Performing classification experiment')
-                perform_trec_exp(sess_docCNN, model_output, indices_data_placeholder,
-                                 keep_prob_placeholder, is_training_placeholder, word_to_index)
+                perform_trec_exp(encoder)
 
             file_num += 1
             saver.save(sess_docCNN, os.path.join(checkpoint_path, 'gbw_model_latest'))
@@ -323,9 +427,33 @@ if __name__ == '__main__':
                         help='The directory containing the saved pre-processed and embedding files')
     parser.add_argument('--data-dir', type=str, default='/home/shunan/Data/', help='Directory containing the data.')
     parser.add_argument('--checkpoint-dir', type=str, default='./latest_model_gbw/', help='Checkpoints directory.')
+    parser.add_argument('--conv1d', action='store_true',
+                        help='Use CNNEmbed1D, built on 1D convolutions over (batch, doc_len, embed_dim) inputs, '
+                             'instead of CNNEmbed. Convert CNNEmbed checkpoints with convert_checkpoint.py '
+                             '--conversion to_conv1d.')
+    parser.add_argument('--ranks', type=str, default=None,
+                        help='Comma separated rank of each convolution, 0 for full rank, to train or fine-tune a model '
+                             'factorized with factorize_model.py.')
+    parser.add_argument('--optimizer', type=str, default='lazy_adam', choices=OPTIMIZERS,
+                        help='\'lazy_adam\' only updates the rows of the word embeddings used by the batch, and their '
+                             'Adam moments. \'adam\' updates the whole embedding matrix on every step.')
     parser.add_argument('--learning-rate', type=float, default=0.0003, help='The learning rate.')
     parser.add_argument('--top-k', type=int, default=3, help='The value of k when performing k-max pooling')
+    parser.add_argument('--num-targets', type=int, default=0,
+                        help='Train a causal model, with causal convolutions and a cumulative max pooling, on this '
+                             'many (prefix, next words) targets per context, all scored from one pass over the '
+                             'context. Needs --top-k=0. If 0, one target per context.')
     parser.add_argument('--max-iter', type=int, default=10, help='The maximum number of training iterations.')
+    parser.add_argument('--tokenizer', type=str, default='nltk', choices=TOKENIZERS,
+                        help='The tokenizer used to encode the classification data, \'nltk\' or \'fast\'.')
+    parser.add_argument('--shared-negatives', type=int, default=0,
+                        help='Score every context of a super batch against one shared pool of this many negative '
+                             'samples, masked against each context, with one matmul. The pool weighs as much as '
+                             '--num-negative-words private negatives. If 0, each context gets its own negatives.')
+    parser.add_argument('--prefetch-depth', type=int, default=4,
+                        help='Number of super batches to prepare ahead of the training steps.')
+    parser.add_argument('--prefetch-workers', type=int, default=1,
+                        help='Number of background threads preparing super batches.')
 
     args = parser.parse_args()
     main(args)
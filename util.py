@@ -1,27 +1,363 @@
+import itertools
 import numpy as np
+import struct
 import sys
+import threading
 import time
+import zipfile
+
+RAGGED_TOKENS_SUFFIX = '.tokens.npy'
+RAGGED_OFFSETS_SUFFIX = '.offsets.npy'
+
+
+class RaggedArray(object):
+    """
+    A list of variable-length documents, stored as one flat int32 array of indices and an int64 array of offsets.
+    Document i is tokens[offsets[i]:offsets[i + 1]], so the data can be memory-mapped and sliced without building
+    Python lists.
+    """
+
+    def __init__(self, tokens, offsets):
+        """
+        Args:
+            tokens (numpy.ndarray): 1D array with the indices of all documents, concatenated.
+            offsets (numpy.ndarray): 1D array of length num_docs + 1 with the start of each document in tokens.
+        """
+
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, docs):
+        """
+        Build a RaggedArray from a sequence of documents, each one a list or array of indices.
+        """
+
+        lengths = np.fromiter((len(doc) for doc in docs), dtype=np.int64, count=len(docs))
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.fromiter(itertools.chain.from_iterable(docs), dtype=np.int32, count=offsets[-1])
+        return cls(tokens, offsets)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Join several RaggedArrays into one, keeping the order of the documents.
+        """
+
+        tokens = np.concatenate([part.tokens for part in parts] + [np.zeros(0, dtype=np.int32)])
+        lengths = np.concatenate([part.lengths() for part in parts] + [np.zeros(0, dtype=np.int64)])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(tokens, offsets)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        """
+        Load a RaggedArray saved with save(). By default the arrays are memory-mapped, so loading is cheap and the
+        pages are shared between processes.
+        """
+
+        tokens = np.load(prefix + RAGGED_TOKENS_SUFFIX, mmap_mode=mmap_mode)
+        offsets = np.load(prefix + RAGGED_OFFSETS_SUFFIX, mmap_mode=mmap_mode)
+        return cls(tokens, offsets)
+
+    def save(self, prefix):
+        """
+        Save the tokens and offsets as two .npy files, prefix + '.tokens.npy' and prefix + '.offsets.npy'.
+        """
+
+        np.save(prefix + RAGGED_TOKENS_SUFFIX, np.asarray(self.tokens, dtype=np.int32))
+        np.save(prefix + RAGGED_OFFSETS_SUFFIX, np.asarray(self.offsets, dtype=np.int64))
+
+    def lengths(self):
+        """
+        Return the length of every document.
+        """
+
+        return np.diff(self.offsets)
+
+    def truncate(self, max_len):
+        """
+        Return a RaggedArray where every document longer than max_len only keeps its first max_len indices.
+        """
+
+        lengths = np.minimum(self.lengths(), max_len)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(self.offsets[:-1] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.tokens[positions], offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, key):
+        """
+        An integer returns that document as an array. A slice, an integer array or a boolean mask returns a new
+        RaggedArray; contiguous slices share the tokens array instead of copying it.
+        """
+
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self)
+            if key < 0 or key >= len(self):
+                raise IndexError('Document index out of range.')
+            return self.tokens[self.offsets[key]:self.offsets[key + 1]]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                return RaggedArray(self.tokens[self.offsets[start]:self.offsets[stop]],
+                                   self.offsets[start:stop + 1] - self.offsets[start])
+            key = np.arange(start, stop, step)
+
+        key = np.asarray(key)
+        if key.dtype == np.bool_:
+            key = np.flatnonzero(key)
+        starts = self.offsets[:-1][key]
+        lengths = self.offsets[1:][key] - starts
+        offsets = np.zeros(len(key) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.tokens[positions], offsets)
+
+
+def load_npz(path, mmap_mode='r'):
+    """
+    Load all the arrays of a .npz file. np.load ignores mmap_mode for .npz files and reads every array it is asked for,
+    but the members of an uncompressed .npz (np.savez) are plain .npy files stored as they are, so each one is
+    memory-mapped at its offset in the archive. Compressed members, scalars and empty arrays are read.
+
+    Args:
+        path (str): Path of the .npz file.
+        mmap_mode (str): Mode of the memory maps, or None to read everything.
+
+    Returns:
+        arrays (dict): The arrays by name.
+    """
+
+    arrays = dict()
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if mmap_mode is not None and info.compress_type == zipfile.ZIP_STORED:
+                # The data follows the 30 byte local file header, the file name and the extra field.
+                f.seek(info.header_offset + 26)
+                name_len, extra_len = struct.unpack('<HH', f.read(4))
+                f.seek(info.header_offset + 30 + name_len + extra_len)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+                if len(shape) and np.prod(shape) > 0 and not dtype.hasobject:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode=mmap_mode, shape=shape,
+                                             order='F' if fortran_order else 'C', offset=f.tell())
+                    continue
+
+            arrays[name] = np.lib.format.read_array(archive.open(info))
+
+    return arrays
+
+
+def left_pad(tokens, starts, lengths, zero_ind, width):
+    """
+    Gather the spans tokens[starts[i]:starts[i] + lengths[i]] into a matrix, padding each row with zeros at the
+    beginning. Spans longer than width keep their last width tokens.
+
+    Args:
+        tokens (numpy.ndarray): Flat array of indices, e.g. RaggedArray.tokens.
+        starts (numpy.ndarray): Start of each span in tokens.
+        lengths (numpy.ndarray): Length of each span.
+        zero_ind (int): Index to the zero vector, in the embedding matrix.
+        width (int): Number of columns of the output.
+
+    Returns:
+        padded (numpy.ndarray): (len(starts) x width) int32 array.
+    """
+
+    starts = starts + np.maximum(lengths - width, 0)
+    lengths = np.minimum(lengths, width)
+    padded = np.full((len(starts), width), zero_ind, dtype=np.int32)
+    rows = np.repeat(np.arange(len(starts)), lengths)
+    # Position of each kept token within its span.
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    padded[rows, width - lengths[rows] + within] = tokens[starts[rows] + within]
+
+    return padded
+
+
+def sample_negatives(tokens, starts, context_lens, num_neg_exs, vocab_size):
+    """
+    Draw negative samples for a set of documents at once. Each row holds num_neg_exs distinct indices, none of which
+    appear in the context tokens[starts[i]:starts[i] + context_lens[i]] of that document. Only the entries that
+    collide with the context or repeat within their row are redrawn.
+
+    Args:
+        tokens (numpy.ndarray): Flat array of indices, e.g. RaggedArray.tokens.
+        starts (numpy.ndarray): Start of each document's context in tokens.
+        context_lens (numpy.ndarray): Length of each document's context.
+        num_neg_exs (int): Number of negative samples per document.
+        vocab_size (int): Vocabulary size. Samples are drawn from range(vocab_size).
+
+    Returns:
+        neg_samples (numpy.ndarray): (len(starts) x num_neg_exs) array of negative samples.
+        num_resamples (int): Number of entries that had to be redrawn.
+    """
+
+    num_docs = len(starts)
+    if num_neg_exs == 0:
+        return np.zeros((num_docs, 0), dtype=np.int64), 0
+    rows = np.repeat(np.arange(num_docs, dtype=np.int64), context_lens)
+    within = np.arange(context_lens.sum()) - np.repeat(np.cumsum(context_lens) - context_lens, context_lens)
+    context = tokens[starts[rows] + within].astype(np.int64)
+
+    # Encode (row, index) pairs as single integers, so membership is a search in one sorted array.
+    stride = max(vocab_size, int(context.max()) + 1 if len(context) else 0)
+    context_keys = np.unique(rows * stride + context)
+
+    neg_samples = np.random.randint(vocab_size, size=(num_docs, num_neg_exs))
+    check_rows = np.arange(num_docs)
+    num_resamples = 0
+    while len(check_rows) > 0:
+        block = neg_samples[check_rows]
+        keys = check_rows[:, None] * stride + block
+        pos = np.minimum(np.searchsorted(context_keys, keys), max(len(context_keys) - 1, 0))
+        bad = context_keys[pos] == keys if len(context_keys) else np.zeros(keys.shape, dtype=bool)
+
+        # Mark repeats within a row, keeping the first occurrence in sorted order.
+        order = np.argsort(block, axis=1, kind='mergesort')
+        block_rows = np.arange(len(check_rows))[:, None]
+        sorted_block = block[block_rows, order]
+        repeats = np.zeros(block.shape, dtype=bool)
+        repeats[:, 1:] = sorted_block[:, 1:] == sorted_block[:, :-1]
+        bad[block_rows, order] |= repeats
+
+        num_bad = np.count_nonzero(bad)
+        if num_bad == 0:
+            break
+        block[bad] = np.random.randint(vocab_size, size=num_bad)
+        neg_samples[check_rows] = block
+        num_resamples += num_bad
+        check_rows = check_rows[bad.any(axis=1)]
+
+    return neg_samples, num_resamples
+
+
+def sample_shared_negatives(tokens, starts, context_lens, pool_size, vocab_size):
+    """
+    Draw one pool of distinct negative samples for a whole batch, and mask out, for each document, the samples that
+    appear in its context tokens[starts[i]:starts[i] + context_lens[i]]. Only the context tokens are searched in the
+    sorted pool, so this costs much less than drawing private negatives for every document.
+
+    Args:
+        tokens (numpy.ndarray): Flat array of indices, e.g. RaggedArray.tokens.
+        starts (numpy.ndarray): Start of each document's context in tokens.
+        context_lens (numpy.ndarray): Length of each document's context.
+        pool_size (int): Number of negative samples in the pool, at most vocab_size.
+        vocab_size (int): Vocabulary size. Samples are drawn from range(vocab_size).
+
+    Returns:
+        pool (numpy.ndarray): (pool_size) sorted array of negative samples.
+        pool_mask (numpy.ndarray): (len(starts) x pool_size) float32 array, 0 where a sample is in the document's
+            context and 1 elsewhere.
+    """
+
+    if pool_size > vocab_size:
+        raise ValueError('Can\'t draw {} distinct negative samples from a vocabulary of {} words.'.format(
+            pool_size, vocab_size))
+    pool = np.unique(np.random.randint(vocab_size, size=pool_size))
+    while len(pool) < pool_size:
+        pool = np.unique(np.concatenate((pool, np.random.randint(vocab_size, size=pool_size - len(pool)))))
+
+    rows = np.repeat(np.arange(len(starts), dtype=np.int64), context_lens)
+    within = np.arange(context_lens.sum()) - np.repeat(np.cumsum(context_lens) - context_lens, context_lens)
+    context = tokens[starts[rows] + within]
+    pos = np.minimum(np.searchsorted(pool, context), pool_size - 1)
+    hits = pool[pos] == context
+
+    pool_mask = np.ones((len(starts), pool_size), dtype=np.float32)
+    pool_mask[rows[hits], pos[hits]] = 0.
+    return pool, pool_mask
+
+
+def sample_multi_targets(tokens, starts, t_inds, num_pos_exs, num_neg_exs, vocab_size):
+    """
+    Gather the words to predict for several targets per document, followed by their negative samples. The negative
+    samples of a target don't appear in its document up to its last word to predict.
+
+    Args:
+        tokens (numpy.ndarray): Flat array of indices, e.g. RaggedArray.tokens.
+        starts (numpy.ndarray): Start of each document in tokens.
+        t_inds (numpy.ndarray): (len(starts) x num_targets) index of the first word to predict of each target.
+        num_pos_exs (int): Number of words to predict per target.
+        num_neg_exs (int): Number of negative samples per target.
+        vocab_size (int): Vocabulary size.
+
+    Returns:
+        target_inds (numpy.ndarray): (len(starts) x num_targets x (num_pos_exs + num_neg_exs)) array.
+        num_resamples (int): Number of negative samples that had to be redrawn.
+    """
+
+    target_starts = (starts[:, None] + t_inds).ravel()
+    pos_inds = tokens[target_starts[:, None] + np.arange(num_pos_exs)]
+    neg_samples, num_resamples = sample_negatives(tokens, np.repeat(starts, t_inds.shape[1]),
+                                                  t_inds.ravel() + num_pos_exs, num_neg_exs, vocab_size)
+    target_inds = np.hstack((pos_inds, neg_samples)).reshape(t_inds.shape + (num_pos_exs + num_neg_exs,))
+    return target_inds, num_resamples
+
 
 def pad_zeros(data_indices, zero_ind, max_doc_len):
     """
     Pad the indices with zero in the beginning if the length is less than max number of words.
 
     Args:
-        data_indices (list): A list of documents, where each document is a list of indices.
+        data_indices (RaggedArray): The documents, where each document is an array of indices.
         zero_ind (int): Index to the zero vector, in the embedding matrix.
-        max_doc_len (int): Maximum length of the document, for padding.
+        max_doc_len (int): Maximum length of the document, for padding. Longer documents are truncated.
 
     Returns:
         new_data_indices (numpy.ndarray): The same documents, but padded so that every document is the same length.
     """
 
-    new_data_indices = []
-    for doc in data_indices:
-        if len(doc) < max_doc_len:
-            doc = [zero_ind for _ in range(max_doc_len - len(doc))] + doc
-        new_data_indices.append(doc)
+    if not isinstance(data_indices, RaggedArray):
+        data_indices = RaggedArray.from_lists(data_indices)
 
-    return np.array(new_data_indices)
+    # Keep the beginning of documents that are too long.
+    lengths = np.minimum(data_indices.lengths(), max_doc_len)
+    return left_pad(data_indices.tokens, data_indices.offsets[:-1], lengths, zero_ind, max_doc_len)
+
+
+def pad_batch(docs, zero_ind, min_len=1):
+    """
+    Pad a batch of documents of different lengths to the length of the longest one, with zeros at the beginning, and
+    return the mask of the words. Feeding both to a CNNEmbed built with a mask gives the same embeddings as feeding the
+    documents one at a time.
+
+    Args:
+        docs (RaggedArray): The documents, as arrays of indices. A list of arrays is converted.
+        zero_ind (int): Index to the zero vector, in the embedding matrix.
+        min_len (int): Minimum number of columns, e.g. k for k-max pooling.
+
+    Returns:
+        padded (numpy.ndarray): (num_docs x max_len) int32 array of indices.
+        mask (numpy.ndarray): (num_docs x max_len) float32 array, 1 for words and 0 for padding.
+    """
+
+    if not isinstance(docs, RaggedArray):
+        docs = RaggedArray.from_lists(docs)
+
+    lengths = docs.lengths()
+    width = max(lengths.max() if len(lengths) else 0, min_len)
+    padded = left_pad(docs.tokens, docs.offsets[:-1], lengths, zero_ind, width)
+    mask = (np.arange(width) >= (width - lengths)[:, None]).astype(np.float32)
+    return padded, mask
 
 
 def get_sup_data(train_data_indices, test_data_indices, train_labels, test_labels,
@@ -30,8 +366,8 @@ def get_sup_data(train_data_indices, test_data_indices, train_labels, test_label
     Get training data, training labels, testing data and testing labels for supervised learning.
 
     Args:
-        train_data_indices: [total num of training data * variable length] int numpy array containing all training indices.
-        test_data_indices: [total num of testing data * variable length] int numpy array containing all testing indices.
+        train_data_indices (RaggedArray): All training documents, as arrays of indices.
+        test_data_indices (RaggedArray): All testing documents, as arrays of indices.
         train_labels: [total num of training data, 1] int numpy array containing all sentiment scores for training reviews.
         test_labels: [total num of testing data, 1] int numpy array containing all sentiment scores for testing reviews.
         unlabeled_class (int): the score representing neutral or unlabeled reviews.
@@ -42,8 +378,8 @@ def get_sup_data(train_data_indices, test_data_indices, train_labels, test_label
         zero_vector_index (int): the index of the zero vector, used in fixed length padding
 
     Returns:
-        train_data_indices_sup: int numpy array, supervised training data
-        test_data_indices_sup: int numpy array, supervised testing data
+        train_data_indices_sup: supervised training data, a padded int numpy array if fixed_length, else a RaggedArray
+        test_data_indices_sup: supervised testing data, a padded int numpy array if fixed_length, else a RaggedArray
         train_labels_sup: int numpy array, supervised training labels
         test_labels_sup: int numpy array, supervised testing labels
     """
@@ -68,8 +404,8 @@ def get_sup_data(train_data_indices, test_data_indices, train_labels, test_label
             train_data_indices_sup = pad_zeros(train_data_indices, zero_vector_index, max_doc_len)
             test_data_indices_sup = pad_zeros(test_data_indices, zero_vector_index, max_doc_len)
         else:
-            train_data_indices_sup = np.copy(train_data_indices)
-            test_data_indices_sup = np.copy(test_data_indices)
+            train_data_indices_sup = train_data_indices
+            test_data_indices_sup = test_data_indices
         train_labels_sup = np.copy(train_labels)
         test_labels_sup = np.copy(test_labels)
     elif num_classes == 100:
@@ -80,7 +416,7 @@ def get_sup_data(train_data_indices, test_data_indices, train_labels, test_label
             train_data_indices_sup = pad_zeros(train_data_indices_sup, zero_vector_index, max_doc_len)
             test_data_indices_sup = pad_zeros(test_data_indices, zero_vector_index, max_doc_len)
         else:
-            test_data_indices_sup = np.copy(test_data_indices)
+            test_data_indices_sup = test_data_indices
         train_labels_sup = train_labels[I]
         test_labels_sup = np.copy(test_labels)
     else:
@@ -93,16 +429,28 @@ def get_sup_data(train_data_indices, test_data_indices, train_labels, test_label
 class BatchGenerator(object):
     """
     Class for generating batches of training. This class also generates the negative samples for each training
-    document.
+    document. Batches are sampled lazily, one at a time, from a shuffled order over the documents, so memory use
+    doesn't depend on the number of documents.
+
+    With num_buckets set, the training instances of an epoch are grouped by context length and each batch is only
+    padded to the length of its bucket, instead of max_doc_len. This is only valid for models that don't need a fixed
+    input length (CNN_pool and CNN_topk).
+
+    With num_targets set, each document gets num_targets targets for a causal model, see CNNEmbed. The context is
+    then the document up to the end of its longest target context, and every target is the prefix ending at its own
+    position, so one pass over the context scores all of them.
+
+    With shared_negatives set, the documents of a batch share one pool of that many negative samples instead of
+    drawing num_neg_exs each, and the batches end with the pool and its mask, see sample_shared_negatives.
     """
 
     def __init__(self, training_inds, num_pos_exs, num_neg_exs, max_doc_len, context_len, vocab_size, batch_size,
-                 zero_ind, gap=None):
+                 zero_ind, gap=None, num_buckets=None, min_doc_len=1, num_targets=None, shared_negatives=None):
         """
         Create a batch generator.
 
         Args:
-            training_inds (list): List of documents, each one represented as a list of indices
+            training_inds (RaggedArray): The documents, each one represented as an array of indices
             num_pos_exs (int): Number of words forward to predict
             num_neg_exs (int): Number of negative samples
             max_doc_len (int): Length of each document
@@ -111,6 +459,11 @@ class BatchGenerator(object):
             batch_size (int): Batch size
             gap (tuple): A tuple of length 2, containing the low and high values to sample the gap from. If None, don't
                 use a gap.
+            num_buckets (int): Number of context length buckets. If None or 0, every batch is padded to max_doc_len.
+            min_doc_len (int): Minimum length to pad a bucketed batch to, e.g. k for k-max pooling.
+            num_targets (int): Number of targets per document for a causal model. If None or 0, one target.
+            shared_negatives (int): Size of the pool of negative samples shared by each batch. If None or 0, every
+                document gets num_neg_exs negative samples of its own.
         """
 
         self.num_pos_exs = num_pos_exs
@@ -121,100 +474,317 @@ class BatchGenerator(object):
         self.batch_size = batch_size
         self.zero_ind = zero_ind
         self.gap = gap
-        self.counter = 0
+        self.num_buckets = num_buckets
+        self.min_doc_len = min_doc_len
+        self.num_targets = num_targets
+        self.shared_negatives = shared_negatives
+        self.epoch = iter([])
+        self.num_resamples = 0
 
-        # Remove the documents that are too short.
-        self.training_inds = self.remove_short_docs(training_inds)
+        # Keep the documents as they are (possibly memory-mapped) and only remember which ones are long enough.
+        self.training_inds = training_inds
+        self.doc_inds = self.remove_short_docs(training_inds)
 
     def get_data_size(self):
         '''
         Return the size of the training data.
         '''
 
-        return len(self.training_inds)
+        return len(self.doc_inds)
 
     def remove_short_docs(self, training_inds):
         '''
-        Remove the documents from the training indices that are less than the context length.
+        Find the documents from the training indices that are long enough to predict num_pos_exs words.
 
         Args:
-            training_inds (list): List of documents, each one represented as a list of indices
+            training_inds (RaggedArray): The documents, each one represented as an array of indices
 
         Returns:
-            Same list of documents, but with the documents that are too short removed.
+            Array with the indices of the documents that are kept.
         '''
 
-        skipped_docs = 0
-        new_train_inds = []
-        for doc in training_inds:
-            if len(doc) >= self.num_pos_exs + 1:
-                new_train_inds.append(doc)
-            else:
-                skipped_docs += 1
-
-        print('Number of skipped documents: {}'.format(skipped_docs))
-        return np.array(new_train_inds)
+        keep = training_inds.lengths() >= self.num_pos_exs + 1
+        print('Number of skipped documents: {}'.format(len(training_inds) - np.count_nonzero(keep)))
+        return np.flatnonzero(keep)
 
     def get_data(self):
         """
-        Return a training batch, along with the forward prediction words and negative samples.
+        Return a training batch, along with the forward prediction words and negative samples, as returned by
+        generate_batch. The batch is sampled when it's requested.
         """
 
-        if self.counter + self.batch_size <= len(self.shuffle_indices):
-            inds = self.shuffle_indices[self.counter:self.counter + self.batch_size]
-            self.counter += self.batch_size
-            return self.training_inds_with_samples[inds, :], self.target_with_samples[inds, :]
+        task = next(self.epoch, None)
+        if task is not None:
+            batch, num_resamples = self._sample_batch(*task)
+            self.num_resamples += num_resamples
+            return batch
         else:
             return None
 
     def generate_training_batches(self):
         """
-        Generate all batches for training.
-        """
-
-        self.training_inds_with_samples = []
-        self.target_with_samples = []
-        self.counter = 0
-
-        t1 = time.time()
-        # Generate all the batches here.
-        num_resamples = 0
-        for i in range(len(self.training_inds)):
-            dat = self.training_inds[i]
-            gap_val = 0
-            if len(dat) < self.context_len + self.num_pos_exs:
-                pos_inds = dat[-self.num_pos_exs:]
-                t_ind = len(dat) - self.num_pos_exs
-                context_inds = set(dat)
-            else:
-                if self.gap is not None:
-                    # Use a gap in this case, where we try to predict the tokens after the gap.
-                    gap_val = np.random.randint(self.gap[0], self.gap[1])
-                    if len(dat) < self.context_len + self.num_pos_exs + gap_val:
-                        gap_val = 0
-
-                forward_inds = range(self.context_len + gap_val, min(len(dat), self.max_doc_len) - self.num_pos_exs + 1)
-                t_ind = np.random.choice(forward_inds)
-                pos_inds = dat[t_ind:t_ind+self.num_pos_exs]
-                context_inds = set(dat[:t_ind + self.num_pos_exs])
-
-            # Doing the negative sampling.
-            neg_samples = np.random.choice(self.vocab_size, size=self.num_neg_exs, replace=False)
-            while context_inds.intersection(set(neg_samples)):
-                neg_samples = np.random.choice(self.vocab_size, size=self.num_neg_exs, replace=False)
-                num_resamples += 1
+        Start a new epoch. The batches themselves are sampled by get_data.
+        """
+
+        if self.num_resamples > 0:
+            print('Number of resamples in the last epoch: {}'.format(self.num_resamples))
+        self.epoch = self.epoch_tasks()
+        self.num_resamples = 0
+
+    def epoch_tasks(self):
+        """
+        Yield the batches of one epoch as tasks to give to generate_batch, e.g. through a BatchPrefetcher. Each task
+        is a tuple (doc_inds, t_inds, gap_vals, doc_len) with the documents, the sampled targets and gaps, and the
+        length to pad the contexts to. There are get_data_size() / batch_size full batches per epoch.
+        """
+
+        shuffle_indices = np.random.permutation(self.doc_inds)
+        num_batches = len(shuffle_indices) / self.batch_size
+        lengths = self.training_inds.offsets[1:][shuffle_indices] - self.training_inds.offsets[:-1][shuffle_indices]
+        t_inds, gap_vals = self.sample_targets(lengths)
+
+        if not self.num_buckets:
+            for i in range(num_batches):
+                rows = slice(i * self.batch_size, (i + 1) * self.batch_size)
+                yield shuffle_indices[rows], t_inds[rows], gap_vals[rows], self.max_doc_len
+            return
+
+        # Put the contexts into buckets at quantiles of their lengths. The sort is stable, so documents stay shuffled
+        # within their bucket.
+        context_lens = t_inds - gap_vals
+        if self.num_targets:
+            context_lens = context_lens.max(axis=1)
+        bucket_lens = self.bucket_lengths(context_lens)
+        buckets = np.minimum(np.searchsorted(bucket_lens, context_lens), len(bucket_lens) - 1)
+        order = np.argsort(buckets, kind='mergesort')
+        bucket_ends = np.cumsum(np.bincount(buckets, minlength=len(bucket_lens)))
+
+        # Full batches from each bucket, then batches mixing the remainders of all buckets.
+        batches = []
+        leftovers = []
+        for members in np.split(order, bucket_ends[:-1]):
+            num_full = len(members) / self.batch_size * self.batch_size
+            batches.extend(members[:num_full].reshape(-1, self.batch_size))
+            leftovers.append(members[num_full:])
+        leftovers = np.concatenate(leftovers)
+        batches.extend(leftovers[:num_batches * self.batch_size - len(batches) * self.batch_size].reshape(
+            -1, self.batch_size))
+
+        for i in np.random.permutation(len(batches)):
+            rows = batches[i]
+            yield shuffle_indices[rows], t_inds[rows], gap_vals[rows], bucket_lens[buckets[rows].max()]
+
+    def bucket_lengths(self, context_lens):
+        """
+        Return the sorted padded lengths of the buckets, placed at quantiles of the context lengths.
+
+        Args:
+            context_lens (numpy.ndarray): Lengths of the contexts of one epoch.
+
+        Returns:
+            bucket_lens (numpy.ndarray): Padded length of each bucket, between min_doc_len and max_doc_len.
+        """
+
+        quantiles = np.percentile(context_lens, np.linspace(0, 100, self.num_buckets + 1)[1:])
+        bucket_lens = np.clip(np.ceil(quantiles).astype(np.int64), self.min_doc_len, self.max_doc_len)
+        return np.unique(bucket_lens)
+
+    def __iter__(self):
+        """
+        Iterate over the batches of one epoch, sampling each batch only when it's needed.
+        """
+
+        for task in self.epoch_tasks():
+            yield self.generate_batch(task)
+
+    def generate_batch(self, task):
+        """
+        Generate a training batch from a task yielded by epoch_tasks. This doesn't modify the generator, so it can
+        be called from several threads at once.
+
+        Args:
+            task (tuple): (doc_inds, t_inds, gap_vals, doc_len), as yielded by epoch_tasks.
+
+        Returns:
+            data_inds (numpy.ndarray): (len(doc_inds) x doc_len) array of contexts, padded with zeros.
+            target_inds (numpy.ndarray): (len(doc_inds) x (num_pos_exs + num_neg_exs)) array of the words to predict,
+                followed by the negative samples. With num_targets, (len(doc_inds) x num_targets x
+                (num_pos_exs + num_neg_exs)).
+            target_positions (numpy.ndarray): Only with num_targets, the (len(doc_inds) x num_targets) position in
+                data_inds of the last word of each target's context.
+            negative_inds, negative_mask (numpy.ndarray): Only with shared_negatives, the pool of negative samples
+                and its (len(doc_inds) x shared_negatives) mask. target_inds then only holds the words to predict.
+        """
+
+        batch, _ = self._sample_batch(*task)
+        return batch
+
+    def _sample_batch(self, doc_inds, t_inds, gap_vals, doc_len):
+        """
+        Gather the contexts and targets, and sample the negative samples, for the given documents. Return the batch
+        and the number of negative samples that were redrawn.
+        """
+
+        tokens = self.training_inds.tokens
+        starts = self.training_inds.offsets[:-1][doc_inds]
+        # With shared negatives, the private ones aren't drawn.
+        num_neg_exs = 0 if self.shared_negatives else self.num_neg_exs
+
+        if self.num_targets:
+            target_inds, num_resamples = sample_multi_targets(tokens, starts, t_inds, self.num_pos_exs, num_neg_exs,
+                                                              self.vocab_size)
+            context_lens = t_inds - gap_vals
+            window_lens = context_lens.max(axis=1)
+            data_inds = left_pad(tokens, starts, window_lens, self.zero_ind, doc_len)
+            target_positions = doc_len - window_lens[:, None] + context_lens - 1
+            batch = (data_inds, target_inds, target_positions.astype(np.int32))
+            # The pool is masked against the document up to its last target.
+            target_ends = t_inds.max(axis=1) + self.num_pos_exs
+        else:
+            pos_inds = tokens[(starts + t_inds)[:, None] + np.arange(self.num_pos_exs)]
+            neg_samples, num_resamples = sample_negatives(tokens, starts, t_inds + self.num_pos_exs, num_neg_exs,
+                                                          self.vocab_size)
 
             # Pad with zeros at the beginning
-            tmp = dat[:(t_ind - gap_val)]
-            train_inds = [self.zero_ind for _ in range(self.max_doc_len - len(tmp))] + tmp
-            self.training_inds_with_samples.append(train_inds)
-            self.target_with_samples.append(np.concatenate((pos_inds, neg_samples)))
+            data_inds = left_pad(tokens, starts, t_inds - gap_vals, self.zero_ind, doc_len)
+            batch = (data_inds, np.hstack((pos_inds, neg_samples)))
+            target_ends = t_inds + self.num_pos_exs
+
+        if self.shared_negatives:
+            batch += sample_shared_negatives(tokens, starts, target_ends, self.shared_negatives, self.vocab_size)
+        return batch, num_resamples
+
+    def sample_targets(self, lengths):
+        """
+        Sample the position of the words to predict, and the gap before them, for documents of the given lengths.
+
+        Args:
+            lengths (numpy.ndarray): Length of each document.
+
+        Returns:
+            t_inds (numpy.ndarray): Index of the first word to predict in each document, or a (len(lengths) x
+                num_targets) array of them with num_targets.
+            gap_vals (numpy.ndarray): Number of words skipped between the context and the words to predict.
+        """
+
+        # The targets of a document are sampled independently, as for that many copies of the document.
+        if self.num_targets:
+            lengths = np.repeat(lengths, self.num_targets)
+
+        # Documents shorter than the context predict their last words, without a gap.
+        short = lengths < self.context_len + self.num_pos_exs
+        gap_vals = np.zeros(len(lengths), dtype=np.int64)
+        if self.gap is not None:
+            # Use a gap in this case, where we try to predict the tokens after the gap.
+            gap_vals = np.random.randint(self.gap[0], self.gap[1], size=len(lengths))
+            gap_vals[lengths < self.context_len + self.num_pos_exs + gap_vals] = 0
+        gap_vals[short] = 0
+
+        low = self.context_len + gap_vals
+        high = np.minimum(lengths, self.max_doc_len) - self.num_pos_exs + 1
+        t_inds = low + (np.random.random_sample(len(lengths)) * (high - low)).astype(np.int64)
+        t_inds[short] = lengths[short] - self.num_pos_exs
 
-        self.training_inds_with_samples = np.array(self.training_inds_with_samples)
-        self.target_with_samples = np.array(self.target_with_samples)
+        if self.num_targets:
+            return t_inds.reshape(-1, self.num_targets), gap_vals.reshape(-1, self.num_targets)
+        return t_inds, gap_vals
 
-        # Shuffle the batches.
-        self.shuffle_indices = np.random.permutation(self.training_inds_with_samples.shape[0])
 
-        print('Time spent generating all negative samples: {}'.format(time.time() - t1))
-        print('Number of resamples: {}'.format(num_resamples))
\ No newline at end of file
+class BatchPrefetcher(object):
+    """
+    Produce training batches on background threads, so the next batches are built while the current training step
+    runs. Each task is turned into one result by produce_fn, and results are returned in the same order as the tasks.
+    """
+
+    def __init__(self, produce_fn, tasks, num_workers=1, prefetch_depth=10):
+        """
+        Create the prefetcher and start its worker threads.
+
+        Args:
+            produce_fn (callable): Function that takes a task and returns its result, e.g. a batch. It's called from
+                several threads at once when num_workers > 1.
+            tasks (iterable): The tasks, consumed lazily and possibly infinite.
+            num_workers (int): Number of worker threads.
+            prefetch_depth (int): Maximum number of results that are produced ahead of the consumer.
+        """
+
+        self.produce_fn = produce_fn
+        self.tasks = iter(tasks)
+        self.prefetch_depth = prefetch_depth
+        self.results = dict()
+        self.next_task = 0
+        self.next_result = 0
+        self.num_tasks = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.workers = [threading.Thread(target=self._work) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        """
+        Worker loop: take the next task, produce its result and store it under the task's position.
+        """
+
+        while True:
+            with self.cond:
+                while not self.closed and self.next_task - self.next_result >= self.prefetch_depth:
+                    self.cond.wait()
+                if self.closed or self.num_tasks is not None:
+                    return
+                try:
+                    task = next(self.tasks)
+                except Exception as e:
+                    self.num_tasks = self.next_task
+                    if not isinstance(e, StopIteration):
+                        self.results[self.next_task] = (False, e)
+                        self.num_tasks += 1
+                    self.cond.notify_all()
+                    return
+                task_ind = self.next_task
+                self.next_task += 1
+
+            try:
+                result = (True, self.produce_fn(task))
+            except Exception as e:
+                result = (False, e)
+
+            with self.cond:
+                self.results[task_ind] = result
+                self.cond.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """
+        Return the next result, waiting for it if it isn't ready yet. Errors raised by a worker are raised here.
+        """
+
+        with self.cond:
+            while self.next_result not in self.results:
+                if self.num_tasks is not None and self.next_result >= self.num_tasks:
+                    raise StopIteration
+                # Wait with a timeout, so the main thread still responds to interrupts.
+                self.cond.wait(1.)
+            success, result = self.results.pop(self.next_result)
+            self.next_result += 1
+            self.cond.notify_all()
+
+        if not success:
+            self.close()
+            raise result
+        return result
+
+    __next__ = next
+
+    def close(self):
+        """
+        Stop the worker threads once they finish their current task.
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()